@@ -2,12 +2,31 @@ import os
 import io
 import base64
 import re
+import json
+import random
+import secrets
+import socket
+import sqlite3
+import time
+import threading
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
 from datetime import datetime, date, timedelta
+import hashlib
+import hmac
+import multiprocessing
+import zipfile
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from hashlib import pbkdf2_hmac
 from typing import Dict, List, Tuple, Optional
 
+import altair as alt
+import numpy as np
 import streamlit as st
-from PIL import Image
+from PIL import Image, ImageOps
 from streamlit_drawable_canvas import st_canvas
 
 from reportlab.lib.pagesizes import A4
@@ -19,7 +38,6 @@ from reportlab.platypus import (
     Image as RLImage, PageBreak
 )
 from reportlab.lib.enums import TA_CENTER
-from reportlab.lib.utils import ImageReader
 
 # ---------------------------
 # CONFIG
@@ -34,6 +52,153 @@ ADMIN_PASSWORD = st.secrets.get("ADMIN_PASSWORD", "1996")
 
 STATUS_OPCIONES = ["OPERATIVO", "OPERATIVO CON FALLA", "INOPERATIVO"]
 
+def _truthy(value) -> bool:
+    # Secrets y celdas del Sheet: 1 / "1" / "true" / "TRUE" / "sí" ... ; lo demás (incl. "false", "0", "") es False
+    return str(value).strip().lower() in ("1", "true", "yes", "si", "sí", "on")
+
+def _secret_list(name: str) -> List[str]:
+    # Lista TOML en secrets o texto separado por comas
+    value = st.secrets.get(name, [])
+    items = value.split(",") if isinstance(value, str) else value
+    return [str(v).strip() for v in items if str(v).strip()]
+
+# Segundos que se reutilizan los handles Spreadsheet/Worksheet antes de pedir metadata otra vez
+SHEET_HANDLE_TTL = int(st.secrets.get("SHEET_HANDLE_TTL", 600))
+# Cache de lectura de hojas: segundos de vigencia y tope de celdas en memoria.
+# Las hojas vivas no se desalojan nunca (su tamaño lo acota el archivo mensual): el tope se
+# cumple desalojando hojas de archivo, así una hoja grande no expulsa a users/templates.
+RECORDS_CACHE_TTL = int(st.secrets.get("RECORDS_CACHE_TTL", 60))
+RECORDS_CACHE_MAX_CELLS = int(st.secrets.get("RECORDS_CACHE_MAX_CELLS", 2_000_000))
+RECORDS_CACHE_PINNED = ("users", "templates", "reports", "report_items")
+# Hojas que solo crecen: se sincroniza solo la cola; cada FULL_SYNC_INTERVAL s se valida todo.
+# users NO: desactivar un usuario o cambiar su clave edita una fila existente y debe verse en RECORDS_CACHE_TTL.
+INCREMENTAL_SYNC_SHEETS = ("reports", "report_items")
+FULL_SYNC_INTERVAL = int(st.secrets.get("FULL_SYNC_INTERVAL", 900))
+# Archivo por mes: reports/report_items vivos guardan solo los últimos ARCHIVE_KEEP_MONTHS meses
+# (0 = no archivar). ARCHIVE_AUTO (apagado por defecto) lo corre en segundo plano; cada pasada
+# toma antes el lease "mantenimiento" de la hoja leases, así que con varias réplicas corre en una a la vez.
+ARCHIVE_KEEP_MONTHS = int(st.secrets.get("ARCHIVE_KEEP_MONTHS", 6))
+ARCHIVE_AUTO = _truthy(st.secrets.get("ARCHIVE_AUTO", False))
+ARCHIVE_CHECK_INTERVAL = int(st.secrets.get("ARCHIVE_CHECK_INTERVAL", 6 * 3600))
+# Cuotas Sheets API (por usuario/service account): 60 lecturas y 60 escrituras por minuto
+SHEETS_READS_PER_MIN = int(st.secrets.get("SHEETS_READS_PER_MIN", 60))
+SHEETS_WRITES_PER_MIN = int(st.secrets.get("SHEETS_WRITES_PER_MIN", 60))
+SHEETS_MAX_RETRIES = int(st.secrets.get("SHEETS_MAX_RETRIES", 5))
+# Si el diagnóstico o la verificación de esquema fallan (Google caído), se recuerda el error
+# estos segundos antes de volver a intentar: los reruns no repiten los reintentos con backoff.
+BOOTSTRAP_RETRY_S = int(st.secrets.get("BOOTSTRAP_RETRY_S", 30))
+# Dónde viven users/reports/report_items: "sheets" (Google Sheets) o "sqlite" (archivo local, sin red)
+STORAGE_BACKEND = str(st.secrets.get("STORAGE_BACKEND", "sheets")).strip().lower()
+SQLITE_DB_PATH = st.secrets.get("SQLITE_DB_PATH", os.path.join("data", "checklist.sqlite3"))
+# Cache de hojas compartido entre réplicas: "" (solo por proceso), "sqlite" (archivo en un volumen
+# compartido del mismo host) o "redis" (SHARED_CACHE_URL; requiere el paquete redis)
+SHARED_CACHE = str(st.secrets.get("SHARED_CACHE", "")).strip().lower()
+SHARED_CACHE_PATH = st.secrets.get("SHARED_CACHE_PATH", os.path.join("data", "shared_cache.sqlite3"))
+SHARED_CACHE_URL = st.secrets.get("SHARED_CACHE_URL", "redis://localhost:6379/0")
+SHARED_CACHE_PREFIX = st.secrets.get("SHARED_CACHE_PREFIX", "checklist")
+# Métricas por rerun (JSON lines): apagado salvo que se configure PERF_LOG_PATH (p.ej. data/perf.jsonl).
+# Al pasar PERF_LOG_MAX_BYTES el archivo se rota a <PERF_LOG_PATH>.1 (se guarda solo el anterior).
+PERF_LOG_PATH = st.secrets.get("PERF_LOG_PATH", "")
+PERF_LOG_MAX_BYTES = int(st.secrets.get("PERF_LOG_MAX_BYTES", 10_000_000))
+
+# ---------------------------
+# MÉTRICAS POR RERUN
+# ---------------------------
+# Rerun en curso del hilo del script: fases (ms) y llamadas a Google API. Los hilos de fondo
+# (cola, pools) no tienen rerun y no se cuentan aquí, solo en sheets_api_stats().
+_perf_run: ContextVar[Optional[dict]] = ContextVar("_perf_run", default=None)
+
+@st.cache_resource
+def _perf_log_lock() -> threading.Lock:
+    return threading.Lock()
+
+@contextmanager
+def perf_phase(name: str):
+    """Suma el tiempo del bloque a la fase `name` del rerun actual (las fases pueden anidarse)."""
+    run = _perf_run.get()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        if run is not None:
+            run["phases"][name] = run["phases"].get(name, 0.0) + (time.perf_counter() - t0) * 1000
+
+def _perf_api_call(method: str, ms: float):
+    run = _perf_run.get()
+    if run is not None:
+        run["api"][method] = run["api"].get(method, 0) + 1
+        run["api_ms"] += ms
+
+@contextmanager
+def perf_rerun(kind: str = "app"):
+    """
+    Envuelve un rerun completo (main) o de un fragmento. Un fragmento que corre dentro
+    de un rerun completo se registra como una fase más.
+    """
+    if _perf_run.get() is not None:
+        with perf_phase(kind):
+            yield
+        return
+    run = {"kind": kind, "t0": time.perf_counter(), "phases": {}, "api": {}, "api_ms": 0.0}
+    token = _perf_run.set(run)
+    try:
+        yield
+    finally:
+        _perf_run.reset(token)
+        _perf_finish(run)
+
+def _perf_finish(run: dict):
+    total_ms = (time.perf_counter() - run["t0"]) * 1000
+    sess = st.session_state.setdefault("_perf_session", {"sid": secrets.token_hex(4), "reruns": 0, "ms": 0.0, "api": {}})
+    sess["reruns"] += 1
+    sess["ms"] += total_ms
+    for m, n in run["api"].items():
+        sess["api"][m] = sess["api"].get(m, 0) + n
+    rec = {
+        "ts": datetime.now().isoformat(timespec="milliseconds"),
+        "session": sess["sid"],
+        "user": st.session_state.get("user", ""),
+        "kind": run["kind"],
+        "total_ms": round(total_ms, 1),
+        "phases": {k: round(v, 1) for k, v in run["phases"].items()},
+        "api_calls": sum(run["api"].values()),
+        "api": run["api"],
+        "api_ms": round(run["api_ms"], 1),
+    }
+    st.session_state["_perf_last"] = rec
+    if not PERF_LOG_PATH:
+        return
+    try:
+        os.makedirs(os.path.dirname(PERF_LOG_PATH) or ".", exist_ok=True)
+        line = json.dumps(rec, ensure_ascii=False) + "\n"
+        with _perf_log_lock():
+            size = os.path.getsize(PERF_LOG_PATH) if os.path.exists(PERF_LOG_PATH) else 0
+            if size and size + len(line) > PERF_LOG_MAX_BYTES:
+                os.replace(PERF_LOG_PATH, PERF_LOG_PATH + ".1")
+            with open(PERF_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(line)
+    except OSError:
+        pass  # las métricas nunca deben romper la app
+
+def perf_sidebar():
+    last = st.session_state.get("_perf_last")
+    sess = st.session_state.get("_perf_session")
+    with st.sidebar.expander("⏱️ Rendimiento"):
+        if not last:
+            st.caption("Sin datos aún (se muestran desde el segundo rerun).")
+            return
+        st.write(f"Último rerun ({last['kind']}): **{last['total_ms']:.0f} ms** · "
+                 f"{last['api_calls']} llamadas Google ({last['api_ms']:.0f} ms)")
+        st.dataframe(
+            [{"fase": k, "ms": v} for k, v in sorted(last["phases"].items(), key=lambda kv: -kv[1])],
+            use_container_width=True, hide_index=True,
+        )
+        st.caption(
+            f"Sesión: {sess['reruns']} reruns · {sess['ms'] / max(1, sess['reruns']):.0f} ms prom. · "
+            f"{sum(sess['api'].values())} llamadas Google"
+            + (" (" + ", ".join(f"{m}: {n}" for m, n in sorted(sess["api"].items())) + ")" if sess["api"] else "")
+        )
+
 # ---------------------------
 # GOOGLE SHEETS
 # ---------------------------
@@ -53,123 +218,1811 @@ def get_google_client():
     if not sa_info or not isinstance(sa_info, dict):
         return None, None, "Falta SECRET: [gcp_service_account] (formato TOML recomendado)"
 
-    scopes = [
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive.readonly",  # solo para abrir el sheet sin dramas
-    ]
-    try:
-        creds = Credentials.from_service_account_info(sa_info, scopes=scopes)
-        gc = gspread.authorize(creds)
-        return gc, sheet_id, None
-    except Exception as e:
-        return None, None, f"No se pudo autenticar con Google: {e}"
+    scopes = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive.readonly",  # solo para abrir el sheet sin dramas
+    ]
+    try:
+        creds = Credentials.from_service_account_info(sa_info, scopes=scopes)
+        gc = gspread.authorize(creds)
+        return gc, sheet_id, None
+    except Exception as e:
+        return None, None, f"No se pudo autenticar con Google: {e}"
+
+@st.cache_resource
+def _sheet_handles() -> dict:
+    # Cache de proceso (compartido entre sesiones): Spreadsheet + Worksheets por nombre
+    return {"lock": threading.Lock(), "sh": None, "sh_ts": 0.0, "ws": {}, "ws_ts": 0.0}
+
+def invalidate_sheet_handles(sheet_name: Optional[str] = None):
+    hc = _sheet_handles()
+    with hc["lock"]:
+        if sheet_name:
+            hc["ws"].pop(sheet_name, None)
+        else:
+            hc["sh"] = None
+            hc["ws"] = {}
+
+def _is_stale_handle_error(e: Exception) -> bool:
+    # 400/404 o hoja inexistente: el handle apunta a algo que ya no existe (hoja renombrada/borrada)
+    if type(e).__name__ in ("WorksheetNotFound", "SpreadsheetNotFound"):
+        return True
+    code = getattr(getattr(e, "response", None), "status_code", None)
+    return code in (400, 404)
+
+# Métodos gspread que solo leen (cuota de lectura, se pueden reintentar y agrupar)
+SHEETS_READ_METHODS = {"open_by_key", "worksheets", "get_all_values", "get", "row_values", "values_batch_get"}
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+@st.cache_resource
+def _sheets_api_state() -> dict:
+    # Token buckets (lectura/escritura), lecturas en vuelo (single-flight) y contadores por método
+    now = time.monotonic()
+    return {
+        "lock": threading.Lock(),
+        "buckets": {
+            "read": {"rate": SHEETS_READS_PER_MIN / 60.0, "cap": max(1, SHEETS_READS_PER_MIN // 6), "tokens": max(1, SHEETS_READS_PER_MIN // 6), "ts": now},
+            "write": {"rate": SHEETS_WRITES_PER_MIN / 60.0, "cap": max(1, SHEETS_WRITES_PER_MIN // 6), "tokens": max(1, SHEETS_WRITES_PER_MIN // 6), "ts": now},
+        },
+        "inflight": {},
+        "stats": {},
+    }
+
+def _take_token(state: dict, kind: str) -> float:
+    """Bloquea hasta tener cupo en el bucket. Devuelve los segundos esperados."""
+    waited = 0.0
+    while True:
+        with state["lock"]:
+            b = state["buckets"][kind]
+            now = time.monotonic()
+            b["tokens"] = min(b["cap"], b["tokens"] + (now - b["ts"]) * b["rate"])
+            b["ts"] = now
+            if b["tokens"] >= 1:
+                b["tokens"] -= 1
+                return waited
+            wait = (1 - b["tokens"]) / b["rate"]
+        time.sleep(wait)
+        waited += wait
+
+def _api_status(e: Exception) -> Optional[int]:
+    return getattr(getattr(e, "response", None), "status_code", None)
+
+def _count_api_call(state: dict, method: str, ms: float, error: bool = False, retry: bool = False, waited: float = 0.0):
+    _perf_api_call(method, ms)
+    with state["lock"]:
+        st_ = state["stats"].setdefault(method, {"calls": 0, "errors": 0, "retries": 0, "total_ms": 0.0, "max_ms": 0.0, "throttled_ms": 0.0})
+        st_["calls"] += 1
+        st_["errors"] += int(error)
+        st_["retries"] += int(retry)
+        st_["total_ms"] += ms
+        st_["max_ms"] = max(st_["max_ms"], ms)
+        st_["throttled_ms"] += waited * 1000
+
+def _call_with_retry(state: dict, method: str, fn):
+    read = method in SHEETS_READ_METHODS
+    attempt = 0
+    while True:
+        waited = _take_token(state, "read" if read else "write")
+        t0 = time.perf_counter()
+        try:
+            out = fn()
+            _count_api_call(state, method, (time.perf_counter() - t0) * 1000, retry=attempt > 0, waited=waited)
+            return out
+        except Exception as e:
+            _count_api_call(state, method, (time.perf_counter() - t0) * 1000, error=True, retry=attempt > 0, waited=waited)
+            status = _api_status(e)
+            # Escrituras: solo 429 (rechazada antes de aplicarse). 5xx/timeout podría haberse aplicado.
+            retryable = status == 429 or (read and (status in RETRYABLE_STATUS or isinstance(e, OSError)))
+            if not retryable or attempt >= SHEETS_MAX_RETRIES:
+                raise
+            time.sleep(min(64.0, 2 ** attempt) * random.uniform(0.5, 1.5))
+            attempt += 1
+
+def _gapi(method: str, fn, key: Optional[str] = None):
+    """
+    Toda llamada a Google pasa por aquí: limita por cuota, reintenta 429/5xx con backoff+jitter
+    y, para lecturas con key, une llamadas idénticas concurrentes en una sola (single-flight).
+    """
+    state = _sheets_api_state()
+    if key is None or method not in SHEETS_READ_METHODS:
+        return _call_with_retry(state, method, fn)
+
+    with state["lock"]:
+        flight = state["inflight"].get(key)
+        leader = flight is None
+        if leader:
+            flight = {"done": threading.Event(), "result": None, "error": None}
+            state["inflight"][key] = flight
+    if not leader:
+        flight["done"].wait()
+        if flight["error"] is not None:
+            raise flight["error"]
+        return flight["result"]
+
+    try:
+        flight["result"] = _call_with_retry(state, method, fn)
+        return flight["result"]
+    except Exception as e:
+        flight["error"] = e
+        raise
+    finally:
+        with state["lock"]:
+            state["inflight"].pop(key, None)
+        flight["done"].set()
+
+def sheets_api_stats() -> Dict[str, dict]:
+    state = _sheets_api_state()
+    with state["lock"]:
+        return {m: dict(v) for m, v in state["stats"].items()}
+
+def _with_worksheet(sheet_name: str, method: str, *args, **kwargs):
+    """ws.<method>(...) con el handle cacheado; si el error indica handle vencido, lo descarta y reintenta 1 vez."""
+    key = f"{sheet_name}|{method}|{args!r}|{sorted(kwargs.items())!r}"
+    try:
+        ws = _worksheet(sheet_name)
+        return _gapi(method, lambda: getattr(ws, method)(*args, **kwargs), key=key)
+    except Exception as e:
+        if not _is_stale_handle_error(e):
+            raise
+        invalidate_sheet_handles()
+    ws = _worksheet(sheet_name)
+    return _gapi(method, lambda: getattr(ws, method)(*args, **kwargs), key=key)
+
+@st.cache_resource
+def _bootstrap_state() -> dict:
+    # Resultado de diagnóstico/esquema por proceso (no por rerun):
+    # {"diag"|"schema": (definitivo, valor, ts)}; busy: los que se están verificando ahora
+    return {"lock": threading.Lock(), "diag": None, "schema": None, "busy": set()}
+
+def reset_bootstrap():
+    bs = _bootstrap_state()
+    with bs["lock"]:
+        bs["diag"] = None
+        bs["schema"] = None
+    invalidate_sheet_handles()
+    invalidate_records()
+
+def _bootstrap_once(name: str, fn):
+    """
+    Valor por proceso de fn() -> (definitivo, valor). La llamada a Google va FUERA del lock
+    (con reintentos y backoff puede tardar un minuto): el lock solo publica el resultado.
+    Lo no definitivo (error de red) se recuerda BOOTSTRAP_RETRY_S. Mientras otra sesión
+    verifica se devuelve None en vez de esperarla.
+    """
+    bs = _bootstrap_state()
+    with bs["lock"]:
+        cached = bs[name]
+        if cached is not None and (cached[0] or time.time() - cached[2] < BOOTSTRAP_RETRY_S):
+            return cached[1]
+        if name in bs["busy"]:
+            return None
+        bs["busy"].add(name)
+    try:
+        final, value = fn()
+        with bs["lock"]:
+            bs[name] = (final, value, time.time())
+        return value
+    finally:
+        with bs["lock"]:
+            bs["busy"].discard(name)
+
+def _sqlite_sidebar():
+    st.sidebar.markdown("## 🔧 Diagnóstico almacenamiento")
+    st.sidebar.write("Backend:", f"SQLite local ({SQLITE_DB_PATH})")
+    try:
+        counts = storage().table_counts()
+    except Exception as e:
+        st.sidebar.error(f"Error abriendo la base local: {e}")
+        return
+    st.sidebar.success("Base local OK ✅ (sin conexión a Google)")
+    st.sidebar.write("Filas:", counts)
+
+    has_google = isinstance(st.secrets.get("gcp_service_account", None), dict) and bool((st.secrets.get("SHEET_ID", "") or "").strip())
+    if has_google and not counts.get("reports"):
+        if st.sidebar.button("⬇️ Importar datos desde Google Sheets"):
+            try:
+                st.sidebar.success(f"Importado: {import_sheets_into_sqlite()}")
+            except Exception as e:
+                st.sidebar.error(f"No se pudo importar: {e}")
+
+def debug_google():
+    if STORAGE_BACKEND == "sqlite":
+        _sqlite_sidebar()
+        return
+
+    st.sidebar.markdown("## 🔧 Diagnóstico Google")
+
+    has_sa = isinstance(st.secrets.get("gcp_service_account", None), dict)
+    has_sheet = bool((st.secrets.get("SHEET_ID", "") or "").strip())
+
+    st.sidebar.write("gcp_service_account:", "✅" if has_sa else "❌")
+    st.sidebar.write("SHEET_ID:", "✅" if has_sheet else "❌")
+
+    if st.sidebar.button("🔄 Re-verificar Google"):
+        reset_bootstrap()
+
+    gc, sheet_id, err = get_google_client()
+    if err:
+        st.sidebar.error(err)
+        st.sidebar.info("Revisa Secrets + compartir el Sheet con la service account.")
+        return
+
+    # Se consulta una vez por proceso; el botón de arriba fuerza otra verificación
+    def _diag():
+        try:
+            return True, (True, list(_refresh_worksheet_handles().keys()))
+        except Exception as e:
+            return False, (False, str(e))  # error transitorio: se reintenta pasado BOOTSTRAP_RETRY_S
+
+    diag = _bootstrap_once("diag", _diag)
+    if diag is None:
+        st.sidebar.info("Verificando conexión con Google…")
+        return
+    ok, info = diag
+    if ok:
+        st.sidebar.success("Conectado a Google Sheets ✅")
+        st.sidebar.write("Hojas:", info)
+        cs = records_cache_stats()
+        st.sidebar.caption(
+            f"Cache hojas: {cs['hits']} hits · {cs['misses']} misses · {cs['errors']} errores de lectura · "
+            f"sync {cs['tail_syncs']} incrementales / {cs['full_syncs']} completas · {cs['drift']} ediciones detectadas"
+        )
+        if SHARED_CACHE:
+            st.sidebar.caption(f"Cache compartido ({SHARED_CACHE}): {cs['shared_hits']} copias de otras réplicas · "
+                               f"{cs['shared_errors']} errores")
+            if cs["shared_last_error"]:
+                st.sidebar.warning(f"Cache compartido no disponible (se usa el local): {cs['shared_last_error']}")
+        with st.sidebar.expander("Llamadas a Google API"):
+            api = sheets_api_stats()
+            if api:
+                st.dataframe([
+                    {"método": m, "llamadas": v["calls"], "errores": v["errors"], "reintentos": v["retries"],
+                     "ms prom.": round(v["total_ms"] / max(1, v["calls"]), 1), "ms máx.": round(v["max_ms"], 1),
+                     "espera cuota ms": round(v["throttled_ms"])}
+                    for m, v in sorted(api.items())
+                ], use_container_width=True, hide_index=True)
+    else:
+        st.sidebar.error("Error accediendo al Sheet:")
+        st.sidebar.code(info)
+
+# ---------------------------
+# SHEETS: SCHEMA + HELPERS
+# ---------------------------
+USERS_HEADERS = ["username", "full_name", "role", "active", "salt", "pw_hash", "created_at", "pw_iter"]
+
+REPORTS_HEADERS = [
+    "report_id",
+    "equipment_tipo",
+    "equipment_codigo",
+    "equipment_nombre",
+    "horometro_inicial",
+    "operador_user",
+    "operador_nombre",
+    "created_at",
+    "created_date",
+    "resultado_final",
+    "estado_general",
+    "observaciones_generales",
+]
+
+# Ítems codificados contra la plantilla (ver PLANTILLAS DE CHECKLIST): sin repetir textos por fila
+REPORT_ITEMS_HEADERS = ["report_id", "template_version", "item_id", "estado_code", "observacion", "foto"]
+# Formato anterior con las etiquetas completas: mismas posiciones, se migra en su lugar
+LEGACY_REPORT_ITEMS_HEADERS = ["report_id", "seccion", "item", "estado", "observacion", "tiene_foto"]
+
+TEMPLATES_HEADERS = ["template_version", "tipo", "item_id", "seccion", "item", "orden"]
+
+def _open_sheet():
+    gc, sheet_id, err = get_google_client()
+    if err or not gc:
+        raise RuntimeError(err or "No hay cliente Google")
+    hc = _sheet_handles()
+    with hc["lock"]:
+        if hc["sh"] is not None and time.time() - hc["sh_ts"] <= SHEET_HANDLE_TTL:
+            return hc["sh"]
+    # Fuera del lock: la llamada puede esperar cuota o backoff y no debe frenar a quien ya tiene handles.
+    # Sesiones simultáneas se unen en una sola llamada (single-flight) y se publica el resultado.
+    sh = _gapi("open_by_key", lambda: gc.open_by_key(sheet_id), key=f"open_by_key|{sheet_id}")
+    with hc["lock"]:
+        if hc["sh"] is None or time.time() - hc["sh_ts"] > SHEET_HANDLE_TTL:
+            hc["sh"] = sh
+            hc["sh_ts"] = time.time()
+            hc["ws"] = {}
+        return hc["sh"]
+
+def _refresh_worksheet_handles() -> dict:
+    sh = _open_sheet()
+    hc = _sheet_handles()
+    wss = {w.title: w for w in _gapi("worksheets", sh.worksheets, key="worksheets")}
+    with hc["lock"]:
+        hc["ws"] = wss
+        hc["ws_ts"] = time.time()
+    return wss
+
+def _worksheet(sheet_name: str):
+    """
+    Worksheet cacheado por nombre. Si falta (o venció), UNA llamada a worksheets()
+    refresca los handles de todas las hojas a la vez.
+    """
+    hc = _sheet_handles()
+    _open_sheet()
+    with hc["lock"]:
+        ws = hc["ws"].get(sheet_name)
+        fresh = time.time() - hc["ws_ts"] <= SHEET_HANDLE_TTL
+    if ws is None or not fresh:
+        ws = _refresh_worksheet_handles().get(sheet_name)
+    if ws is None:
+        raise RuntimeError(f"No existe la hoja '{sheet_name}'")
+    return ws
+
+def ensure_sheet_exists(sheet_name: str, headers: list):
+    try:
+        sh = _open_sheet()
+        try:
+            ws = _worksheet(sheet_name)
+        except Exception:
+            ws = _gapi("add_worksheet", lambda: sh.add_worksheet(
+                title=sheet_name, rows="2000", cols=str(max(10, len(headers) + 5))))
+            _gapi("append_row", lambda: ws.append_row(headers, value_input_option="RAW"))
+            invalidate_sheet_handles(sheet_name)
+            invalidate_records(sheet_name)
+            return True, f"Hoja '{sheet_name}' creada."
+
+        first_row = _with_worksheet(sheet_name, "row_values", 1)
+        if [h.strip() for h in first_row] != headers:
+            return False, _headers_mismatch_msg(sheet_name, headers, first_row)
+        return True, f"Hoja '{sheet_name}' OK."
+    except Exception as e:
+        return False, f"Error creando/verificando hoja '{sheet_name}': {e}"
+
+SCHEMA_SHEETS = [
+    ("users", USERS_HEADERS),
+    ("reports", REPORTS_HEADERS),
+    ("templates", TEMPLATES_HEADERS),
+    ("report_items", REPORT_ITEMS_HEADERS),
+]
+
+def _headers_mismatch_msg(sheet_name: str, headers: list, first_row: list) -> str:
+    return (
+        f"⚠️ La hoja '{sheet_name}' existe pero los headers NO coinciden.\n"
+        f"Esperado: {headers}\n"
+        f"Actual:   {first_row}\n"
+        f"Solución: reemplaza la fila 1 por los headers esperados."
+    )
+
+def init_google_schema() -> List[Tuple[bool, str]]:
+    """
+    Verifica las hojas con 2 llamadas: worksheets() + values_batch_get de todas las filas 1.
+    Solo crea (ensure_sheet_exists) las que faltan.
+    """
+    existing = _refresh_worksheet_handles()
+    present = [(n, h) for n, h in SCHEMA_SHEETS if n in existing]
+    checks = [ensure_sheet_exists(n, h) for n, h in SCHEMA_SHEETS if n not in existing]
+
+    if present:
+        ranges = [f"'{n}'!1:1" for n, _ in present]
+        sh = _open_sheet()
+        resp = _gapi("values_batch_get", lambda: sh.values_batch_get(ranges), key=f"values_batch_get|{ranges!r}")
+        for (name, headers), vr in zip(present, resp.get("valueRanges", [])):
+            values = vr.get("values") or [[]]
+            first_row = [h.strip() for h in values[0]]
+            if first_row == headers:
+                checks.append((True, f"Hoja '{name}' OK."))
+            elif first_row and headers[:len(first_row)] == first_row:
+                checks.append(_add_missing_headers(name, headers, first_row))
+            elif name == "report_items" and first_row == LEGACY_REPORT_ITEMS_HEADERS:
+                checks.append((True, "Hoja 'report_items' con formato anterior: un supervisor puede migrarla a códigos "
+                                     "(Reportes → Migración de report_items)."))
+            else:
+                checks.append((False, _headers_mismatch_msg(name, headers, values[0])))
+    return checks
+
+def _add_missing_headers(sheet_name: str, headers: list, first_row: list) -> Tuple[bool, str]:
+    # Hoja con esquema anterior (le faltan columnas al final): se agregan los headers nuevos
+    missing = headers[len(first_row):]
+    try:
+        _with_worksheet(sheet_name, "update", values=[missing], range_name=f"{_col_letter(len(first_row) + 1)}1")
+    except Exception as e:
+        return False, f"Error agregando columnas {missing} a '{sheet_name}': {e}"
+    invalidate_records(sheet_name)
+    return True, f"Hoja '{sheet_name}' actualizada: columnas nuevas {missing}."
+
+def append_row_sheet(sheet_name: str, row: list):
+    storage().append_row(sheet_name, row)
+    _cache_append_rows(sheet_name, [row])
+    _shared("touch", sheet_name)
+
+def _cell(v) -> dict:
+    if isinstance(v, bool):
+        return {"userEnteredValue": {"boolValue": v}}
+    if isinstance(v, (int, float)):
+        return {"userEnteredValue": {"numberValue": v}}
+    return {"userEnteredValue": {"stringValue": "" if v is None else str(v)}}
+
+def append_rows_atomic(rows_by_sheet: Dict[str, List[list]]):
+    """Agrega filas a varias tablas de una vez (todo o nada) en el backend activo."""
+    storage().append_rows_atomic(rows_by_sheet)
+    for sheet_name, rows in rows_by_sheet.items():
+        if rows:
+            _cache_append_rows(sheet_name, rows)
+            _shared("touch", sheet_name)
+
+def _sheets_append_rows_atomic(rows_by_sheet: Dict[str, List[list]]):
+    """
+    Agrega filas a varias hojas en UNA sola llamada batchUpdate (appendCells).
+    La API aplica todos los requests o ninguno: no quedan reportes a medias.
+    """
+    requests = []
+    for sheet_name, rows in rows_by_sheet.items():
+        if not rows:
+            continue
+        requests.append({"appendCells": {
+            "sheetId": _worksheet(sheet_name).id,
+            "rows": [{"values": [_cell(v) for v in r]} for r in rows],
+            "fields": "userEnteredValue",
+        }})
+    if not requests:
+        return
+    try:
+        sh = _open_sheet()
+        _gapi("batch_update", lambda: sh.batch_update({"requests": requests}))
+    except Exception as e:
+        # sheetId vencido (hoja recreada): la próxima vez se vuelve a pedir metadata
+        if _is_stale_handle_error(e):
+            invalidate_sheet_handles()
+        raise
+
+@st.cache_resource
+def _records_cache() -> dict:
+    # Por proceso: {sheet_name: entry} en orden LRU (ver _new_cache_entry)
+    return {
+        "lock": threading.RLock(), "entries": OrderedDict(),
+        "hits": 0, "misses": 0, "errors": 0, "tail_syncs": 0, "full_syncs": 0, "drift": 0,
+        "shared_hits": 0, "shared_errors": 0, "shared_last_error": None,
+    }
+
+def _rows_to_records(header: list, rows: List[list]) -> List[dict]:
+    n = len(header)
+    return [dict(zip(header, r + [""] * (n - len(r)))) for r in rows]
+
+def _rows_only(sheet_name: str) -> bool:
+    # report_items y sus archivos: millones de filas; se guardan solo como listas (sin dict por fila)
+    return sheet_name == "report_items" or sheet_name.startswith("report_items_")
+
+def _new_cache_entry(header: list, rows: List[list], records: bool = True) -> dict:
+    # rows/records: filas confirmadas desde el Sheet (fila i -> fila i+2 del Sheet);
+    #   records es None en las hojas _rows_only (los dicts se arman solo cuando se piden)
+    # pending: filas escritas por este proceso que aún no se re-leyeron del Sheet
+    #   (pending_ts: cuándo se confirmó cada escritura, ver _settle_pending)
+    # shared: (gen, version) de la copia compartida con la que coincide (None: sin cache compartido)
+    now = time.time()
+    return {
+        "header": header, "rows": rows, "records": _rows_to_records(header, rows) if records else None,
+        "pending": [], "pending_records": [], "pending_ts": [], "ts": now, "full_ts": now, "shared": None,
+    }
+
+def _entry_cells(e: dict) -> int:
+    return len(e["header"]) * (len(e["rows"]) + len(e["pending"]) + 1)
+
+def _records_cache_evict(rc: dict):
+    # LRU solo entre hojas de archivo; la recién usada (última) se queda aunque pase el tope sola
+    total = sum(_entry_cells(e) for e in rc["entries"].values())
+    names = [n for n in list(rc["entries"])[:-1] if n not in RECORDS_CACHE_PINNED]
+    for name in names:
+        if total <= RECORDS_CACHE_MAX_CELLS:
+            break
+        total -= _entry_cells(rc["entries"].pop(name))
+        # los índices por hoja guardan la entrada: se sueltan con ella
+        for state in (_items_index_state(), _archive_rollup_state()):
+            with state["lock"]:
+                state["by_sheet"].pop(name, None)
+
+def _col_letter(n: int) -> str:
+    out = ""
+    while n > 0:
+        n, r = divmod(n - 1, 26)
+        out = chr(65 + r) + out
+    return out or "A"
+
+def _rows_digest(rows: List[list]) -> str:
+    h = hashlib.sha1()
+    for r in rows:
+        h.update("\x1f".join(str(v) for v in r).rstrip("\x1f").encode("utf-8"))
+        h.update(b"\x1e")
+    return h.hexdigest()
+
+def _fetch_sheet_values(sheet_name: str) -> Tuple[list, List[list]]:
+    values = _with_worksheet(sheet_name, "get_all_values")
+    if not values:
+        return [], []
+    header = [h.strip() for h in values[0]]
+    return header, values[1:]
+
+def _fetch_sheet_tail(sheet_name: str, header: list, synced: int) -> List[list]:
+    # Solo las filas nuevas después de las ya sincronizadas (fila 1 = headers)
+    rng = f"A{synced + 2}:{_col_letter(len(header))}"
+    return [list(r) for r in _with_worksheet(sheet_name, "get", rng)]
+
+def _fetch_sheet_range(sheet_name: str, header: list, start: int, count: int) -> List[list]:
+    # Filas de datos [start, start + count): rango acotado (fila 1 = headers)
+    rng = f"A{start + 2}:{_col_letter(len(header))}{start + 1 + count}"
+    return [list(r) for r in _with_worksheet(sheet_name, "get", rng)]
+
+def _is_incremental(sheet_name: str) -> bool:
+    # Hojas que solo crecen: las vivas y los archivos mensuales (que no cambian)
+    return sheet_name in INCREMENTAL_SYNC_SHEETS or bool(_ARCHIVE_SHEET_RE.match(sheet_name))
+
+def _trim_row(row: list) -> list:
+    # Sheets no devuelve celdas vacías al final de la fila
+    out = ["" if v is None else str(v) for v in row]
+    while out and out[-1] == "":
+        out.pop()
+    return out
+
+def _carry_pending(new: dict, old: Optional[dict]):
+    # Una entrada nueva (sync completa, copia compartida) hereda lo pendiente de la anterior
+    if old is None or old is new or not old["pending"]:
+        return
+    new["pending"] = list(old["pending"])
+    new["pending_records"] = _rows_to_records(new["header"], new["pending"])
+    new["pending_ts"] = list(old["pending_ts"])
+
+def _settle_pending(e: dict, read_ts: float, read_rows: List[list]):
+    """
+    Descarta de lo pendiente lo que ya trae una lectura del Sheet. Una fila sale si aparece en
+    read_rows o si su escritura se confirmó antes de que empezara la lectura (read_ts); una
+    escritura confirmada durante la lectura puede no venir en ella y se sigue mostrando.
+    """
+    if not e["pending"]:
+        return
+    want = {tuple(_trim_row(r)) for r in e["pending"]}
+    seen = Counter(k for k in (tuple(_trim_row(r)) for r in read_rows) if k in want)
+    keep = []
+    for row, rec, ts in zip(e["pending"], e["pending_records"], e["pending_ts"]):
+        k = tuple(_trim_row(row))
+        if seen[k]:
+            seen[k] -= 1
+        elif ts >= read_ts:
+            keep.append((row, rec, ts))
+    e["pending"] = [row for row, _, _ in keep]
+    e["pending_records"] = [rec for _, rec, _ in keep]
+    e["pending_ts"] = [ts for _, _, ts in keep]
+
+def _sync_entry(rc: dict, sheet_name: str, e: Optional[dict], m: Optional[dict] = None):
+    """
+    Refresca una entrada vencida. Para hojas incrementales solo se baja la cola;
+    cada FULL_SYNC_INTERVAL se baja todo y se compara checksum para detectar ediciones manuales.
+    m: meta del cache compartido leída ANTES de ir a Google (lo leído se publica con esa versión).
+    """
+    incremental = (
+        e is not None and _is_incremental(sheet_name) and e["header"]
+        and time.time() - e["full_ts"] < FULL_SYNC_INTERVAL
+    )
+    t_read = time.time()  # lo confirmado antes de este momento viene en la lectura
+    if incremental:
+        synced = len(e["rows"])
+        # Se relee la última fila ya sincronizada: si no coincide, se borraron/movieron filas
+        # (p.ej. archivo mensual desde otra réplica) y la cola por posición ya no sirve.
+        tail = storage().fetch_tail(sheet_name, e["header"], max(0, synced - 1))
+        if synced:
+            if not tail or _trim_row(tail[0]) != _trim_row(e["rows"][-1]):
+                incremental = False
+            tail = tail[1:]
+    if incremental:
+        with rc["lock"]:
+            if rc["entries"].get(sheet_name) is not e or len(e["rows"]) != synced:
+                return  # otra sesión ya sincronizó esta entrada
+            e["rows"].extend(tail)
+            if e["records"] is not None:
+                e["records"].extend(_rows_to_records(e["header"], tail))
+            _settle_pending(e, t_read, tail)
+            e["ts"] = time.time()
+            rc["tail_syncs"] += 1
+        _shared_publish(sheet_name, e, synced, m, t_read)
+        return
+
+    header, rows = storage().fetch_values(sheet_name)
+    keep = 0
+    with rc["lock"]:
+        if e is not None and _is_incremental(sheet_name):
+            local = e["rows"]
+            if header != e["header"] or _rows_digest(local) != _rows_digest(rows[:len(local)]):
+                rc["drift"] += 1
+            else:
+                keep = len(local)  # sin ediciones: a la copia compartida solo le faltan las filas nuevas
+        rc["full_syncs"] += 1
+        new = _new_cache_entry(header, rows, records=not _rows_only(sheet_name))
+        _carry_pending(new, rc["entries"].get(sheet_name))
+        _settle_pending(new, t_read, rows)
+        rc["entries"][sheet_name] = new
+        new["shared"] = e["shared"] if keep else None
+    _shared_publish(sheet_name, new, keep, m, t_read)
+
+def _fresh_entry(sheet_name: str) -> Tuple[Optional[dict], Optional[str]]:
+    """Entrada de cache vigente (sincroniza si venció). Devuelve (entry, error); entry puede ser la copia anterior."""
+    rc = _records_cache()
+    m = _shared("meta", sheet_name)  # None: sin cache compartido (o no disponible)
+    with rc["lock"]:
+        e = rc["entries"].get(sheet_name)
+        if e and time.time() - e["ts"] <= RECORDS_CACHE_TTL and (m is None or _shared_current(e, m)):
+            rc["hits"] += 1
+            rc["entries"].move_to_end(sheet_name)
+            return e, None
+        rc["misses"] += 1
+
+    try:
+        with perf_phase(f"hoja:{sheet_name}"):
+            fresh = False
+            if m is not None:
+                # otra réplica ya leyó esta versión: se usa su copia; si no, sirve de base para la cola
+                e, fresh = _adopt_shared(rc, sheet_name, e, m)
+            if not fresh:
+                _sync_entry(rc, sheet_name, e, m)
+    except Exception as ex:
+        with rc["lock"]:
+            rc["errors"] += 1
+            return rc["entries"].get(sheet_name), f"No se pudo leer la hoja '{sheet_name}': {ex}"
+
+    with rc["lock"]:
+        e = rc["entries"][sheet_name]
+        rc["entries"].move_to_end(sheet_name)
+        _records_cache_evict(rc)
+        return e, None
+
+def read_sheet(sheet_name: str) -> Tuple[List[dict], Optional[str]]:
+    """
+    Lectura con cache (TTL) por hoja. Devuelve (registros, error).
+    Si la lectura falla se devuelve el error aparte (y la copia anterior si existe),
+    para no confundir un error de cuota con una hoja vacía.
+    """
+    e, err = _fresh_entry(sheet_name)
+    if e is None:
+        return [], err
+    with _records_cache()["lock"]:
+        if e["records"] is None:
+            return _rows_to_records(e["header"], e["rows"]) + e["pending_records"], err
+        return e["records"] + e["pending_records"], err
+
+def sheet_records(sheet_name: str) -> list:
+    rows, _ = read_sheet(sheet_name)
+    return rows
+
+def _cache_append_rows(sheet_name: str, rows: List[list]):
+    # write-through: quien escribe ve su propia escritura sin volver a descargar la hoja
+    rc = _records_cache()
+    with rc["lock"]:
+        e = rc["entries"].get(sheet_name)
+        if not e:
+            return
+        new_rows = [["" if v is None else str(v) for v in r] for r in rows]
+        e["pending"].extend(new_rows)
+        e["pending_records"].extend(_rows_to_records(e["header"], new_rows))
+        e["pending_ts"].extend([time.time()] * len(new_rows))
+
+def invalidate_records(sheet_name: Optional[str] = None):
+    """Descarta la copia local y la compartida: la próxima lectura (en cualquier réplica) va al backend."""
+    rc = _records_cache()
+    with rc["lock"]:
+        if sheet_name:
+            rc["entries"].pop(sheet_name, None)
+        else:
+            rc["entries"].clear()
+    ic = _item_columns_state()
+    with ic["lock"]:
+        if sheet_name:
+            ic["by_sheet"].pop(sheet_name, None)
+        else:
+            ic["by_sheet"].clear()
+    _shared("reset", sheet_name)
+
+def records_cache_stats() -> dict:
+    rc = _records_cache()
+    with rc["lock"]:
+        return {
+            "hits": rc["hits"], "misses": rc["misses"], "errors": rc["errors"],
+            "tail_syncs": rc["tail_syncs"], "full_syncs": rc["full_syncs"], "drift": rc["drift"],
+            "shared_hits": rc["shared_hits"], "shared_errors": rc["shared_errors"],
+            "shared_last_error": rc["shared_last_error"],
+            "sheets": {n: len(e["rows"]) + len(e["pending"]) for n, e in rc["entries"].items()},
+        }
+
+def new_report_id() -> str:
+    """
+    ID único sin leer la hoja: fecha-hora (ordena cronológicamente) + 32 bits aleatorios.
+    No depende de un contador compartido, así que no choca entre sesiones ni réplicas.
+    Los IDs numéricos antiguos (1, 2, 3...) siguen siendo válidos.
+    """
+    return f"{datetime.now():%Y%m%d-%H%M%S}-{secrets.token_hex(4).upper()}"
+
+# ---------------------------
+# CACHE COMPARTIDO ENTRE RÉPLICAS (SQLite en un volumen compartido o Redis)
+# ---------------------------
+EMPTY_SHARED_META = {"version": 0, "gen": 0, "nrows": 0, "snap_version": -1, "ts": 0.0, "full_ts": 0.0, "header": []}
+
+class SharedCache(ABC):
+    """
+    Una copia de cada hoja para todas las réplicas, con sellos de versión:
+    - version: sube con cada escritura (touch) o invalidación (reset) hecha por cualquier réplica.
+    - gen: sube cuando se reemplaza la copia entera; las filas se guardan por gen y solo se agregan al final.
+    - snap_version: la version vigente cuando se LEYÓ de Google. Si es igual a version y la copia
+      está dentro del TTL, sirve tal cual: ninguna otra réplica vuelve a llamar a Google.
+    Una implementación incompleta falla al instanciarse (TypeError).
+    """
+    name = ""
+
+    @abstractmethod
+    def meta(self, sheet: str) -> dict:
+        ...
+
+    @abstractmethod
+    def load(self, sheet: str, gen: int, start: int) -> Optional[Tuple[dict, List[list]]]:
+        """(meta, filas[start:nrows]) leídas juntas; None si la copia cambió de gen."""
+
+    @abstractmethod
+    def publish(self, sheet: str, base: Optional[Tuple[int, int]], header: list, rows: List[list],
+                snap_version: int, ts: float, full_ts: float) -> Optional[int]:
+        """
+        base=(gen, n): agrega rows al final si la copia sigue en (gen, n); base=None: reemplaza todo (gen nueva).
+        Devuelve la gen publicada, o None si otra réplica publicó antes.
+        """
+
+    @abstractmethod
+    def touch(self, sheet: str):
+        ...
+
+    @abstractmethod
+    def reset(self, sheet: Optional[str] = None):
+        """Invalida la copia (todas las hojas si sheet es None): la próxima lectura va a Google."""
+
+class SQLiteSharedCache(SharedCache):
+    """Archivo SQLite (WAL) compartido por procesos/contenedores del mismo host. Entre máquinas, Redis."""
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._ready = False
+
+    def _conn(self) -> sqlite3.Connection:
+        if not self._ready:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        if not self._ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    sheet TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0,
+                    gen INTEGER NOT NULL DEFAULT 0,
+                    nrows INTEGER NOT NULL DEFAULT 0,
+                    snap_version INTEGER NOT NULL DEFAULT -1,
+                    ts REAL NOT NULL DEFAULT 0,
+                    full_ts REAL NOT NULL DEFAULT 0,
+                    header TEXT NOT NULL DEFAULT '[]'
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rows (
+                    sheet TEXT NOT NULL, gen INTEGER NOT NULL, idx INTEGER NOT NULL, data TEXT NOT NULL,
+                    PRIMARY KEY (sheet, gen, idx)
+                ) WITHOUT ROWID
+            """)
+            self._ready = True
+        return conn
+
+    def _meta(self, conn: sqlite3.Connection, sheet: str) -> dict:
+        r = conn.execute(
+            "SELECT version, gen, nrows, snap_version, ts, full_ts, header FROM meta WHERE sheet = ?", (sheet,)
+        ).fetchone()
+        if not r:
+            return dict(EMPTY_SHARED_META)
+        return {"version": r[0], "gen": r[1], "nrows": r[2], "snap_version": r[3], "ts": r[4], "full_ts": r[5],
+                "header": json.loads(r[6])}
+
+    def meta(self, sheet):
+        conn = self._conn()
+        try:
+            return self._meta(conn, sheet)
+        finally:
+            conn.close()
+
+    def load(self, sheet, gen, start):
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN")
+            m = self._meta(conn, sheet)
+            if m["gen"] != gen:
+                return None
+            rows = [json.loads(d) for (d,) in conn.execute(
+                "SELECT data FROM rows WHERE sheet = ? AND gen = ? AND idx >= ? AND idx < ? ORDER BY idx",
+                (sheet, gen, start, m["nrows"]),
+            )]
+            return m, rows
+        finally:
+            conn.close()  # solo lectura: cerrar descarta la transacción
+
+    def publish(self, sheet, base, header, rows, snap_version, ts, full_ts):
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                m = self._meta(conn, sheet)
+                if base is not None:
+                    if (m["gen"], m["nrows"]) != tuple(base):
+                        conn.execute("ROLLBACK")
+                        return None
+                    gen, start, snap_version = base[0], base[1], max(m["snap_version"], snap_version)
+                else:
+                    gen, start = m["gen"] + 1, 0
+                    conn.execute("DELETE FROM rows WHERE sheet = ?", (sheet,))
+                conn.executemany(
+                    "INSERT INTO rows (sheet, gen, idx, data) VALUES (?, ?, ?, ?)",
+                    ((sheet, gen, start + i, json.dumps(r, ensure_ascii=False)) for i, r in enumerate(rows)),
+                )
+                conn.execute(
+                    "INSERT INTO meta (sheet, version, gen, nrows, snap_version, ts, full_ts, header) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(sheet) DO UPDATE SET gen = excluded.gen, "
+                    "nrows = excluded.nrows, snap_version = excluded.snap_version, ts = excluded.ts, "
+                    "full_ts = excluded.full_ts, header = excluded.header",
+                    (sheet, m["version"], gen, start + len(rows), snap_version, ts, full_ts,
+                     json.dumps(header, ensure_ascii=False)),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return gen
+        finally:
+            conn.close()
+
+    def touch(self, sheet):
+        conn = self._conn()
+        try:
+            conn.execute(
+                "INSERT INTO meta (sheet, version) VALUES (?, 1) ON CONFLICT(sheet) DO UPDATE SET version = version + 1",
+                (sheet,),
+            )
+        finally:
+            conn.close()
+
+    def reset(self, sheet=None):
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                sheets = [sheet] if sheet else [r[0] for r in conn.execute("SELECT sheet FROM meta")]
+                for s in sheets:
+                    conn.execute(
+                        "INSERT INTO meta (sheet, version, gen) VALUES (?, 1, 1) ON CONFLICT(sheet) DO UPDATE SET "
+                        "version = version + 1, gen = gen + 1, nrows = 0, header = '[]'",
+                        (s,),
+                    )
+                    conn.execute("DELETE FROM rows WHERE sheet = ?", (s,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+class RedisSharedCache(SharedCache):
+    """Redis (o compatible): meta en un hash por hoja y filas en una lista por gen."""
+    name = "redis"
+    PUSH_BATCH = 5000
+    RESET_RETRIES = 10  # reintentos de reset si otra réplica cambia la meta en medio (WATCH)
+
+    def __init__(self, url: str, prefix: str):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("SHARED_CACHE='redis' necesita el paquete 'redis' (pip install redis).") from e
+        self.r = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._watch_error = redis.WatchError
+
+    def _key(self, sheet: str, part: str) -> str:
+        return f"{self.prefix}:{sheet}:{part}"
+
+    def _parse(self, h: dict) -> dict:
+        if not h:
+            return dict(EMPTY_SHARED_META)
+        h = {k.decode() if isinstance(k, bytes) else k: v for k, v in h.items()}
+        m = dict(EMPTY_SHARED_META)
+        for k in ("version", "gen", "nrows", "snap_version"):
+            m[k] = int(h.get(k, m[k]))
+        for k in ("ts", "full_ts"):
+            m[k] = float(h.get(k, m[k]))
+        m["header"] = json.loads(h.get("header", "[]"))
+        return m
+
+    def meta(self, sheet):
+        return self._parse(self.r.hgetall(self._key(sheet, "meta")))
+
+    def load(self, sheet, gen, start):
+        with self.r.pipeline(transaction=True) as p:
+            p.hgetall(self._key(sheet, "meta"))
+            p.lrange(self._key(sheet, f"rows:{gen}"), start, -1)
+            h, data = p.execute()
+        m = self._parse(h)
+        if m["gen"] != gen:
+            return None
+        return m, [json.loads(d) for d in data[:max(0, m["nrows"] - start)]]
+
+    def publish(self, sheet, base, header, rows, snap_version, ts, full_ts):
+        key = self._key(sheet, "meta")
+        with self.r.pipeline() as p:
+            try:
+                p.watch(key)
+                m = self._parse(p.hgetall(key))
+                if base is not None:
+                    if (m["gen"], m["nrows"]) != tuple(base):
+                        return None
+                    gen, start, snap_version = base[0], base[1], max(m["snap_version"], snap_version)
+                else:
+                    gen, start = m["gen"] + 1, 0
+                p.multi()
+                if base is None:
+                    p.delete(self._key(sheet, f"rows:{m['gen']}"))
+                for i in range(0, len(rows), self.PUSH_BATCH):
+                    p.rpush(self._key(sheet, f"rows:{gen}"),
+                            *[json.dumps(r, ensure_ascii=False) for r in rows[i:i + self.PUSH_BATCH]])
+                p.hset(key, mapping={"gen": gen, "nrows": start + len(rows), "snap_version": snap_version,
+                                     "ts": ts, "full_ts": full_ts, "header": json.dumps(header, ensure_ascii=False)})
+                p.sadd(f"{self.prefix}:sheets", sheet)
+                p.execute()
+                return gen
+            except self._watch_error:
+                return None
+
+    def touch(self, sheet):
+        with self.r.pipeline(transaction=True) as p:
+            p.hincrby(self._key(sheet, "meta"), "version", 1)
+            p.sadd(f"{self.prefix}:sheets", sheet)
+            p.execute()
+
+    def reset(self, sheet=None):
+        sheets = [sheet] if sheet else [s.decode() if isinstance(s, bytes) else s
+                                        for s in self.r.smembers(f"{self.prefix}:sheets")]
+        for s in sheets:
+            key = self._key(s, "meta")
+            with self.r.pipeline() as p:
+                for attempt in range(self.RESET_RETRIES):
+                    try:
+                        p.watch(key)
+                        m = self._parse(p.hgetall(key))
+                        p.multi()
+                        p.hincrby(key, "version", 1)
+                        p.hset(key, mapping={"gen": m["gen"] + 1, "nrows": 0, "header": "[]"})
+                        p.delete(self._key(s, f"rows:{m['gen']}"))
+                        p.sadd(f"{self.prefix}:sheets", s)
+                        p.execute()
+                        break
+                    except self._watch_error:
+                        time.sleep(min(0.5, 0.01 * 2 ** attempt) * random.uniform(0.5, 1.5))
+                else:
+                    raise RuntimeError(f"No se pudo invalidar '{s}' en Redis: la meta cambió en cada intento.")
+
+@st.cache_resource
+def shared_cache() -> Optional[SharedCache]:
+    if not SHARED_CACHE:
+        return None
+    if SHARED_CACHE == "sqlite":
+        return SQLiteSharedCache(SHARED_CACHE_PATH)
+    if SHARED_CACHE == "redis":
+        return RedisSharedCache(SHARED_CACHE_URL, SHARED_CACHE_PREFIX)
+    raise ValueError(f"SHARED_CACHE desconocido: {SHARED_CACHE!r} (usa '', 'sqlite' o 'redis')")
+
+def _shared(method: str, *args):
+    """Llama al cache compartido. Sin cache compartido (o si falla) devuelve None: se sigue con el cache local."""
+    if not SHARED_CACHE:
+        return None
+    try:
+        return getattr(shared_cache(), method)(*args)
+    except Exception as e:
+        rc = _records_cache()
+        with rc["lock"]:
+            rc["shared_errors"] += 1
+            rc["shared_last_error"] = str(e)
+        return None
+
+def _shared_current(e: dict, m: dict) -> bool:
+    # misma versión y la copia compartida no tiene filas que esta réplica aún no vio
+    return e["shared"] == (m["gen"], m["version"]) and len(e["rows"]) >= m["nrows"]
+
+def _adopt_shared(rc: dict, sheet_name: str, e: Optional[dict], m: dict) -> Tuple[Optional[dict], bool]:
+    """
+    Trae a este proceso la copia compartida. Devuelve (entry, vigente): vigente = es de la última
+    versión y está dentro del TTL (sin Google). Si no, entry es la base para sincronizar solo la cola
+    (None: sync completa).
+    """
+    same_gen = e is not None and e["shared"] is not None and e["shared"][0] == m["gen"]
+    base = e if same_gen else None
+    if not m["gen"] or not m["header"]:
+        return base, False
+    start = len(e["rows"]) if same_gen else 0
+    if same_gen and start >= m["nrows"]:
+        fresh = m["snap_version"] == m["version"] and time.time() - m["ts"] <= RECORDS_CACHE_TTL
+        if not fresh or start > m["nrows"]:
+            return base, False
+        rows = []
+    else:
+        got = _shared("load", sheet_name, m["gen"], start)
+        if got is None:
+            return base, False
+        m, rows = got
+        fresh = m["snap_version"] == m["version"] and time.time() - m["ts"] <= RECORDS_CACHE_TTL
+    with rc["lock"]:
+        if same_gen:
+            if rc["entries"].get(sheet_name) is not e or len(e["rows"]) != start:
+                return base, False  # otra sesión ya la actualizó
+            e["rows"].extend(rows)
+            if e["records"] is not None:
+                e["records"].extend(_rows_to_records(e["header"], rows))
+        else:
+            new = _new_cache_entry(m["header"], rows, records=not _rows_only(sheet_name))
+            _carry_pending(new, rc["entries"].get(sheet_name))
+            e = rc["entries"][sheet_name] = new
+        e["full_ts"] = m["full_ts"]
+        e["shared"] = (m["gen"], m["snap_version"])
+        # m["ts"]: cuándo empezó la lectura que publicó la otra réplica
+        _settle_pending(e, m["ts"] if fresh else 0.0, rows)
+        if fresh:
+            e["ts"] = m["ts"]
+            rc["shared_hits"] += 1
+        else:
+            e["ts"] = 0.0  # base vencida: se sincroniza la cola enseguida
+    return e, fresh
+
+def _shared_publish(sheet_name: str, e: dict, start: int, m: Optional[dict], read_ts: float):
+    # Publica lo recién leído de Google para las demás réplicas (start > 0: solo las filas nuevas).
+    # read_ts (inicio de la lectura) es la antigüedad de la copia: lo confirmado antes viene incluido.
+    if m is None:
+        return
+    rc = _records_cache()
+    with rc["lock"]:
+        base = (e["shared"][0], start) if start and e["shared"] else None
+        header, rows, full_ts = list(e["header"]), e["rows"][start if base else 0:], e["full_ts"]
+    gen = _shared("publish", sheet_name, base, header, rows, m["version"], read_ts, full_ts)
+    with rc["lock"]:
+        e["shared"] = (gen, m["version"]) if gen else None
+
+# ---------------------------
+# ALMACENAMIENTO: Google Sheets o SQLite local
+# ---------------------------
+class StorageBackend(ABC):
+    """
+    Tablas users / reports / report_items como header + filas en orden de inserción
+    (fila i <-> fila i+2 de la hoja). El cache de registros y los índices se arman encima.
+    Si supports_queries, query_reports/report_items_for filtran en el backend.
+    Un backend incompleto falla al instanciarse (TypeError), no a mitad de un request.
+    """
+    name = ""
+    supports_queries = False
+
+    @abstractmethod
+    def check_schema(self) -> List[Tuple[bool, str]]:
+        ...
+
+    @abstractmethod
+    def fetch_values(self, table: str) -> Tuple[list, List[list]]:
+        ...
+
+    @abstractmethod
+    def fetch_tail(self, table: str, header: list, synced: int) -> List[list]:
+        ...
+
+    @abstractmethod
+    def fetch_header(self, table: str) -> list:
+        ...
+
+    @abstractmethod
+    def fetch_range(self, table: str, header: list, start: int, count: int) -> List[list]:
+        """Filas [start, start + count) sin traer la tabla entera (hojas grandes por bloques)."""
+
+    def append_row(self, table: str, row: list):
+        self.append_rows_atomic({table: [row]})
+
+    @abstractmethod
+    def append_rows_atomic(self, rows_by_table: Dict[str, List[list]]):
+        ...
+
+    @abstractmethod
+    def update_user_fields(self, found: dict, fields: dict) -> bool:
+        """
+        Actualiza columnas de un usuario encontrado con find_user ({"row", "user"}).
+        Devuelve False (sin escribir) si el usuario ya no está donde decía el índice.
+        """
+
+class SheetsStorage(StorageBackend):
+    name = "sheets"
+
+    def check_schema(self):
+        return init_google_schema()
+
+    def fetch_values(self, table):
+        return _fetch_sheet_values(table)
+
+    def fetch_tail(self, table, header, synced):
+        return _fetch_sheet_tail(table, header, synced)
+
+    def fetch_header(self, table):
+        return [h.strip() for h in _with_worksheet(table, "row_values", 1)]
+
+    def fetch_range(self, table, header, start, count):
+        return _fetch_sheet_range(table, header, start, count)
+
+    def append_row(self, table, row):
+        _with_worksheet(table, "append_row", row, value_input_option="USER_ENTERED")
+
+    def append_rows_atomic(self, rows_by_table):
+        _sheets_append_rows_atomic(rows_by_table)
+
+    def update_user_fields(self, found, fields):
+        # La fila sale de un índice cacheado (hasta RECORDS_CACHE_TTL): si se borraron u ordenaron
+        # filas a mano puede ser de otro usuario. Se relee la celda username antes de escribir.
+        row_n = found["row"]
+        cell = _with_worksheet("users", "get", f"{_col_letter(USERS_HEADERS.index('username') + 1)}{row_n}")
+        if _col(cell[0] if cell else [], 0).strip() != str(found["user"].get("username", "")).strip():
+            return False
+        _with_worksheet("users", "batch_update", [
+            {"range": f"{_col_letter(USERS_HEADERS.index(c) + 1)}{row_n}", "values": [[v]]}
+            for c, v in fields.items()
+        ])
+        return True
+
+def _sql_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+class SQLiteStorage(StorageBackend):
+    """Todo en un archivo local: sin red, consultas filtradas con índices."""
+    name = "sqlite"
+    supports_queries = True
+    INDEXES = {
+        "users": ["username"],
+        "reports": ["report_id", "created_date", "equipment_codigo"],
+        "report_items": ["report_id"],
+        "templates": ["item_id"],
+    }
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _conn(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.create_function("lower_u", 1, lambda v: str(v or "").lower(), deterministic=True)
+        return conn
+
+    def _columns(self, conn: sqlite3.Connection, table: str) -> List[str]:
+        return [r[1] for r in conn.execute(f"PRAGMA table_info({_sql_ident(table)})")]
+
+    def check_schema(self):
+        checks = []
+        conn = self._conn()
+        try:
+            for name, headers in SCHEMA_SHEETS:
+                cols = self._columns(conn, name)
+                if not cols:
+                    col_defs = ", ".join(f"{_sql_ident(h)} TEXT NOT NULL DEFAULT ''" for h in headers)
+                    conn.execute(f"CREATE TABLE {_sql_ident(name)} ({col_defs})")
+                    checks.append((True, f"Tabla '{name}' creada."))
+                elif cols == headers:
+                    checks.append((True, f"Tabla '{name}' OK."))
+                elif headers[:len(cols)] == cols:
+                    for h in headers[len(cols):]:
+                        conn.execute(f"ALTER TABLE {_sql_ident(name)} ADD COLUMN {_sql_ident(h)} TEXT NOT NULL DEFAULT ''")
+                    checks.append((True, f"Tabla '{name}' actualizada: columnas nuevas {headers[len(cols):]}."))
+                elif name == "report_items" and cols == LEGACY_REPORT_ITEMS_HEADERS:
+                    n = self._migrate_legacy_items(conn)
+                    checks.append((True, f"Tabla 'report_items' migrada a códigos de plantilla ({n} filas)."))
+                else:
+                    checks.append((False, _headers_mismatch_msg(name, headers, cols)))
+                    continue
+                for col in self.INDEXES.get(name, []):
+                    conn.execute(f"CREATE INDEX IF NOT EXISTS {_sql_ident(f'ix_{name}_{col}')} ON {_sql_ident(name)} ({_sql_ident(col)})")
+        finally:
+            conn.close()
+        return checks
+
+    def _migrate_legacy_items(self, conn: sqlite3.Connection) -> int:
+        # Local y rápido: renombra columnas y codifica todas las filas en una transacción
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for old, new in zip(LEGACY_REPORT_ITEMS_HEADERS, REPORT_ITEMS_HEADERS):
+                if old != new:
+                    conn.execute(f"ALTER TABLE report_items RENAME COLUMN {_sql_ident(old)} TO {_sql_ident(new)}")
+            tipo_of = dict(conn.execute("SELECT report_id, equipment_tipo FROM reports"))
+            rows = conn.execute(
+                f"SELECT rowid, {', '.join(_sql_ident(h) for h in REPORT_ITEMS_HEADERS)} FROM report_items"
+            ).fetchall()
+            encoded, new_templates = encode_legacy_item_rows([list(r[1:]) for r in rows], tipo_of)
+            conn.executemany(
+                "UPDATE report_items SET template_version = ?, item_id = ?, estado_code = ?, foto = ? WHERE rowid = ?",
+                [(e[1], e[2], e[3], e[5], r[0]) for r, e in zip(rows, encoded)],
+            )
+            conn.executemany(
+                f"INSERT INTO templates ({', '.join(_sql_ident(h) for h in TEMPLATES_HEADERS)}) "
+                f"VALUES ({', '.join('?' * len(TEMPLATES_HEADERS))})",
+                [[str(v) for v in t] for t in new_templates],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        learn_templates(new_templates)
+        return len(rows)
+
+    def fetch_values(self, table):
+        conn = self._conn()
+        try:
+            header = self._columns(conn, table)
+            if not header:
+                return [], []
+            return header, [list(r) for r in conn.execute(f"SELECT * FROM {_sql_ident(table)} ORDER BY rowid")]
+        finally:
+            conn.close()
+
+    def fetch_tail(self, table, header, synced):
+        conn = self._conn()
+        try:
+            cols = ", ".join(_sql_ident(h) for h in header)
+            return [list(r) for r in conn.execute(f"SELECT {cols} FROM {_sql_ident(table)} ORDER BY rowid LIMIT -1 OFFSET ?", (synced,))]
+        finally:
+            conn.close()
+
+    def fetch_header(self, table):
+        conn = self._conn()
+        try:
+            return self._columns(conn, table)
+        finally:
+            conn.close()
+
+    def fetch_range(self, table, header, start, count):
+        conn = self._conn()
+        try:
+            cols = ", ".join(_sql_ident(h) for h in header)
+            return [list(r) for r in conn.execute(f"SELECT {cols} FROM {_sql_ident(table)} ORDER BY rowid LIMIT ? OFFSET ?", (count, start))]
+        finally:
+            conn.close()
+
+    def append_rows_atomic(self, rows_by_table):
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for table, rows in rows_by_table.items():
+                    if not rows:
+                        continue
+                    header = self._columns(conn, table)
+                    conn.executemany(
+                        f"INSERT INTO {_sql_ident(table)} ({', '.join(_sql_ident(h) for h in header)}) "
+                        f"VALUES ({', '.join('?' * len(header))})",
+                        [[("" if v is None else str(v)) for v in (list(r) + [""] * len(header))[:len(header)]] for r in rows],
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+    def update_user_fields(self, found, fields):
+        conn = self._conn()
+        try:
+            cur = conn.execute(
+                f"UPDATE users SET {', '.join(f'{_sql_ident(c)} = ?' for c in fields)} "
+                "WHERE rowid = (SELECT MIN(rowid) FROM users WHERE username = ?)",
+                [str(v) for v in fields.values()] + [str(found["user"].get("username", ""))],
+            )
+            return cur.rowcount > 0
+        finally:
+            conn.close()
+
+    def query_reports(self, equipo, operador, resultados, d0, d1, cols, first, page_size) -> Tuple[List[dict], int]:
+        where, args = [], []
+        if equipo:
+            where.append("equipment_codigo = ?")
+            args.append(equipo)
+        if resultados:
+            where.append(f"resultado_final IN ({', '.join('?' * len(resultados))})")
+            args.extend(resultados)
+        if operador:
+            where.append("(instr(lower_u(operador_nombre), ?) > 0 OR lower_u(operador_user) = ?)")
+            args.extend([operador, operador])
+        if d0:
+            where.append("created_date >= ?")
+            args.append(d0)
+        if d1:
+            where.append("created_date <= ?")
+            args.append(d1 + "\uffff")  # incluye 'YYYY-MM-DDThh...' del mismo día
+        sql_where = f" WHERE {' AND '.join(where)}" if where else ""
+        conn = self._conn()
+        try:
+            known = set(self._columns(conn, "reports"))
+            sel = ", ".join(_sql_ident(c) if c in known else "''" for c in cols)
+            total = conn.execute(f"SELECT COUNT(*) FROM reports{sql_where}", args).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT {sel} FROM reports{sql_where} ORDER BY rowid DESC LIMIT ? OFFSET ?", args + [page_size, first]
+            ).fetchall()
+        finally:
+            conn.close()
+        return [dict(zip(cols, r)) for r in rows], total
+
+    def report_items(self, report_id: str) -> List[dict]:
+        conn = self._conn()
+        try:
+            cur = conn.execute("SELECT * FROM report_items WHERE report_id = ? ORDER BY rowid", (report_id,))
+            return [decode_item_row(list(r)) for r in cur.fetchall()]
+        finally:
+            conn.close()
+
+    def table_counts(self) -> Dict[str, int]:
+        conn = self._conn()
+        try:
+            return {n: conn.execute(f"SELECT COUNT(*) FROM {_sql_ident(n)}").fetchone()[0]
+                    for n, _ in SCHEMA_SHEETS if self._columns(conn, n)}
+        finally:
+            conn.close()
+
+@st.cache_resource
+def storage() -> StorageBackend:
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(SQLITE_DB_PATH)
+    if STORAGE_BACKEND != "sheets":
+        raise ValueError(f"STORAGE_BACKEND desconocido: {STORAGE_BACKEND!r} (usa 'sheets' o 'sqlite')")
+    return SheetsStorage()
+
+def import_sheets_into_sqlite() -> Dict[str, int]:
+    """
+    Copia inicial Google Sheets -> SQLite local. Solo con reports vacío (no duplica reportes);
+    los usuarios que ya existen localmente (p.ej. el admin sembrado) se conservan.
+    """
+    local = storage()
+    if not isinstance(local, SQLiteStorage):
+        raise RuntimeError("El backend activo no es SQLite.")
+    counts = local.table_counts()
+    if counts.get("reports") or counts.get("report_items"):
+        raise RuntimeError("La base local ya tiene reportes; la importación es solo para una base nueva.")
+    _, local_users = local.fetch_values("users")
+    known_users = {r[0] for r in local_users}
+    _, local_templates = local.fetch_values("templates")
+    known_templates = {(r[0], r[2]) for r in local_templates}
+    remote = SheetsStorage()
+    rows_by_table = {}
+    tipo_of: Dict[str, str] = {}
+    for name, headers in SCHEMA_SHEETS:
+        try:
+            header, rows = remote.fetch_values(name)
+        except RuntimeError:
+            if name != "templates":
+                raise
+            header, rows = [], []  # Sheets aún sin plantillas guardadas (formato anterior)
+        if name == "report_items":
+            # mismas posiciones en ambos formatos: las filas con etiquetas se codifican al importar
+            out, new_templates = encode_legacy_item_rows([_trim_row(r) for r in rows], tipo_of)
+            rows_by_table[name] = out
+            rows_by_table["templates"].extend(new_templates)
+            continue
+        out = []
+        for r in rows:
+            rec = dict(zip(header, r))
+            if name == "users" and rec.get("username") in known_users:
+                continue
+            if name == "templates" and (rec.get("template_version"), rec.get("item_id")) in known_templates:
+                continue
+            if "created_date" in rec:
+                rec["created_date"] = norm_date(rec["created_date"]) or rec["created_date"]
+            if name == "reports":
+                tipo_of[str(rec.get("report_id", ""))] = str(rec.get("equipment_tipo", ""))
+            out.append([rec.get(h, "") for h in headers])
+        rows_by_table[name] = out
+    local.append_rows_atomic(rows_by_table)
+    learn_templates(rows_by_table["templates"])
+    invalidate_records()
+    return {n: len(r) for n, r in rows_by_table.items()}
+
+# ---------------------------
+# LEASES ENTRE RÉPLICAS (hoja leases)
+# ---------------------------
+# Tareas que mueven o reescriben filas de reports/report_items corren en UNA réplica a la vez.
+# Sheets no tiene compare-and-swap: el candidato agrega su reserva y relee la hoja; gana la reserva
+# vigente más antigua. Cada intento deja dos filas (reserva + liberación). expires_at usa el reloj
+# de cada réplica: LEASE_TTL debe ser mucho mayor que el desfase entre servidores.
+LEASES_HEADERS = ["name", "owner", "expires_at"]
+LEASE_TTL = int(st.secrets.get("LEASE_TTL", 1800))
+MAINTENANCE_LEASE = "mantenimiento"  # archivo mensual y migración de report_items
+
+def _lease_holder(rows: List[list], name: str, now: float) -> Optional[str]:
+    # owner vigente cuya primera fila es la más antigua (la última fila de cada owner manda en expires_at)
+    first: Dict[str, int] = {}
+    expires: Dict[str, float] = {}
+    for i, r in enumerate(rows):
+        owner = _col(r, 1)
+        if _col(r, 0) != name or not owner:
+            continue
+        first.setdefault(owner, i)
+        try:
+            expires[owner] = float(_col(r, 2) or 0)
+        except ValueError:
+            expires[owner] = 0.0
+    live = [o for o in first if expires[o] > now]
+    return min(live, key=first.get) if live else None
+
+def acquire_lease(name: str, ttl: int = LEASE_TTL) -> Optional[dict]:
+    """Reserva `name` para esta réplica por ttl segundos. Devuelve el lease, o None si lo tiene otra."""
+    ok, msg = ensure_sheet_exists("leases", LEASES_HEADERS)
+    if not ok:
+        raise RuntimeError(msg)
+    lease = {"name": name, "owner": f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}",
+             "expires_at": time.time() + ttl}
+    _with_worksheet("leases", "append_row", [name, lease["owner"], f"{lease['expires_at']:.3f}"],
+                    value_input_option="RAW")
+    _, rows = _fetch_sheet_values("leases")
+    if _lease_holder(rows, name, time.time()) == lease["owner"]:
+        return lease
+    release_lease(lease)  # perdió: su reserva no debe ganar cuando venza la del otro
+    return None
+
+def release_lease(lease: dict):
+    try:
+        _with_worksheet("leases", "append_row", [lease["name"], lease["owner"], "0"], value_input_option="RAW")
+    except Exception:
+        pass  # vence sola en LEASE_TTL
+
+def check_lease(lease: dict, margin: float = 60.0):
+    """Antes de cada paso destructivo: el lease debe seguir vigente (con margen)."""
+    if time.time() > lease["expires_at"] - margin:
+        raise RuntimeError(f"El lease '{lease['name']}' venció durante la tarea; se reintenta en la próxima pasada.")
+
+@contextmanager
+def maintenance_lease():
+    """with maintenance_lease() as lease: ... ; RuntimeError si otra réplica tiene el mantenimiento."""
+    lease = acquire_lease(MAINTENANCE_LEASE)
+    if lease is None:
+        raise RuntimeError("Otra réplica está archivando o migrando reports/report_items; se reintenta más tarde.")
+    try:
+        yield lease
+    finally:
+        release_lease(lease)
+
+# ---------------------------
+# ARCHIVO MENSUAL (reports_YYYY_MM / report_items_YYYY_MM)
+# ---------------------------
+_ARCHIVE_SHEET_RE = re.compile(r"^(reports|report_items)_(\d{4})_(\d{2})$")
+
+def _archive_name(base: str, month: str) -> str:
+    return f"{base}_{month.replace('-', '_')}"
+
+def archive_months() -> List[str]:
+    """Meses ('YYYY-MM') con hoja de archivo, desde los handles cacheados (sin llamadas extra)."""
+    if storage().name != "sheets":
+        return []
+    hc = _sheet_handles()
+    try:
+        _open_sheet()
+        with hc["lock"]:
+            titles = list(hc["ws"])
+            fresh = time.time() - hc["ws_ts"] <= SHEET_HANDLE_TTL
+        if not titles or not fresh:
+            titles = list(_refresh_worksheet_handles())
+    except Exception:
+        return []
+    months = set()
+    for t in titles:
+        m = _ARCHIVE_SHEET_RE.match(t)
+        if m and m.group(1) == "reports":
+            months.add(f"{m.group(2)}-{m.group(3)}")
+    return sorted(months)
+
+def archive_months_in_range(start: Optional[date], end: Optional[date]) -> List[str]:
+    """Meses archivados que tocan [start, end], más nuevos primero. Sin rango: ninguno (solo la ventana viva)."""
+    if not start and not end:
+        return []
+    m0 = start.isoformat()[:7] if start else ""
+    m1 = end.isoformat()[:7] if end else "9999-12"
+    return [m for m in reversed(archive_months()) if m0 <= m <= m1]
+
+def archive_cutoff(today: Optional[date] = None) -> str:
+    """Primer día ('YYYY-MM-DD') de la ventana viva de ARCHIVE_KEEP_MONTHS meses."""
+    today = today or date.today()
+    y, m = divmod(today.year * 12 + today.month - 1 - (ARCHIVE_KEEP_MONTHS - 1), 12)
+    return f"{y:04d}-{m + 1:02d}-01"
+
+@st.cache_resource
+def _archive_lock() -> threading.Lock:
+    return threading.Lock()
+
+def _row_runs(indexes: List[int]) -> List[Tuple[int, int]]:
+    # [3,4,5,9] -> [(3,6),(9,10)]
+    runs = []
+    for i in sorted(indexes):
+        if runs and runs[-1][1] == i:
+            runs[-1] = (runs[-1][0], i + 1)
+        else:
+            runs.append((i, i + 1))
+    return runs
 
-def debug_google():
-    st.sidebar.markdown("## 🔧 Diagnóstico Google")
+def archive_old_months(today: Optional[date] = None) -> Dict[str, int]:
+    """
+    Mueve los reportes anteriores a la ventana viva (y sus ítems) a hojas por mes.
+    1) crea las hojas que falten y copia todos los meses en un batchUpdate (sin duplicar lo ya copiado),
+    2) verifica que las filas vivas sigan en su lugar y las borra en un batchUpdate.
+    Si se corta entre 1 y 2, la próxima pasada solo borra. Devuelve {mes: reportes movidos}.
+    Corre con el lease de mantenimiento (una réplica a la vez); RuntimeError si lo tiene otra.
+    """
+    if storage().name != "sheets" or ARCHIVE_KEEP_MONTHS <= 0:
+        return {}
+    cutoff = archive_cutoff(today)
+    with _archive_lock(), maintenance_lease() as lease:
+        rep_header, rep_rows = _fetch_sheet_values("reports")
+        it_header, it_rows = _fetch_sheet_values("report_items")
+        if "report_id" not in rep_header or "created_date" not in rep_header or "report_id" not in it_header:
+            return {}
+        c_id, c_dt, c_rid = rep_header.index("report_id"), rep_header.index("created_date"), it_header.index("report_id")
 
-    has_sa = isinstance(st.secrets.get("gcp_service_account", None), dict)
-    has_sheet = bool((st.secrets.get("SHEET_ID", "") or "").strip())
+        month_of: Dict[str, str] = {}
+        rep_idx: Dict[str, List[int]] = {}
+        for i, r in enumerate(rep_rows):
+            d = norm_date(_col(r, c_dt))
+            if d and d < cutoff:
+                month_of[_col(r, c_id)] = d[:7]
+                rep_idx.setdefault(d[:7], []).append(i)
+        if not rep_idx:
+            return {}
+        it_idx: Dict[str, List[int]] = {}
+        for i, r in enumerate(it_rows):
+            m = month_of.get(_col(r, c_rid))
+            if m:
+                it_idx.setdefault(m, []).append(i)
 
-    st.sidebar.write("gcp_service_account:", "✅" if has_sa else "❌")
-    st.sidebar.write("SHEET_ID:", "✅" if has_sheet else "❌")
+        # 1) copiar: hojas nuevas + filas de todos los meses en UN batchUpdate (todo o nada)
+        existing = _refresh_worksheet_handles()
+        used_ids = {w.id for w in existing.values()}
+        requests = []
+        for m in sorted(rep_idx):
+            arch_rep, arch_it = _archive_name("reports", m), _archive_name("report_items", m)
+            done = set()
+            if arch_rep in existing:  # pasada anterior cortada: no duplicar lo ya copiado
+                done = {_col(r, c_id) for r in _fetch_sheet_tail(arch_rep, rep_header, 0)}
+            for name, header, rows in (
+                (arch_rep, rep_header, [rep_rows[i] for i in rep_idx[m] if _col(rep_rows[i], c_id) not in done]),
+                (arch_it, it_header, [it_rows[i] for i in it_idx.get(m, []) if _col(it_rows[i], c_rid) not in done]),
+            ):
+                if name in existing:
+                    sheet_id = existing[name].id
+                else:
+                    sheet_id = random.randrange(1, 2 ** 31)
+                    while sheet_id in used_ids:
+                        sheet_id = random.randrange(1, 2 ** 31)
+                    used_ids.add(sheet_id)
+                    requests.append({"addSheet": {"properties": {
+                        "sheetId": sheet_id, "title": name,
+                        "gridProperties": {"rowCount": len(rows) + 1, "columnCount": len(header)},
+                    }}})
+                    rows = [header] + rows
+                if rows:
+                    requests.append({"appendCells": {
+                        "sheetId": sheet_id,
+                        "rows": [{"values": [_cell(v) for v in r]} for r in rows],
+                        "fields": "userEnteredValue",
+                    }})
+        sh = _open_sheet()
+        if requests:
+            check_lease(lease)
+            _gapi("batch_update", lambda: sh.batch_update({"requests": requests}))
+        invalidate_sheet_handles()
 
-    gc, sheet_id, err = get_google_client()
-    if err:
-        st.sidebar.error(err)
-        st.sidebar.info("Revisa Secrets + compartir el Sheet con la service account.")
-        return
+        # 2) verificar posiciones y borrar de las hojas vivas (de abajo hacia arriba)
+        requests = []
+        for name, rows, idx_by_month, col in (("reports", rep_rows, rep_idx, c_id), ("report_items", it_rows, it_idx, c_rid)):
+            idx = [i for ids in idx_by_month.values() for i in ids]
+            if not idx:
+                continue
+            now_ids = [_col(r, 0) for r in _with_worksheet(name, "get", f"{_col_letter(col + 1)}2:{_col_letter(col + 1)}")]
+            if any(i >= len(now_ids) or now_ids[i] != _col(rows[i], col) for i in idx):
+                raise RuntimeError(f"La hoja '{name}' cambió durante el archivo; se reintenta en la próxima pasada.")
+            sheet_id = existing[name].id
+            for a, b in reversed(_row_runs(idx)):
+                requests.append({"deleteDimension": {"range": {
+                    "sheetId": sheet_id, "dimension": "ROWS", "startIndex": a + 1, "endIndex": b + 1,
+                }}})
+        check_lease(lease)
+        _gapi("batch_update", lambda: sh.batch_update({"requests": requests}))
+        invalidate_records()
+    return {m: len(ids) for m, ids in sorted(rep_idx.items())}
 
+def _maybe_archive(state: dict):
+    # Llamado desde el hilo de la cola: a lo más una pasada cada ARCHIVE_CHECK_INTERVAL
+    if not ARCHIVE_AUTO or ARCHIVE_KEEP_MONTHS <= 0 or time.time() - state["archive_ts"] < ARCHIVE_CHECK_INTERVAL:
+        return
+    state["archive_ts"] = time.time()
     try:
-        sh = gc.open_by_key(sheet_id)
-        ws_names = [w.title for w in sh.worksheets()]
-        st.sidebar.success("Conectado a Google Sheets ✅")
-        st.sidebar.write("Hojas:", ws_names)
+        state["archived"] = archive_old_months()
+        state["archive_error"] = None
     except Exception as e:
-        st.sidebar.error("Error accediendo al Sheet:")
-        st.sidebar.code(str(e))
+        state["archive_error"] = str(e)
 
-# ---------------------------
-# SHEETS: SCHEMA + HELPERS
-# ---------------------------
-USERS_HEADERS = ["username", "full_name", "role", "active", "salt", "pw_hash", "created_at"]
+_ITEMS_LAYOUTS = {tuple(REPORT_ITEMS_HEADERS), tuple(LEGACY_REPORT_ITEMS_HEADERS)}
 
-REPORTS_HEADERS = [
-    "report_id",
-    "equipment_tipo",
-    "equipment_codigo",
-    "equipment_nombre",
-    "horometro_inicial",
-    "operador_user",
-    "operador_nombre",
-    "created_at",
-    "created_date",
-    "resultado_final",
-    "estado_general",
-    "observaciones_generales",
-]
+def _partition_snapshot(base: str, start: date, end: date) -> Tuple[list, List[list], Optional[str]]:
+    """Filas de la hoja viva + archivos mensuales que tocan [start, end] (mismo header)."""
+    header, rows, err = _sheet_rows_snapshot(base)
+    rows = list(rows)
+    for m in archive_months_in_range(start, end):
+        a_header, a_rows, a_err = _sheet_rows_snapshot(_archive_name(base, m))
+        if a_header and a_header != header and {tuple(a_header), tuple(header)} != _ITEMS_LAYOUTS:
+            a_err = a_err or f"La hoja '{_archive_name(base, m)}' tiene otras columnas; se omite."
+        else:
+            rows.extend(a_rows)
+        err = err or a_err
+    return header, rows, err
 
-REPORT_ITEMS_HEADERS = ["report_id", "seccion", "item", "estado", "observacion", "tiene_foto"]
+# ---------------------------
+# OUTBOX: cola local durable -> Sheets en segundo plano
+# ---------------------------
+OUTBOX_PATH = st.secrets.get("OUTBOX_PATH", os.path.join("data", "outbox.sqlite3"))
+OUTBOX_BATCH = int(st.secrets.get("OUTBOX_BATCH", 20))      # reportes por batchUpdate
+OUTBOX_LEASE = 120                                           # s que un envío queda reservado
+OUTBOX_BACKOFF_MAX = 300                                     # s máximos entre reintentos
 
-def _open_sheet():
-    gc, sheet_id, err = get_google_client()
-    if err or not gc:
-        raise RuntimeError(err or "No hay cliente Google")
-    return gc.open_by_key(sheet_id)
+def _outbox_conn() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(OUTBOX_PATH) or ".", exist_ok=True)
+    conn = sqlite3.connect(OUTBOX_PATH, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            report_id TEXT UNIQUE NOT NULL,
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_try REAL NOT NULL DEFAULT 0,
+            last_error TEXT
+        )
+    """)
+    return conn
 
-def ensure_sheet_exists(sheet_name: str, headers: list):
+def enqueue_report(report_id: str, report_row: list, item_rows: List[list]) -> Tuple[bool, str]:
+    """Guarda el reporte en disco (commit local) y despierta al worker. No toca la red."""
     try:
-        sh = _open_sheet()
+        conn = _outbox_conn()
         try:
-            ws = sh.worksheet(sheet_name)
-        except Exception:
-            ws = sh.add_worksheet(title=sheet_name, rows="2000", cols=str(max(10, len(headers) + 5)))
-            ws.append_row(headers, value_input_option="RAW")
-            return True, f"Hoja '{sheet_name}' creada."
-
-        first_row = ws.row_values(1)
-        if [h.strip() for h in first_row] != headers:
-            return False, (
-                f"⚠️ La hoja '{sheet_name}' existe pero los headers NO coinciden.\n"
-                f"Esperado: {headers}\n"
-                f"Actual:   {first_row}\n"
-                f"Solución: reemplaza la fila 1 por los headers esperados."
+            conn.execute(
+                "INSERT INTO outbox (report_id, payload, created_at) VALUES (?, ?, ?)",
+                (report_id, json.dumps({"reports": [report_row], "report_items": item_rows}), time.time()),
             )
-        return True, f"Hoja '{sheet_name}' OK."
+        finally:
+            conn.close()
     except Exception as e:
-        return False, f"Error creando/verificando hoja '{sheet_name}': {e}"
+        return False, f"No se pudo guardar el reporte localmente: {e}"
+    _outbox_worker()["wake"].set()
+    return True, ""
 
-def init_google_schema():
-    checks = [
-        ensure_sheet_exists("users", USERS_HEADERS),
-        ensure_sheet_exists("reports", REPORTS_HEADERS),
-        ensure_sheet_exists("report_items", REPORT_ITEMS_HEADERS),
-    ]
-    for ok, msg in checks:
-        if not ok:
-            st.warning(msg)
+def _claim_outbox_jobs(conn: sqlite3.Connection) -> List[tuple]:
+    # Reserva (lease) para que otro worker sobre el mismo archivo no envíe lo mismo
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        jobs = conn.execute(
+            "SELECT id, report_id, payload, attempts FROM outbox WHERE next_try <= ? ORDER BY id LIMIT ?",
+            (now, OUTBOX_BATCH),
+        ).fetchall()
+        if jobs:
+            conn.execute(
+                f"UPDATE outbox SET next_try = ? WHERE id IN ({','.join('?' * len(jobs))})",
+                [now + OUTBOX_LEASE] + [j[0] for j in jobs],
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return jobs
 
-def append_row_sheet(sheet_name: str, row: list):
-    sh = _open_sheet()
-    ws = sh.worksheet(sheet_name)
-    ws.append_row(row, value_input_option="USER_ENTERED")
+def _confirmed_report_ids() -> set:
+    """
+    report_id ya escritos en el backend, sin invalidar el cache (local ni compartido): lo cacheado
+    más la cola que falta. Si la última fila cacheada ya no está en su lugar (archivo mensual), se lee todo.
+    """
+    rc = _records_cache()
+    with rc["lock"]:
+        e = rc["entries"].get("reports")
+        header, known = (list(e["header"]), list(e["rows"])) if e and e["header"] else ([], [])
+    rows = None
+    if header:
+        tail = storage().fetch_tail("reports", header, max(0, len(known) - 1))
+        if not known or (tail and _trim_row(tail[0]) == _trim_row(known[-1])):
+            rows = known + tail[1 if known else 0:]
+    if rows is None:
+        header, rows = storage().fetch_values("reports")
+    c_id = header.index("report_id") if "report_id" in header else 0
+    return {_col(r, c_id) for r in rows}
 
-def sheet_records(sheet_name: str) -> list:
+def flush_outbox_once() -> int:
+    """Envía un lote a Sheets (un solo batchUpdate). Devuelve cuántos reportes quedaron confirmados."""
+    conn = _outbox_conn()
     try:
-        sh = _open_sheet()
-        ws = sh.worksheet(sheet_name)
-        return ws.get_all_records()
-    except Exception:
-        return []
+        jobs = _claim_outbox_jobs(conn)
+        if not jobs:
+            return 0
 
-def next_report_id() -> int:
-    rows = sheet_records("reports")
-    mx = 0
-    for r in rows:
+        # Un reintento puede venir de un timeout cuyo batchUpdate sí se aplicó: no duplicar
+        done_ids = set()
+        if any(attempts > 0 for *_, attempts in jobs):
+            done_ids = _confirmed_report_ids() & {report_id for _, report_id, _, _ in jobs}
+
+        rows_by_sheet = {"reports": [], "templates": [], "report_items": []}
+        for _, report_id, payload, _ in jobs:
+            if report_id in done_ids:
+                continue
+            data = json.loads(payload)
+            items = data["report_items"]
+            if not all(is_encoded_item_row(r) for r in items):  # encolado con el formato anterior
+                tipo = _col(data["reports"][0], 1) if data["reports"] else ""
+                items, new_templates = encode_legacy_item_rows(items, {report_id: tipo})
+                rows_by_sheet["templates"].extend(new_templates)
+            rows_by_sheet["reports"].extend(data["reports"])
+            rows_by_sheet["report_items"].extend(items)
+
+        ids = [j[0] for j in jobs]
         try:
-            mx = max(mx, int(r.get("report_id", 0)))
-        except Exception:
-            pass
-    return mx + 1
+            append_rows_atomic(rows_by_sheet)
+        except Exception as e:
+            for job_id, _, _, attempts in jobs:
+                delay = min(OUTBOX_BACKOFF_MAX, 2 ** (attempts + 1)) * random.uniform(0.5, 1.5)
+                conn.execute(
+                    "UPDATE outbox SET attempts = ?, next_try = ?, last_error = ? WHERE id = ?",
+                    (attempts + 1, time.time() + delay, str(e)[:500], job_id),
+                )
+            raise
+        learn_templates(rows_by_sheet["templates"])
+        if done_ids:
+            # filas de un envío anterior que sí se aplicó: las demás réplicas sincronizan la cola
+            for sheet_name in ("reports", "report_items"):
+                _shared("touch", sheet_name)
+        conn.execute(f"DELETE FROM outbox WHERE id IN ({','.join('?' * len(ids))})", ids)
+        return len(ids)
+    finally:
+        conn.close()
+
+def _outbox_loop(state: dict):
+    while True:
+        _maybe_archive(state)  # mantenimiento en el mismo hilo de fondo
+        try:
+            n = flush_outbox_once()
+            if n:
+                state["flushed"] += n
+                state["last_error"] = None
+                continue
+        except Exception as e:
+            state["last_error"] = str(e)
+        state["wake"].wait(timeout=5)
+        state["wake"].clear()
+
+@st.cache_resource
+def _outbox_worker() -> dict:
+    # Un hilo por proceso que vacía la cola hacia Sheets
+    state = {"wake": threading.Event(), "flushed": 0, "last_error": None,
+             "archive_ts": 0.0, "archived": {}, "archive_error": None}
+    threading.Thread(target=_outbox_loop, args=(state,), name="outbox-flusher", daemon=True).start()
+    return state
+
+def outbox_stats() -> dict:
+    state = _outbox_worker()
+    conn = _outbox_conn()
+    try:
+        pending, oldest, max_attempts = conn.execute(
+            "SELECT COUNT(*), MIN(created_at), MAX(attempts) FROM outbox"
+        ).fetchone()
+    finally:
+        conn.close()
+    return {
+        "pending": pending,
+        "oldest_age_s": int(time.time() - oldest) if oldest else 0,
+        "max_attempts": max_attempts or 0,
+        "flushed": state["flushed"],
+        "last_error": state["last_error"],
+    }
 
 # ---------------------------
 # EQUIPOS + CHECKLISTS (NO TOCAR)
@@ -255,77 +2108,898 @@ CHECKLISTS: Dict[str, List[Tuple[str, List[str]]]] = {
     ]
 }
 
+# ---------------------------
+# PLANTILLAS DE CHECKLIST (CHECKLISTS compilado a códigos)
+# ---------------------------
+ESTADO_CODES = {"OPERATIVO": "O", "OPERATIVO CON FALLA": "F", "INOPERATIVO": "I"}
+ESTADO_BY_CODE = {c: e for e, c in ESTADO_CODES.items()}
+LEGACY_TEMPLATE_VERSION = "legacy"  # filas migradas del formato anterior
+MIGRATE_CHUNK_ROWS = int(st.secrets.get("MIGRATE_CHUNK_ROWS", 5000))
+_ITEM_ID_RE = re.compile(r"^[0-9a-f]{6}$")
+
+def item_id_for(tipo: str, seccion: str, item: str) -> str:
+    # Estable: depende solo de las etiquetas (no del orden ni de la versión de la plantilla)
+    return hashlib.sha1(f"{tipo}\x1f{seccion}\x1f{item}".encode("utf-8")).hexdigest()[:6]
+
+def compile_templates(checklists: Dict[str, List[Tuple[str, List[str]]]]) -> Dict[str, dict]:
+    """{tipo: {"version", "items": [(item_id, seccion, item)]}}; la versión es un hash del contenido."""
+    out, seen = {}, {}
+    for tipo, secciones in checklists.items():
+        items = []
+        for seccion, nombres in secciones:
+            for item in nombres:
+                iid = item_id_for(tipo, seccion, item)
+                if seen.setdefault(iid, (tipo, seccion, item)) != (tipo, seccion, item):
+                    raise ValueError(f"item_id repetido {iid}: {seen[iid]} y {(tipo, seccion, item)}")
+                items.append((iid, seccion, item))
+        digest = hashlib.sha1(json.dumps([tipo, items], ensure_ascii=False).encode("utf-8")).hexdigest()
+        out[tipo] = {"version": digest[:6], "items": items}
+    return out
+
+# Un item_id repetido no tumba la app: se muestra en la UI y no se aceptan envíos hasta corregir CHECKLISTS
+try:
+    CHECKLIST_TEMPLATES, TEMPLATES_ERROR = compile_templates(CHECKLISTS), None
+except ValueError as e:
+    CHECKLIST_TEMPLATES, TEMPLATES_ERROR = {}, f"Plantillas de checklist inválidas: {e}. Corrige CHECKLISTS."
+
+@st.cache_resource
+def _template_table() -> dict:
+    # item_id -> (tipo, seccion, item): lo compilado + lo guardado en la hoja templates (versiones viejas)
+    labels = {iid: (tipo, sec, it) for tipo, t in CHECKLIST_TEMPLATES.items() for iid, sec, it in t["items"]}
+    return {"lock": threading.Lock(), "labels": labels, "loaded_ts": 0.0}
+
+def learn_templates(rows: List[list]):
+    """Agrega filas de templates (formato TEMPLATES_HEADERS) a la tabla en memoria."""
+    tt = _template_table()
+    with tt["lock"]:
+        for r in rows:
+            r = [str(v) for v in r]
+            if len(r) >= 5 and r[2]:
+                tt["labels"].setdefault(r[2], (r[1], r[3], r[4]))
+
+def sync_templates():
+    """Guarda en templates las versiones compiladas que falten y carga las ya guardadas."""
+    recs, err = read_sheet("templates")
+    if err:
+        raise RuntimeError(err)
+    stored = [[rec.get(h, "") for h in TEMPLATES_HEADERS] for rec in recs]
+    have = {(str(r[0]), str(r[2])) for r in stored}
+    new_rows = [
+        [t["version"], tipo, iid, sec, it, n]
+        for tipo, t in CHECKLIST_TEMPLATES.items()
+        for n, (iid, sec, it) in enumerate(t["items"], 1)
+        if (t["version"], iid) not in have
+    ]
+    if new_rows:
+        append_rows_atomic({"templates": new_rows})
+    learn_templates(stored)
+    _template_table()["loaded_ts"] = time.time()
+
+def item_labels(item_id: str) -> Optional[Tuple[str, str, str]]:
+    """(tipo, seccion, item) de un item_id. Si no se conoce (plantilla nueva de otra réplica) se relee templates."""
+    tt = _template_table()
+    lab = tt["labels"].get(item_id)
+    if lab is None and time.time() - tt["loaded_ts"] > RECORDS_CACHE_TTL:
+        tt["loaded_ts"] = time.time()
+        recs, err = read_sheet("templates")
+        if not err:
+            learn_templates([[rec.get(h, "") for h in TEMPLATES_HEADERS] for rec in recs])
+        lab = tt["labels"].get(item_id)
+    return lab
+
+def encode_item_row(report_id: str, tipo: str, seccion: str, item: str, estado: str,
+                    observacion: str, tiene_foto: bool) -> list:
+    return [
+        report_id, CHECKLIST_TEMPLATES[tipo]["version"], item_id_for(tipo, seccion, item),
+        ESTADO_CODES.get(estado, estado), observacion, "1" if tiene_foto else "0",
+    ]
+
+def is_encoded_item_row(row: list) -> bool:
+    return bool(_ITEM_ID_RE.match(_col(row, 2)))
+
+def encode_legacy_item_rows(rows: List[list], tipo_of: Dict[str, str]) -> Tuple[List[list], List[list]]:
+    """
+    Filas de report_items con etiquetas completas -> (filas codificadas, filas nuevas para templates).
+    Las ya codificadas pasan igual. Etiquetas que no están en CHECKLISTS quedan en la versión 'legacy'.
+    """
+    labels = _template_table()["labels"]
+    out, new_templates, pending = [], [], {}
+    for row in rows:
+        if is_encoded_item_row(row):
+            out.append(list(row))
+            continue
+        rid, seccion, item, estado, obs, foto = (list(row) + [""] * 6)[:6]
+        tipo = tipo_of.get(rid, "")
+        iid = item_id_for(tipo, seccion, item)
+        lab = labels.get(iid) or pending.get(iid)
+        if lab is None:
+            pending[iid] = (tipo, seccion, item)
+            new_templates.append([LEGACY_TEMPLATE_VERSION, tipo, iid, seccion, item, ""])
+        elif lab != (tipo, seccion, item):
+            raise RuntimeError(f"item_id repetido {iid}: {lab} y {(tipo, seccion, item)}")
+        out.append([rid, LEGACY_TEMPLATE_VERSION, iid, ESTADO_CODES.get(estado, estado), obs, "1" if foto == "SI" else "0"])
+    return out, new_templates
+
+def decode_item_row(row: list) -> dict:
+    """Fila de report_items (codificada o con etiquetas) -> {report_id, seccion, item, estado, observacion, tiene_foto}."""
+    r = ["" if v is None else str(v) for v in (list(row) + [""] * 6)[:6]]
+    if not is_encoded_item_row(r):
+        return dict(zip(LEGACY_REPORT_ITEMS_HEADERS, r))
+    _, seccion, item = item_labels(r[2]) or ("", "", r[2])
+    return {"report_id": r[0], "seccion": seccion, "item": item, "estado": ESTADO_BY_CODE.get(r[3], r[3]),
+            "observacion": r[4], "tiene_foto": "SI" if r[5] == "1" else "NO"}
+
+def _item_sheets_to_migrate() -> List[str]:
+    # report_items y sus archivos cuya fila 1 sigue con el formato anterior (una sola lectura)
+    names = ["report_items"] + [_archive_name("report_items", m) for m in archive_months()]
+    sh = _open_sheet()
+    ranges = [f"'{n}'!1:1" for n in names]
+    resp = _gapi("values_batch_get", lambda: sh.values_batch_get(ranges), key=f"values_batch_get|{ranges!r}")
+    return [n for n, vr in zip(names, resp.get("valueRanges", []))
+            if [h.strip() for h in (vr.get("values") or [[]])[0]] != REPORT_ITEMS_HEADERS]
+
+def _report_tipos() -> Dict[str, str]:
+    tipo_of = {}
+    for name in ["reports"] + [_archive_name("reports", m) for m in archive_months()]:
+        header, rows, err = _sheet_rows_snapshot(name)
+        if err:
+            raise RuntimeError(err)
+        if "report_id" in header and "equipment_tipo" in header:
+            c_id, c_tipo = header.index("report_id"), header.index("equipment_tipo")
+            tipo_of.update((_col(r, c_id), _col(r, c_tipo)) for r in rows)
+    return tipo_of
+
+def migrate_report_items() -> Dict[str, int]:
+    """
+    Reescribe en su lugar las filas de report_items (y archivos) que siguen con etiquetas completas.
+    Mismas columnas y posiciones: mientras dura, los lectores decodifican ambos formatos por fila.
+    Por bloques de MIGRATE_CHUNK_ROWS: verifica que las filas sigan en su lugar antes de escribir;
+    la fila 1 se cambia al final. Devuelve {hoja: filas migradas}.
+    Acción del supervisor; corre con el lease de mantenimiento (nunca junto al archivo mensual,
+    en ninguna réplica). RuntimeError si lo tiene otra.
+    """
+    if storage().name != "sheets":
+        return {}
+    migrated = {}
+    with _archive_lock(), maintenance_lease() as lease:
+        names = _item_sheets_to_migrate()
+        tipo_of = _report_tipos() if names else {}
+        sh = _open_sheet()
+        for name in names:
+            header, rows = _fetch_sheet_values(name)
+            idx = [i for i, r in enumerate(rows) if any(r) and not is_encoded_item_row(r)]
+            encoded, new_templates = encode_legacy_item_rows([rows[i] for i in idx], tipo_of)
+            if new_templates:  # antes que las filas que las usan
+                append_rows_atomic({"templates": new_templates})
+                learn_templates(new_templates)
+            sheet_id = _worksheet(name).id
+            by_pos = dict(zip(idx, encoded))
+            for lo in range(0, len(rows), MIGRATE_CHUNK_ROWS):
+                block = idx[bisect_left(idx, lo):bisect_left(idx, lo + MIGRATE_CHUNK_ROWS)]
+                if not block:
+                    continue
+                now_ids = [_col(r, 0) for r in _with_worksheet(name, "get", f"A{block[0] + 2}:A{block[-1] + 2}")]
+                if any(_col(now_ids, i - block[0]) != _col(rows[i], 0) for i in block):
+                    raise RuntimeError(f"La hoja '{name}' cambió durante la migración; se reintenta en la próxima pasada.")
+                requests = [{"updateCells": {
+                    "start": {"sheetId": sheet_id, "rowIndex": a + 1, "columnIndex": 0},
+                    "rows": [{"values": [_cell(v) for v in by_pos[i]]} for i in range(a, b)],
+                    "fields": "userEnteredValue",
+                }} for a, b in _row_runs(block)]
+                check_lease(lease)
+                _gapi("batch_update", lambda: sh.batch_update({"requests": requests}))
+            check_lease(lease)
+            _with_worksheet(name, "update", values=[REPORT_ITEMS_HEADERS], range_name="A1")
+            invalidate_records(name)
+            migrated[name] = len(idx)
+    return migrated
+
 # ---------------------------
 # AUTH (Users in Sheets)
 # ---------------------------
-def hash_password(password: str, salt: bytes) -> str:
-    dk = pbkdf2_hmac("sha256", password.encode("utf-8"), salt, 120000)
+# Iteraciones PBKDF2 para claves nuevas/rehash. Filas sin pw_iter usan LEGACY_PBKDF2_ITERATIONS.
+PBKDF2_ITERATIONS = int(st.secrets.get("PBKDF2_ITERATIONS", 120000))
+LEGACY_PBKDF2_ITERATIONS = 120000
+HASH_WORKERS = int(st.secrets.get("HASH_WORKERS", os.cpu_count() or 2))
+HASH_MAX_PENDING = int(st.secrets.get("HASH_MAX_PENDING", 4 * HASH_WORKERS))
+# Intentos fallidos dentro de la ventana. Por usuario: pasado LOGIN_MAX_FAILURES cada intento espera
+# (retardo progresivo hasta LOGIN_DELAY_MAX_S) pero una clave correcta entra igual; así nadie bloquea
+# a un supervisor adivinando su usuario. Por IP: rechazo, con tope alto porque detrás del balanceador
+# o del NAT de planta todos los operadores comparten IP.
+LOGIN_MAX_FAILURES = int(st.secrets.get("LOGIN_MAX_FAILURES", 5))
+LOGIN_MAX_FAILURES_IP = int(st.secrets.get("LOGIN_MAX_FAILURES_IP", 100))
+LOGIN_DELAY_MAX_S = float(st.secrets.get("LOGIN_DELAY_MAX_S", 10))
+LOGIN_WINDOW_S = int(st.secrets.get("LOGIN_WINDOW_S", 300))
+# Proxies propios (lista de IPs, o texto separado por comas): solo si la conexión viene de uno
+# de ellos se cree en X-Forwarded-For
+LOGIN_TRUSTED_PROXIES = frozenset(_secret_list("LOGIN_TRUSTED_PROXIES"))
+LOGIN_THROTTLE_MAX_KEYS = 10_000  # tope de claves (usuario/IP) con fallos recientes en memoria
+
+def hash_password(password: str, salt: bytes, iterations: int = LEGACY_PBKDF2_ITERATIONS) -> str:
+    dk = pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
     return base64.b64encode(dk).decode("utf-8")
 
+@st.cache_resource
+def _hash_pool() -> dict:
+    # pbkdf2_hmac libera el GIL: varios logins simultáneos usan varios núcleos
+    return {
+        "pool": ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="pbkdf2"),
+        "slots": threading.BoundedSemaphore(HASH_MAX_PENDING),
+    }
+
+def hash_password_async(password: str, salt: bytes, iterations: int) -> str:
+    """hash_password en el pool acotado; si está lleno se rechaza en vez de encolar sin límite."""
+    hp = _hash_pool()
+    if not hp["slots"].acquire(blocking=False):
+        raise RuntimeError("Servidor ocupado validando claves. Intenta de nuevo en unos segundos.")
+    try:
+        return hp["pool"].submit(hash_password, password, salt, iterations).result()
+    finally:
+        hp["slots"].release()
+
+def new_password_fields(password: str) -> Tuple[str, str, int]:
+    salt = os.urandom(16)
+    pw_hash = hash_password_async(password, salt, PBKDF2_ITERATIONS)
+    return base64.b64encode(salt).decode("utf-8"), pw_hash, PBKDF2_ITERATIONS
+
+@st.cache_resource
+def _login_throttle() -> dict:
+    # clave ("u:<usuario>" / "ip:<ip>") -> timestamps de intentos fallidos recientes
+    return {"lock": threading.Lock(), "fails": {}}
+
+def _client_ip() -> Optional[str]:
+    """
+    IP del cliente para el throttle. Si la conexión viene de un proxy de LOGIN_TRUSTED_PROXIES se toma
+    el último salto de X-Forwarded-For que no sea un proxy propio (lo anterior lo puede inventar el cliente).
+    """
+    ctx = getattr(st, "context", None)
+    ip = getattr(ctx, "ip_address", None)
+    if ip and ip in LOGIN_TRUSTED_PROXIES:
+        headers = getattr(ctx, "headers", None) or {}
+        hops = [h.strip() for h in str(headers.get("X-Forwarded-For") or "").split(",") if h.strip()]
+        for hop in reversed(hops):
+            if hop not in LOGIN_TRUSTED_PROXIES:
+                return hop
+    return ip
+
+def _throttle_keys(username: str, client_ip: Optional[str]) -> List[str]:
+    keys = [f"u:{username.lower()}"]
+    if client_ip:
+        keys.append(f"ip:{client_ip}")
+    return keys
+
+def _login_check(keys: List[str]) -> Tuple[bool, float]:
+    """(bloqueado por IP, segundos de espera por usuario) según los fallos recientes."""
+    lt = _login_throttle()
+    cutoff = time.time() - LOGIN_WINDOW_S
+    blocked, delay = False, 0.0
+    with lt["lock"]:
+        for k in keys:
+            recent = [t for t in lt["fails"].get(k, []) if t > cutoff]
+            if recent:
+                lt["fails"][k] = recent
+            else:
+                lt["fails"].pop(k, None)
+            if k.startswith("ip:"):
+                blocked = blocked or len(recent) >= LOGIN_MAX_FAILURES_IP
+            elif len(recent) >= LOGIN_MAX_FAILURES:
+                delay = min(LOGIN_DELAY_MAX_S, 2.0 ** (len(recent) - LOGIN_MAX_FAILURES))
+    return blocked, delay
+
+def _prune_login_fails(fails: dict):
+    # Claves cuya ventana venció; si aun así hay demasiadas (barrido de IPs), se olvidan las más antiguas
+    cutoff = time.time() - LOGIN_WINDOW_S
+    for k in [k for k, ts in fails.items() if ts[-1] <= cutoff]:
+        del fails[k]
+    if len(fails) > LOGIN_THROTTLE_MAX_KEYS:
+        for k in sorted(fails, key=lambda k: fails[k][-1])[:len(fails) - LOGIN_THROTTLE_MAX_KEYS]:
+            del fails[k]
+
+def _login_result(keys: List[str], ok: bool):
+    lt = _login_throttle()
+    with lt["lock"]:
+        for k in keys:
+            if ok and k.startswith("u:"):
+                lt["fails"].pop(k, None)
+            elif not ok:
+                lt["fails"].setdefault(k, []).append(time.time())
+        if len(lt["fails"]) > LOGIN_THROTTLE_MAX_KEYS:
+            _prune_login_fails(lt["fails"])
+
+@st.cache_resource
+def _user_index_state() -> dict:
+    # username -> {"row": fila del Sheet (None si aún no se re-leyó), "user": registro}
+    return {"lock": threading.Lock(), "entry": None, "consumed": 0, "by_name": {}}
+
+def _index_user(by_name: dict, rec: dict, row: Optional[int]):
+    name = str(rec.get("username", ""))
+    cur = by_name.get(name)
+    if cur is None or cur["row"] is None:  # si hay duplicados en el Sheet gana el primero (como antes)
+        by_name[name] = {"row": row, "user": rec}
+
+def find_user(username: str) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    Búsqueda O(1) en el índice de usuarios. El índice se arma desde la hoja cacheada (cada vez que
+    se relee entera, a lo más una vez por RECORDS_CACHE_TTL) y entre medio consume las escrituras propias.
+    Devuelve ({"row", "user"} o None, error de lectura).
+    """
+    e, err = _fresh_entry("users")
+    if e is None:
+        return None, err
+    rc, ui = _records_cache(), _user_index_state()
+    with rc["lock"], ui["lock"]:
+        if ui["entry"] is not e:  # primera vez o sync completa: se reconstruye
+            ui.update(entry=e, consumed=0, by_name={})
+        recs = e["records"]
+        for i in range(ui["consumed"], len(recs)):
+            _index_user(ui["by_name"], recs[i], i + 2)
+        ui["consumed"] = len(recs)
+        for rec in e["pending_records"]:
+            _index_user(ui["by_name"], rec, None)
+        return ui["by_name"].get(username), err
+
+def _seed_admin_user():
+    found, err = find_user(ADMIN_USER)
+    if err:
+        raise RuntimeError(err)
+    if not found:
+        salt_b64, pw_hash, iters = new_password_fields(ADMIN_PASSWORD)
+        append_row_sheet("users", [
+            ADMIN_USER, "Supervisor", "supervisor", 1, salt_b64, pw_hash,
+            datetime.now().isoformat(timespec="seconds"), iters
+        ])
+
 def init_db_like():
-    init_google_schema()
+    """
+    Esquema + usuario admin: UNA vez por proceso (no en cada rerun).
+    Si falla por error de red se reintenta pasado BOOTSTRAP_RETRY_S; "Re-verificar Google" lo fuerza.
+    Los operadores pueden enviar igual: los reportes quedan en la cola local.
+    """
+    def _schema():
+        try:
+            checks = storage().check_schema()
+            if all(ok for ok, _ in checks):
+                _seed_admin_user()
+                sync_templates()
+            return True, checks
+        except Exception as e:
+            return False, [(False, f"Error verificando hojas: {e}")]
+
+    checks = _bootstrap_once("schema", _schema)
+    if checks is None:
+        st.info("Verificando hojas de Google…")
+        return
+
+    for ok, msg in checks:
+        if not ok:
+            st.warning(msg)
+    if all(ok for ok, _ in checks):
+        _outbox_worker()  # retoma envíos pendientes de otra ejecución y el archivo mensual
+
+def _rehash_user_password(found: dict, password: str):
+    """Reescribe salt/pw_hash/pw_iter con PBKDF2_ITERATIONS (fila conocida) y actualiza el cache."""
+    row_n = found["row"]
+    if not row_n:
+        return  # fila recién escrita aún no re-leída: se hará en el próximo login
+    salt_b64, pw_hash, iters = new_password_fields(password)
+    c_salt = USERS_HEADERS.index("salt")
+    c_iter = USERS_HEADERS.index("pw_iter")
+    if not storage().update_user_fields(found, {"salt": salt_b64, "pw_hash": pw_hash, "pw_iter": iters}):
+        invalidate_records("users")  # el índice quedó viejo (filas movidas): se relee y se reintenta en otro login
+        return
+    rc = _records_cache()
+    with rc["lock"]:
+        found["user"].update({"salt": salt_b64, "pw_hash": pw_hash, "pw_iter": str(iters)})
+        e = rc["entries"].get("users")
+        if e and row_n - 2 < len(e["rows"]):
+            r = e["rows"][row_n - 2]
+            r.extend([""] * (len(USERS_HEADERS) - len(r)))
+            r[c_salt], r[c_salt + 1], r[c_iter] = salt_b64, pw_hash, str(iters)
+    _shared("reset", "users")  # cambio en una fila existente: las demás réplicas releen la hoja
+
+def auth_user(username: str, password: str, client_ip: Optional[str] = None):
+    username = username.strip()
+    keys = _throttle_keys(username, client_ip)
+    blocked, delay = _login_check(keys)
+    if blocked:
+        raise RuntimeError("Demasiados intentos fallidos. Espera unos minutos e intenta de nuevo.")
+    if delay:
+        time.sleep(delay)  # usuario con fallos recientes: se frena el intento, no se rechaza
+
+    found, err = find_user(username)
+    if err and not found:
+        raise RuntimeError(err)
+    row = found["user"] if found else None
+    if not row or not _truthy(row.get("active", 1)):
+        _login_result(keys, False)
+        return None
+    salt = base64.b64decode(row["salt"])
+    iters = int(row.get("pw_iter") or LEGACY_PBKDF2_ITERATIONS)
+    pw_hash = hash_password_async(password, salt, iters)
+    if not hmac.compare_digest(pw_hash, str(row["pw_hash"])):
+        _login_result(keys, False)
+        return None
+    _login_result(keys, True)
+
+    if iters != PBKDF2_ITERATIONS:
+        try:
+            _rehash_user_password(found, password)
+        except Exception:
+            pass  # el login ya es válido; se reintenta en el próximo ingreso
+    return {"username": row["username"], "full_name": row["full_name"], "role": row["role"]}
+
+def create_user(username: str, full_name: str, password: str, role: str, active: bool):
+    username = username.strip()
+    found, err = find_user(username)
+    if err:
+        raise RuntimeError(f"No se puede validar el usuario ahora. {err}")
+    if found:
+        raise ValueError("Ese usuario ya existe.")
+
+    salt_b64, pw_hash, iters = new_password_fields(password)
+
+    append_row_sheet("users", [
+        username, full_name.strip(), role, 1 if active else 0,
+        salt_b64, pw_hash, datetime.now().isoformat(timespec="seconds"), iters
+    ])
+
+def fetch_users():
+    users = sheet_records("users")
+    users.sort(key=lambda x: x.get("created_at", ""), reverse=True)
+    out = []
+    for u in users:
+        out.append({
+            "username": u.get("username", ""),
+            "full_name": u.get("full_name", ""),
+            "role": u.get("role", ""),
+            "active": u.get("active", 1),
+            "created_at": u.get("created_at", ""),
+        })
+    return out
+
+# ---------------------------
+# LOGIC
+# ---------------------------
+def compute_result(items_estado: List[str]) -> Tuple[str, str]:
+    return compute_result_from_counts(Counter(items_estado))
+
+def compute_result_from_counts(counts: Dict[str, int]) -> Tuple[str, str]:
+    """Igual que compute_result pero desde conteos por estado (los del checklist se suman por sección)."""
+    if counts.get("INOPERATIVO", 0) > 0:
+        return ("INOPERATIVO", "NO APTO")
+    if counts.get("OPERATIVO CON FALLA", 0) > 0:
+        return ("FALLA", "RESTRICCIONES")
+    return ("OPERATIVO", "APTO")
+
+# ---------------------------
+# ROLLUPS (Panel de control)
+# ---------------------------
+RESULTADOS = ["APTO", "RESTRICCIONES", "NO APTO"]
+
+def norm_date(value) -> str:
+    """created_date a 'YYYY-MM-DD' (filas antiguas pueden venir como 'dd/mm/yyyy'). '' si no se reconoce."""
+    v = str(value or "").strip()
+    if re.match(r"^\d{4}-\d{2}-\d{2}", v):
+        return v[:10]
+    m = re.match(r"^(\d{1,2})/(\d{1,2})/(\d{4})", v)
+    if m:
+        return f"{m.group(3)}-{int(m.group(2)):02d}-{int(m.group(1)):02d}"
+    return ""
+
+@st.cache_resource
+def _rollup_state() -> dict:
+    # Buckets diarios: fecha -> {key_idx: n}, key = (equipo, operador, resultado)
+    # "cum" es la suma acumulada por fecha ordenada: rango = cum[i1] - cum[i0]
+    return {
+        "lock": threading.Lock(), "entry": None, "consumed": 0,
+        "days": {}, "keys": {}, "key_list": [], "dates": [], "cum": None,
+    }
+
+def _report_rollup_key(rec: dict) -> Tuple[str, tuple]:
+    return norm_date(rec.get("created_date")), (
+        str(rec.get("equipment_codigo") or "").strip(),
+        str(rec.get("operador_nombre") or "").strip(),
+        str(rec.get("resultado_final") or "").strip(),
+    )
+
+def _rollup_add(ro: dict, rec: dict):
+    d, key = _report_rollup_key(rec)
+    if not d:
+        return
+    ki = ro["keys"].get(key)
+    if ki is None:
+        ki = ro["keys"][key] = len(ro["key_list"])
+        ro["key_list"].append(key)
+    day = ro["days"].setdefault(d, {})
+    day[ki] = day.get(ki, 0) + 1
+    ro["cum"] = None
+
+def _rollup_cum(ro: dict) -> np.ndarray:
+    if ro["cum"] is None:
+        ro["dates"] = sorted(ro["days"])
+        m = np.zeros((len(ro["dates"]) + 1, len(ro["key_list"])), dtype=np.int64)
+        for i, d in enumerate(ro["dates"], start=1):
+            for ki, n in ro["days"][d].items():
+                m[i, ki] = n
+        ro["cum"] = np.cumsum(m, axis=0)
+    return ro["cum"]
+
+@st.cache_resource
+def _archive_rollup_state() -> dict:
+    # hoja de archivo -> (entry, filas contadas, {fecha: {key: n}})
+    return {"lock": threading.Lock(), "by_sheet": {}}
+
+def _archive_day_counts(sheet_name: str) -> Tuple[Dict[str, Dict[tuple, int]], Optional[str]]:
+    e, err = _fresh_entry(sheet_name)
+    if e is None:
+        return {}, err
+    ar = _archive_rollup_state()
+    with _records_cache()["lock"], ar["lock"]:
+        cached = ar["by_sheet"].get(sheet_name)
+        if cached is None or cached[0] is not e or cached[1] != len(e["records"]):
+            days: Dict[str, Dict[tuple, int]] = {}
+            for rec in e["records"]:
+                d, key = _report_rollup_key(rec)
+                if d:
+                    day = days.setdefault(d, {})
+                    day[key] = day.get(key, 0) + 1
+            cached = ar["by_sheet"][sheet_name] = (e, len(e["records"]), days)
+        return cached[2], err
+
+def rollup_summary(start: date, end: date) -> Tuple[dict, Optional[str]]:
+    """
+    Totales del Panel de control para [start, end] desde los buckets diarios.
+    Los buckets consumen solo reportes nuevos del cache de 'reports'; el rango sale en O(claves).
+    """
+    e, err = _fresh_entry("reports")
+    ro = _rollup_state()
+    with _records_cache()["lock"], ro["lock"]:
+        if e is not None:
+            if ro["entry"] is not e:  # primera vez o sync completa: se reconstruye
+                ro.update(entry=e, consumed=0, days={}, keys={}, key_list=[], dates=[], cum=None)
+            for rec in e["records"][ro["consumed"]:]:
+                _rollup_add(ro, rec)
+            ro["consumed"] = len(e["records"])
+            pending = list(e["pending_records"])
+        else:
+            pending = []
+
+        cum = _rollup_cum(ro)
+        i0 = bisect_left(ro["dates"], start.isoformat())
+        i1 = bisect_right(ro["dates"], end.isoformat())
+        counts = cum[i1] - cum[i0]
+        key_list = list(ro["key_list"])
+
+    # reportes propios aún no re-leídos del Sheet (pocos): se suman aparte
+    extra: Dict[tuple, int] = {}
+    for rec in pending:
+        d, key = _report_rollup_key(rec)
+        if d and start.isoformat() <= d <= end.isoformat():
+            extra[key] = extra.get(key, 0) + 1
+
+    # meses archivados del rango: conteos por día de cada hoja (no cambia; se calcula una vez)
+    for m in archive_months_in_range(start, end):
+        days, a_err = _archive_day_counts(_archive_name("reports", m))
+        err = err or a_err
+        for d, keys in days.items():
+            if start.isoformat() <= d <= end.isoformat():
+                for key, n in keys.items():
+                    extra[key] = extra.get(key, 0) + n
+
+    by_key: Dict[tuple, int] = {key_list[i]: int(counts[i]) for i in np.flatnonzero(counts)}
+    for key, n in extra.items():
+        by_key[key] = by_key.get(key, 0) + n
+
+    res_counts = {r: 0 for r in RESULTADOS}
+    by_equipo: Dict[str, Dict[str, int]] = {}
+    for (equipo, operador, resultado), n in by_key.items():
+        if resultado in res_counts:
+            res_counts[resultado] += n
+        eq_row = by_equipo.setdefault(equipo, {r: 0 for r in RESULTADOS})
+        if resultado in eq_row:
+            eq_row[resultado] += n
+    return {
+        "total": sum(by_key.values()),
+        "operadores": len({k[1] for k in by_key if k[1]}),
+        "equipos_con_envio": len({k[0] for k in by_key if k[0]}),
+        "resultados": res_counts,
+        "por_equipo": by_equipo,
+    }, err
+
+# ---------------------------
+# CONSULTAS (Reportes / ítems)
+# ---------------------------
+REPORTS_BROWSER_COLUMNS = [
+    "report_id", "created_at", "equipment_codigo", "equipment_nombre", "operador_nombre",
+    "horometro_inicial", "resultado_final", "estado_general", "observaciones_generales",
+]
+
+def query_reports(
+    equipo: str = "",
+    operador: str = "",
+    resultados: Optional[List[str]] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    columns: Optional[List[str]] = None,
+    page: int = 1,
+    page_size: int = 50,
+) -> Tuple[List[dict], int, Optional[str]]:
+    """
+    Filtra reportes en el servidor (más nuevos primero) y devuelve SOLO la página pedida
+    con las columnas pedidas: (filas, total_coincidencias, error).
+    """
+    operador = operador.strip().lower()
+    d0 = start.isoformat() if start else ""
+    d1 = end.isoformat() if end else ""
+    cols = columns or REPORTS_BROWSER_COLUMNS
+    first = (max(1, page) - 1) * page_size
+
+    backend = storage()
+    if backend.supports_queries:
+        try:
+            rows, total = backend.query_reports(equipo, operador, resultados, d0, d1, cols, first, page_size)
+            return rows, total, None
+        except Exception as ex:
+            return [], 0, f"No se pudo consultar reportes: {ex}"
+
+    e, err = _fresh_entry("reports")
+    if e is None:
+        return [], 0, err
+    with _records_cache()["lock"]:
+        recs = e["records"] + e["pending_records"]
+    # Más nuevos primero: hoja viva y luego los meses archivados que pide el rango
+    parts = [recs]
+    for m in archive_months_in_range(start, end):
+        a_recs, a_err = read_sheet(_archive_name("reports", m))
+        parts.append(a_recs)
+        err = err or a_err
+
+    total = 0
+    out = []
+    for r in (r for part in parts for r in reversed(part)):
+        if equipo and r.get("equipment_codigo") != equipo:
+            continue
+        if resultados and r.get("resultado_final") not in resultados:
+            continue
+        if operador and operador not in str(r.get("operador_nombre", "")).lower() and operador != str(r.get("operador_user", "")).lower():
+            continue
+        if d0 or d1:
+            d = norm_date(r.get("created_date"))
+            if not d or (d0 and d < d0) or (d1 and d > d1):
+                continue
+        if first <= total < first + page_size:
+            out.append({c: r.get(c, "") for c in cols})
+        total += 1
+    return out, total, err
+
+@st.cache_resource
+def _items_index_state() -> dict:
+    # Por hoja (report_items y sus archivos): report_id -> posiciones en rows (se consume solo lo nuevo)
+    return {"lock": threading.Lock(), "by_sheet": {}}
+
+def _items_in(sheet_name: str, rid: str) -> Tuple[List[dict], Optional[str]]:
+    e, err = _fresh_entry(sheet_name)
+    if e is None:
+        return [], err
+    ix = _items_index_state()
+    with _records_cache()["lock"], ix["lock"]:
+        si = ix["by_sheet"].get(sheet_name)
+        if si is None or si["entry"] is not e:
+            si = ix["by_sheet"][sheet_name] = {"entry": e, "consumed": 0, "by_report": {}}
+        raw = e["rows"]
+        c_rid = e["header"].index("report_id") if "report_id" in e["header"] else -1
+        for i in range(si["consumed"], len(raw)):
+            si["by_report"].setdefault(_col(raw[i], c_rid), []).append(i)
+        si["consumed"] = len(raw)
+        rows = _rows_to_records(e["header"], [raw[i] for i in si["by_report"].get(rid, [])])
+        rows += [r for r in e["pending_records"] if str(r.get("report_id", "")) == rid]
+    return rows, err
+
+def report_items_for(report_id) -> Tuple[List[dict], Optional[str]]:
+    """Solo las filas de report_items de un reporte (vía índice por report_id), con etiquetas decodificadas."""
+    rid = str(report_id)
+    backend = storage()
+    if backend.supports_queries:
+        try:
+            return backend.report_items(rid), None
+        except Exception as ex:
+            return [], f"No se pudieron leer los ítems del reporte: {ex}"
+    rows, err = _items_in("report_items", rid)
+    if rows:
+        return [decode_item_row(list(r.values())) for r in rows], err
+    # No está en la hoja viva: el mes sale del ID (YYYYMMDD-...); IDs antiguos recorren los archivos
+    months = archive_months()
+    month = f"{rid[:4]}-{rid[4:6]}" if re.match(r"^\d{8}-", rid) else ""
+    for m in ([month] if month in months else list(reversed(months))):
+        a_rows, a_err = _items_in(_archive_name("report_items", m), rid)
+        if a_rows or a_err:
+            return [decode_item_row(list(r.values())) for r in a_rows], err or a_err
+    return [], err
+
+# ---------------------------
+# ANALÍTICA DE FALLAS (report_items)
+# ---------------------------
+# report_items se lee por rangos de este tamaño (una llamada por bloque) y se guarda como columnas NumPy
+ANALYTICS_CHUNK_ROWS = int(st.secrets.get("ANALYTICS_CHUNK_ROWS", 20_000))
+ESTADOS_FALLA = ("OPERATIVO CON FALLA", "INOPERATIVO")
+
+def _sheet_rows_snapshot(sheet_name: str) -> Tuple[list, List[list], Optional[str]]:
+    # (header, filas como listas) sin armar dicts; la lista es una copia de referencias
+    e, err = _fresh_entry(sheet_name)
+    if e is None:
+        return [], [], err
+    with _records_cache()["lock"]:
+        return list(e["header"]), e["rows"] + e["pending"], err
+
+def _col(row: list, i: int) -> str:
+    return row[i] if 0 <= i < len(row) else ""
+
+def _day_ordinal(value) -> int:
+    # Ordinal del día de created_date; -1 si falta o no es una fecha válida (p.ej. '2026-02-30')
+    d = norm_date(value)
+    try:
+        return date.fromisoformat(d).toordinal() if d else -1
+    except ValueError:
+        return -1
+
+# Columna 3 de report_items: código (formato actual) o estado completo (formato anterior)
+_FALLA_VALUES = frozenset(ESTADOS_FALLA) | {ESTADO_CODES[e] for e in ESTADOS_FALLA}
+
+def _item_name(labels: Dict[str, str], row: list) -> str:
+    key = _col(row, 2)
+    name = labels.get(key)
+    if name is None:
+        lab = item_labels(key) if is_encoded_item_row(row) else None
+        name = labels[key] = lab[2] if lab else key
+    return name
+
+@st.cache_resource
+def _item_columns_state() -> dict:
+    # hoja de ítems -> {"lock", "cols"}: columnas codificadas (ver _refresh_item_columns)
+    return {"lock": threading.Lock(), "by_sheet": {}}
+
+def _new_item_columns(header: list) -> dict:
+    # rid/item: código por fila (índice en rid_codes/item_codes, en orden de aparición); fail: bool por fila
+    return {"header": header, "n": 0, "last": None, "ts": 0.0, "full_ts": time.time(),
+            "rid": np.empty(0, dtype=np.int32), "item": np.empty(0, dtype=np.int32), "fail": np.empty(0, dtype=bool),
+            "rid_codes": {}, "item_codes": {}, "labels": {}}
+
+def _refresh_item_columns(sheet_name: str, cols: Optional[dict]) -> dict:
+    """
+    Baja por rangos de ANALYTICS_CHUNK_ROWS las filas que faltan y las agrega como códigos enteros:
+    nunca está la hoja entera en memoria como texto. Se relee la última fila ya leída; si no coincide
+    (filas borradas o movidas, p.ej. el archivo mensual) se reconstruye desde cero.
+    """
+    backend = storage()
+    if cols is None:
+        header = backend.fetch_header(sheet_name)
+        if header and tuple(header) not in _ITEMS_LAYOUTS:
+            raise ValueError(f"La hoja '{sheet_name}' tiene otras columnas; se omite.")
+        cols = _new_item_columns(header)
+    if not cols["header"]:
+        cols["ts"] = time.time()  # hoja vacía
+        return cols
+    c_rid = cols["header"].index("report_id")
+    rid_codes, item_codes, labels = cols["rid_codes"], cols["item_codes"], cols["labels"]
+    parts = {"rid": [cols["rid"]], "item": [cols["item"]], "fail": [cols["fail"]]}
+    n, last = cols["n"], cols["last"]
+    while True:
+        start = max(0, n - 1)
+        chunk = backend.fetch_range(sheet_name, cols["header"], start, ANALYTICS_CHUNK_ROWS)
+        got = len(chunk)
+        if n:
+            if not chunk or tuple(_trim_row(chunk[0])) != last:
+                return _refresh_item_columns(sheet_name, _new_item_columns(cols["header"]))
+            chunk = chunk[1:]
+        k = len(chunk)
+        parts["rid"].append(np.fromiter((rid_codes.setdefault(_col(r, c_rid), len(rid_codes)) for r in chunk),
+                                        dtype=np.int32, count=k))
+        parts["item"].append(np.fromiter((item_codes.setdefault(_item_name(labels, r), len(item_codes)) for r in chunk),
+                                         dtype=np.int32, count=k))
+        parts["fail"].append(np.fromiter((_col(r, 3) in _FALLA_VALUES for r in chunk), dtype=bool, count=k))
+        if k:
+            n, last = n + k, tuple(_trim_row(chunk[-1]))
+        if got < ANALYTICS_CHUNK_ROWS:
+            break
+    cols.update({c: np.concatenate(v) for c, v in parts.items()})
+    cols.update(n=n, last=last, ts=time.time())
+    return cols
+
+def _item_columns(sheet_name: str) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    report_items (o un archivo mensual) como columnas NumPy, sin pasar por el cache de hojas.
+    La hoja viva baja solo lo nuevo cada RECORDS_CACHE_TTL y se relee entera cada FULL_SYNC_INTERVAL
+    (ediciones a mano); un archivo se revisa cada FULL_SYNC_INTERVAL. Devuelve una vista consistente.
+    """
+    ic = _item_columns_state()
+    with ic["lock"]:
+        sc = ic["by_sheet"].setdefault(sheet_name, {"lock": threading.Lock(), "cols": None})
+    # lock por hoja: solo esperan otras consultas de analítica de la misma hoja
+    with sc["lock"]:
+        cols, err = sc["cols"], None
+        ttl = RECORDS_CACHE_TTL if sheet_name == "report_items" else FULL_SYNC_INTERVAL
+        if cols is None or time.time() - cols["ts"] > ttl:
+            try:
+                if cols is not None and sheet_name == "report_items" and time.time() - cols["full_ts"] > FULL_SYNC_INTERVAL:
+                    cols = None
+                cols = sc["cols"] = _refresh_item_columns(sheet_name, cols)
+            except Exception as ex:
+                cols, err = sc["cols"], f"No se pudo leer la hoja '{sheet_name}': {ex}"
+        if cols is None:
+            return None, err
+        return {"rid": cols["rid"], "item": cols["item"], "fail": cols["fail"],
+                "rid_names": list(cols["rid_codes"]), "item_names": list(cols["item_codes"])}, err
 
-    users = sheet_records("users")
-    exists = any(u.get("username") == ADMIN_USER for u in users)
-    if not exists:
-        salt = os.urandom(16)
-        salt_b64 = base64.b64encode(salt).decode("utf-8")
-        pw_hash = hash_password(ADMIN_PASSWORD, salt)
-        append_row_sheet("users", [
-            ADMIN_USER, "Supervisor", "supervisor", 1, salt_b64, pw_hash,
-            datetime.now().isoformat(timespec="seconds")
-        ])
+def item_failure_stats(start: date, end: date) -> Tuple[dict, Optional[str]]:
+    """
+    Tasa de falla por equipo x ítem y tendencia semanal. report_items (hoja viva y archivos del rango)
+    se toma como columnas NumPy de códigos enteros (_item_columns), unidas a 'reports' con un índice
+    hash por report_id y procesadas por bloques.
+    """
+    rep_header, rep_rows, err = _partition_snapshot("reports", start, end)
 
-def auth_user(username: str, password: str):
-    username = username.strip()
-    users = sheet_records("users")
-    row = next((u for u in users if u.get("username") == username and int(u.get("active", 1)) == 1), None)
-    if not row:
-        return None
-    salt = base64.b64decode(row["salt"])
-    pw_hash = hash_password(password, salt)
-    if pw_hash != row["pw_hash"]:
-        return None
-    return {"username": row["username"], "full_name": row["full_name"], "role": row["role"]}
+    # Índice hash report_id -> posición; columnas de reports como arrays
+    c_id, c_eq, c_dt = (rep_header.index(c) if c in rep_header else -1 for c in ("report_id", "equipment_codigo", "created_date"))
+    equipos: Dict[str, int] = {}
+    rep_index: Dict[str, int] = {}
+    rep_eq = np.empty(len(rep_rows), dtype=np.int32)
+    rep_day = np.empty(len(rep_rows), dtype=np.int32)
+    d0, d1 = start.toordinal(), end.toordinal()
+    for i, r in enumerate(rep_rows):
+        rep_index[_col(r, c_id)] = i
+        rep_eq[i] = equipos.setdefault(_col(r, c_eq), len(equipos))
+        rep_day[i] = _day_ordinal(_col(r, c_dt))
 
-def create_user(username: str, full_name: str, password: str, role: str, active: bool):
-    username = username.strip()
-    users = sheet_records("users")
-    if any(u.get("username") == username for u in users):
-        raise ValueError("Ese usuario ya existe.")
+    items: Dict[str, int] = {}
+    cols = {"eq": [], "item": [], "day": [], "fail": []}
+    sheets = ["report_items"] + [_archive_name("report_items", m) for m in archive_months_in_range(start, end)]
+    for name in sheets:
+        ic, i_err = _item_columns(name)
+        err = err or i_err
+        if ic is None:
+            continue
+        # códigos de la hoja -> posición en reports / código global del ítem
+        rid_map = np.fromiter((rep_index.get(r, -1) for r in ic["rid_names"]), dtype=np.int64, count=len(ic["rid_names"]))
+        item_map = np.fromiter((items.setdefault(i, len(items)) for i in ic["item_names"]), dtype=np.int32,
+                               count=len(ic["item_names"]))
+        for off in range(0, len(ic["rid"]), ANALYTICS_CHUNK_ROWS):
+            rep_i = rid_map[ic["rid"][off:off + ANALYTICS_CHUNK_ROWS]]
+            keep = rep_i >= 0
+            rep_i = rep_i[keep]
+            day = rep_day[rep_i]
+            in_range = (day >= d0) & (day <= d1)
+            cols["eq"].append(rep_eq[rep_i][in_range])
+            cols["item"].append(item_map[ic["item"][off:off + ANALYTICS_CHUNK_ROWS][keep]][in_range])
+            cols["day"].append(day[in_range])
+            cols["fail"].append(ic["fail"][off:off + ANALYTICS_CHUNK_ROWS][keep][in_range])
 
-    salt = os.urandom(16)
-    salt_b64 = base64.b64encode(salt).decode("utf-8")
-    pw_hash = hash_password(password, salt)
+    eq_names = sorted(equipos, key=equipos.get)
+    item_names = sorted(items, key=items.get)
+    if not cols["eq"] or not sum(len(c) for c in cols["eq"]):
+        return {"equipos": eq_names, "items": item_names, "total": np.zeros((len(eq_names), len(item_names))),
+                "fails": np.zeros((len(eq_names), len(item_names))), "weeks": [], "n": 0}, err
 
-    append_row_sheet("users", [
-        username, full_name.strip(), role, 1 if active else 0,
-        salt_b64, pw_hash, datetime.now().isoformat(timespec="seconds")
-    ])
+    eq = np.concatenate(cols["eq"])
+    it = np.concatenate(cols["item"])
+    day = np.concatenate(cols["day"])
+    fail = np.concatenate(cols["fail"])
 
-def fetch_users():
-    users = sheet_records("users")
-    users.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-    out = []
-    for u in users:
-        out.append({
-            "username": u.get("username", ""),
-            "full_name": u.get("full_name", ""),
-            "role": u.get("role", ""),
-            "active": u.get("active", 1),
-            "created_at": u.get("created_at", ""),
-        })
-    return out
+    size = len(eq_names) * len(item_names)
+    flat = eq.astype(np.int64) * len(item_names) + it
+    total = np.bincount(flat, minlength=size).reshape(len(eq_names), len(item_names))
+    fails = np.bincount(flat, weights=fail, minlength=size).reshape(len(eq_names), len(item_names))
 
-# ---------------------------
-# LOGIC
-# ---------------------------
-def compute_result(items_estado: List[str]) -> Tuple[str, str]:
-    if any(s == "INOPERATIVO" for s in items_estado):
-        return ("INOPERATIVO", "NO APTO")
-    if any(s == "OPERATIVO CON FALLA" for s in items_estado):
-        return ("FALLA", "RESTRICCIONES")
-    return ("OPERATIVO", "APTO")
+    # Tendencia: semanas (lunes) desde el inicio del rango
+    week = (day - d0 + start.weekday()) // 7
+    w_total = np.bincount(week)
+    w_fails = np.bincount(week, weights=fail, minlength=len(w_total))
+    monday0 = start - timedelta(days=start.weekday())
+    weeks = [
+        {"semana": (monday0 + timedelta(weeks=int(w))).isoformat(), "ítems revisados": int(w_total[w]),
+         "fallas": int(w_fails[w]), "tasa de falla %": round(float(100.0 * w_fails[w] / w_total[w]), 2)}
+        for w in np.flatnonzero(w_total)
+    ]
+    return {"equipos": eq_names, "items": item_names, "total": total, "fails": fails, "weeks": weeks, "n": int(len(eq))}, err
 
 # ---------------------------
 # PDF (NO SE GUARDA, SOLO DESCARGA)
@@ -343,18 +3017,11 @@ STYLE_CENTER = ParagraphStyle("c", parent=STYLE_SMALL, alignment=TA_CENTER)
 STYLE_CENTER_W = ParagraphStyle("cw", parent=STYLE_CENTER, textColor=colors.white, fontName="Helvetica-Bold")
 STYLE_SMALL_B_W = ParagraphStyle("smbw", parent=STYLE_SMALL_B, textColor=colors.white, fontName="Helvetica-Bold")
 
-def _rl_img_from_path(path: str, w_mm: float, h_mm: float):
-    if not path or not os.path.exists(path):
-        return None
-    img = RLImage(path, width=w_mm * mm, height=h_mm * mm)
-    img.hAlign = "LEFT"
-    return img
-
-def _rl_img_from_bytes(img_bytes: bytes, w_mm: float, h_mm: float):
+def _rl_img_from_bytes(img_bytes: bytes, w_mm: float, h_mm: float, kind: str = "direct"):
     if not img_bytes:
         return None
-    bio = io.BytesIO(img_bytes)
-    return RLImage(ImageReader(bio), width=w_mm * mm, height=h_mm * mm)
+    # BytesIO directo (RLImage no acepta ImageReader en ReportLab 5)
+    return RLImage(io.BytesIO(img_bytes), width=w_mm * mm, height=h_mm * mm, kind=kind)
 
 def canvas_to_png_bytes(canvas_result) -> bytes:
     if canvas_result is None or canvas_result.image_data is None:
@@ -364,26 +3031,140 @@ def canvas_to_png_bytes(canvas_result) -> bytes:
     img.save(out, format="PNG")
     return out.getvalue()
 
-def upload_to_png_bytes(uploaded_file) -> bytes:
+# Fotos de evidencia: se reducen al tamaño de la celda del PDF (PHOTO_CELL_MM a PHOTO_DPI)
+# y se guardan como JPEG; el total por reporte no pasa de PHOTO_REPORT_BUDGET.
+PHOTO_CELL_MM = (80, 45)
+PHOTO_DPI = int(st.secrets.get("PHOTO_DPI", 150))
+PHOTO_JPEG_QUALITY = int(st.secrets.get("PHOTO_JPEG_QUALITY", 80))
+PHOTO_REPORT_BUDGET = int(st.secrets.get("PHOTO_REPORT_BUDGET", 2_000_000))
+
+def _photo_target_px(scale: float = 1.0) -> Tuple[int, int]:
+    w_mm, h_mm = PHOTO_CELL_MM
+    return (max(1, int(w_mm / 25.4 * PHOTO_DPI * scale)), max(1, int(h_mm / 25.4 * PHOTO_DPI * scale)))
+
+def prepare_photo_bytes(data: bytes, quality: int = PHOTO_JPEG_QUALITY, scale: float = 1.0) -> bytes:
+    tw, th = _photo_target_px(scale)
+    img = Image.open(io.BytesIO(data))
+    # JPEG: decodifica directamente a escala reducida (mucho más rápido que abrir 12 MP completos)
+    img.draft("RGB", (max(tw, th), max(tw, th)))
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    img.thumbnail((tw, th), Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=quality, optimize=True)
+    return out.getvalue()
+
+PHOTO_CACHE_MAX_BYTES = int(st.secrets.get("PHOTO_CACHE_MAX_BYTES", 20_000_000))
+
+def upload_to_photo_bytes(uploaded_file) -> bytes:
+    """
+    Convierte una sola vez por imagen distinta: LRU en la sesión con clave = hash del contenido
+    (+ parámetros de conversión), con tope de memoria PHOTO_CACHE_MAX_BYTES.
+    """
     if not uploaded_file:
         return b""
+    data = uploaded_file.getvalue()
+    key = f"{hashlib.sha256(data).hexdigest()}:{PHOTO_DPI}:{PHOTO_JPEG_QUALITY}"
+    cache = st.session_state.setdefault("_photo_cache", OrderedDict())
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+
     try:
-        data = uploaded_file.getvalue()
-        # normalizamos a PNG para que ReportLab no falle
-        img = Image.open(io.BytesIO(data)).convert("RGB")
-        out = io.BytesIO()
-        img.save(out, format="PNG")
-        return out.getvalue()
+        with perf_phase("fotos"):
+            out = prepare_photo_bytes(data)
     except Exception:
         return b""
+    cache[key] = out
+    used = sum(len(v) for v in cache.values())
+    while used > PHOTO_CACHE_MAX_BYTES and len(cache) > 1:
+        _, old = cache.popitem(last=False)
+        used -= len(old)
+    return out
+
+def fit_photos_to_budget(items: List[dict], budget: int = PHOTO_REPORT_BUDGET):
+    """
+    Si las fotos del reporte pasan el presupuesto, baja calidad y luego resolución (in place).
+    Cada paso se codifica desde la foto original (foto_src), no desde el JPEG del paso anterior.
+    """
+    steps = [(65, 1.0), (50, 1.0), (50, 0.75), (40, 0.5)]
+    sources = {}
+    for i, it in enumerate(items):
+        up = it.pop("foto_src", None)
+        if it.get("foto_bytes"):
+            sources[i] = up.getvalue() if up is not None else it["foto_bytes"]
+    for quality, scale in steps:
+        if sum(len(it.get("foto_bytes") or b"") for it in items) <= budget:
+            return
+        for i, data in sources.items():
+            items[i]["foto_bytes"] = prepare_photo_bytes(data, quality=quality, scale=scale)
+
+PDF_WORKERS = int(st.secrets.get("PDF_WORKERS", 2))
+
+@st.cache_resource
+def _pdf_static() -> dict:
+    # Partes inmutables del PDF, una vez por proceso: bytes del logo y TableStyles
+    logo_bytes = b""
+    if os.path.exists(LOGO_PATH):
+        with open(LOGO_PATH, "rb") as f:
+            logo_bytes = f.read()
+    return {
+        "logo_bytes": logo_bytes,
+        "header_style": TableStyle([
+            ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+            ("ALIGN", (0, 0), (0, 0), "LEFT"),
+            ("ALIGN", (1, 0), (1, 0), "CENTER"),
+            ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
+        ]),
+        "info_style": TableStyle([
+            ("BOX", (0, 0), (-1, -1), 1, colors.black),
+            ("INNERGRID", (0, 0), (-1, -1), 0.25, colors.grey),
+            ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+            ("LEFTPADDING", (0, 0), (-1, -1), 6),
+            ("RIGHTPADDING", (0, 0), (-1, -1), 6),
+            ("TOPPADDING", (0, 0), (-1, -1), 4),
+            ("BOTTOMPADDING", (0, 0), (-1, -1), 4),
+        ]),
+        "items_style": TableStyle([
+            ("BACKGROUND", (0, 0), (-1, 0), NAVY),
+            ("GRID", (0, 0), (-1, -1), 0.35, colors.grey),
+            ("VALIGN", (0, 0), (-1, -1), "TOP"),
+            ("LEFTPADDING", (0, 0), (-1, -1), 4),
+            ("RIGHTPADDING", (0, 0), (-1, -1), 4),
+            ("TOPPADDING", (0, 0), (-1, -1), 3),
+            ("BOTTOMPADDING", (0, 0), (-1, -1), 3),
+        ]),
+        "photos_style": TableStyle([
+            ("VALIGN", (0, 0), (-1, -1), "TOP"),
+            ("BOX", (0, 0), (-1, -1), 0.5, colors.lightgrey),
+            ("INNERGRID", (0, 0), (-1, -1), 0.5, colors.lightgrey),
+            ("LEFTPADDING", (0, 0), (-1, -1), 6),
+            ("RIGHTPADDING", (0, 0), (-1, -1), 6),
+            ("TOPPADDING", (0, 0), (-1, -1), 6),
+            ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
+        ]),
+    }
+
+@st.cache_resource
+def _pdf_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix="pdf")
 
-def generate_pdf_bytes(payload: dict) -> Tuple[bytes, str]:
+def _pdf_header_table(static: dict) -> Table:
+    logo = _rl_img_from_bytes(static["logo_bytes"], 35, 10)
+    if logo:
+        logo.hAlign = "LEFT"
+    tbl = Table([[logo if logo else "", Paragraph("CHECKLIST DE EQUIPO", STYLE_TITLE)]],
+                colWidths=[45 * mm, 135 * mm])
+    tbl.setStyle(static["header_style"])
+    return tbl
+
+def generate_pdf_bytes(payload: dict, static: Optional[dict] = None) -> Tuple[bytes, str]:
     """
     Genera PDF en memoria (bytes). Incluye:
     - Tabla checklist
     - Observaciones
     - Firma operador
     - Fotos adjuntas (solo ítems con evidencia), desde bytes
+    static: partes fijas ya armadas (procesos hijos de la exportación masiva no usan st.cache_resource).
     """
     buffer = io.BytesIO()
     doc = SimpleDocTemplate(
@@ -393,15 +3174,8 @@ def generate_pdf_bytes(payload: dict) -> Tuple[bytes, str]:
     )
     story = []
 
-    logo = _rl_img_from_path(LOGO_PATH, 35, 10)
-    header_tbl = Table([[logo if logo else "", Paragraph("CHECKLIST DE EQUIPO", STYLE_TITLE)]],
-                       colWidths=[45 * mm, 135 * mm])
-    header_tbl.setStyle(TableStyle([
-        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-        ("ALIGN", (0, 0), (0, 0), "LEFT"),
-        ("ALIGN", (1, 0), (1, 0), "CENTER"),
-        ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
-    ]))
+    static = static or _pdf_static()
+    header_tbl = _pdf_header_table(static)
     story.append(header_tbl)
 
     info = [
@@ -416,15 +3190,7 @@ def generate_pdf_bytes(payload: dict) -> Tuple[bytes, str]:
          Paragraph("", STYLE_SMALL)],
     ]
     info_tbl = Table(info, colWidths=[70 * mm, 55 * mm, 55 * mm])
-    info_tbl.setStyle(TableStyle([
-        ("BOX", (0, 0), (-1, -1), 1, colors.black),
-        ("INNERGRID", (0, 0), (-1, -1), 0.25, colors.grey),
-        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-        ("LEFTPADDING", (0, 0), (-1, -1), 6),
-        ("RIGHTPADDING", (0, 0), (-1, -1), 6),
-        ("TOPPADDING", (0, 0), (-1, -1), 4),
-        ("BOTTOMPADDING", (0, 0), (-1, -1), 4),
-    ]))
+    info_tbl.setStyle(static["info_style"])
     story.append(info_tbl)
     story.append(Spacer(1, 6 * mm))
 
@@ -444,15 +3210,7 @@ def generate_pdf_bytes(payload: dict) -> Tuple[bytes, str]:
         ])
 
     tbl = Table(data, colWidths=[55 * mm, 65 * mm, 30 * mm, 35 * mm], repeatRows=1)
-    tbl.setStyle(TableStyle([
-        ("BACKGROUND", (0, 0), (-1, 0), NAVY),
-        ("GRID", (0, 0), (-1, -1), 0.35, colors.grey),
-        ("VALIGN", (0, 0), (-1, -1), "TOP"),
-        ("LEFTPADDING", (0, 0), (-1, -1), 4),
-        ("RIGHTPADDING", (0, 0), (-1, -1), 4),
-        ("TOPPADDING", (0, 0), (-1, -1), 3),
-        ("BOTTOMPADDING", (0, 0), (-1, -1), 3),
-    ]))
+    tbl.setStyle(static["items_style"])
     story.append(tbl)
 
     story.append(Spacer(1, 4 * mm))
@@ -462,7 +3220,7 @@ def generate_pdf_bytes(payload: dict) -> Tuple[bytes, str]:
     fotos = [(it["item"], it["seccion"], it.get("foto_bytes") or b"") for it in payload["items"] if it.get("foto_bytes")]
     if fotos:
         story.append(PageBreak())
-        story.append(header_tbl)
+        story.append(_pdf_header_table(static))
         story.append(Paragraph("Fotos adjuntas (solo ítems con evidencia)", STYLE_H2))
         story.append(Spacer(1, 2 * mm))
 
@@ -471,7 +3229,7 @@ def generate_pdf_bytes(payload: dict) -> Tuple[bytes, str]:
         for (item_name, sec, bts) in fotos:
             cell_story = []
             cell_story.append(Paragraph(f"<b>{item_name}</b><br/>{sec}", STYLE_SMALL))
-            img = _rl_img_from_bytes(bts, 80, 45)
+            img = _rl_img_from_bytes(bts, PHOTO_CELL_MM[0], PHOTO_CELL_MM[1], kind="proportional")
             if img:
                 cell_story.append(Spacer(1, 2 * mm))
                 cell_story.append(img)
@@ -486,15 +3244,7 @@ def generate_pdf_bytes(payload: dict) -> Tuple[bytes, str]:
             grid.append(row)
 
         photo_tbl = Table(grid, colWidths=[90 * mm, 90 * mm])
-        photo_tbl.setStyle(TableStyle([
-            ("VALIGN", (0, 0), (-1, -1), "TOP"),
-            ("BOX", (0, 0), (-1, -1), 0.5, colors.lightgrey),
-            ("INNERGRID", (0, 0), (-1, -1), 0.5, colors.lightgrey),
-            ("LEFTPADDING", (0, 0), (-1, -1), 6),
-            ("RIGHTPADDING", (0, 0), (-1, -1), 6),
-            ("TOPPADDING", (0, 0), (-1, -1), 6),
-            ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
-        ]))
+        photo_tbl.setStyle(static["photos_style"])
         story.append(photo_tbl)
 
     # Firma operador (al final)
@@ -511,6 +3261,354 @@ def generate_pdf_bytes(payload: dict) -> Tuple[bytes, str]:
     fname = f"CHECKLIST_{payload['equipment_codigo']}_{payload['created_date']}.pdf"
     return pdf_bytes, fname
 
+# ---------------------------
+# ALMACÉN DE ARCHIVOS (firmas, fotos, PDFs) direccionado por contenido
+# ---------------------------
+ARTIFACTS_DIR = st.secrets.get("ARTIFACTS_DIR", os.path.join("data", "artifacts"))
+ARTIFACTS_MAX_BYTES = int(st.secrets.get("ARTIFACTS_MAX_BYTES", 2_000_000_000))
+# compact_artifacts no toca archivos más nuevos que esto (.tmp en escritura, blobs aún sin indexar)
+ARTIFACTS_GRACE_S = int(st.secrets.get("ARTIFACTS_GRACE_S", 3600))
+
+def _artifacts_conn() -> sqlite3.Connection:
+    os.makedirs(os.path.join(ARTIFACTS_DIR, "blobs"), exist_ok=True)
+    conn = sqlite3.connect(os.path.join(ARTIFACTS_DIR, "index.sqlite3"), timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, last_access REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS artifacts (
+            report_id TEXT NOT NULL, kind TEXT NOT NULL, name TEXT NOT NULL,
+            sha256 TEXT NOT NULL, created_at REAL NOT NULL,
+            PRIMARY KEY (report_id, kind, name)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS artifacts_sha ON artifacts (sha256)")
+    return conn
+
+def _blob_path(sha: str) -> str:
+    return os.path.join(ARTIFACTS_DIR, "blobs", sha[:2], sha)
+
+def put_blob(conn: sqlite3.Connection, data: bytes) -> str:
+    """
+    Guarda bytes con clave SHA-256; si ya existen (misma foto/firma) no se vuelven a escribir.
+    Va dentro de una transacción BEGIN IMMEDIATE: ver si el archivo existe y anotar la fila es atómico
+    frente a evict/compact, que borran archivos con el mismo lock de escritura tomado.
+    """
+    sha = hashlib.sha256(data).hexdigest()
+    path = _blob_path(sha)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    conn.execute(
+        "INSERT INTO blobs (sha256, size, last_access) VALUES (?, ?, ?) "
+        "ON CONFLICT(sha256) DO UPDATE SET last_access = excluded.last_access",
+        (sha, len(data), time.time()),
+    )
+    return sha
+
+def store_report_artifacts(report_id, artifacts: List[Tuple[str, str, bytes]]):
+    """artifacts: [(kind, name, bytes)] -> blobs deduplicados + índice por report_id."""
+    conn = _artifacts_conn()
+    try:
+        # blobs + referencias en una transacción: compactar nunca ve un blob recién escrito sin su referencia
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for kind, name, data in artifacts:
+                if not data:
+                    continue
+                sha = put_blob(conn, data)
+                conn.execute(
+                    "INSERT OR REPLACE INTO artifacts (report_id, kind, name, sha256, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (str(report_id), kind, name, sha, time.time()),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        evict_artifacts(conn)
+    finally:
+        conn.close()
+
+def list_report_artifacts(report_id, kind: Optional[str] = None) -> List[dict]:
+    conn = _artifacts_conn()
+    try:
+        q = "SELECT a.kind, a.name, a.sha256, b.size FROM artifacts a JOIN blobs b USING (sha256) WHERE a.report_id = ?"
+        args = [str(report_id)]
+        if kind:
+            q += " AND a.kind = ?"
+            args.append(kind)
+        return [dict(zip(("kind", "name", "sha256", "size"), r)) for r in conn.execute(q + " ORDER BY a.kind, a.name", args)]
+    finally:
+        conn.close()
+
+def get_blob(sha: str) -> bytes:
+    path = _blob_path(sha)
+    if not os.path.exists(path):
+        return b""
+    with open(path, "rb") as f:
+        data = f.read()
+    conn = _artifacts_conn()
+    try:
+        conn.execute("UPDATE blobs SET last_access = ? WHERE sha256 = ?", (time.time(), sha))
+    finally:
+        conn.close()
+    return data
+
+def evict_artifacts(conn: sqlite3.Connection, max_bytes: int = ARTIFACTS_MAX_BYTES) -> int:
+    """
+    Si el almacén pasa max_bytes, borra los blobs menos usados (y sus referencias). Devuelve bytes liberados.
+    Los archivos se borran con el lock de escritura tomado: un put_blob concurrente del mismo contenido
+    espera y, al no encontrar el archivo, lo vuelve a escribir.
+    """
+    freed = 0
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total > max_bytes:
+            for sha, size in conn.execute("SELECT sha256, size FROM blobs ORDER BY last_access").fetchall():
+                if total - freed <= max_bytes:
+                    break
+                conn.execute("DELETE FROM artifacts WHERE sha256 = ?", (sha,))
+                conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha,))
+                try:
+                    os.remove(_blob_path(sha))
+                except FileNotFoundError:
+                    pass
+                freed += size
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return freed
+
+def compact_artifacts() -> dict:
+    """
+    Limpieza: blobs sin referencias, archivos sin fila en el índice (p.ej. .tmp de un corte)
+    y filas cuyo archivo ya no existe. Luego VACUUM del índice.
+    Los archivos se listan sin lock; se confirman y borran dentro de BEGIN IMMEDIATE (como evict).
+    Nada más nuevo que ARTIFACTS_GRACE_S se toca: puede ser una escritura en curso.
+    """
+    conn = _artifacts_conn()
+    out = {"blobs_sin_uso": 0, "archivos_huerfanos": 0, "filas_sin_archivo": 0}
+    cutoff = time.time() - ARTIFACTS_GRACE_S
+    try:
+        blobs_dir = os.path.join(ARTIFACTS_DIR, "blobs")
+        old_files = []
+        for sub in os.listdir(blobs_dir):
+            for fname in os.listdir(os.path.join(blobs_dir, sub)):
+                path = os.path.join(blobs_dir, sub, fname)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        old_files.append((fname, path))
+                except FileNotFoundError:
+                    pass
+        missing = [sha for (sha,) in conn.execute("SELECT sha256 FROM blobs") if not os.path.exists(_blob_path(sha))]
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for (sha,) in conn.execute(
+                "SELECT sha256 FROM blobs WHERE last_access < ? AND sha256 NOT IN (SELECT DISTINCT sha256 FROM artifacts)",
+                (cutoff,),
+            ).fetchall():
+                conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha,))
+                try:
+                    os.remove(_blob_path(sha))
+                except FileNotFoundError:
+                    pass
+                out["blobs_sin_uso"] += 1
+
+            known = {sha for (sha,) in conn.execute("SELECT sha256 FROM blobs")}
+            for fname, path in old_files:
+                if fname not in known:
+                    try:
+                        os.remove(path)
+                        out["archivos_huerfanos"] += 1
+                    except FileNotFoundError:
+                        pass
+
+            for sha in missing:
+                if sha in known and not os.path.exists(_blob_path(sha)):
+                    conn.execute("DELETE FROM artifacts WHERE sha256 = ?", (sha,))
+                    conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha,))
+                    out["filas_sin_archivo"] += 1
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    return out
+
+def artifacts_stats() -> dict:
+    conn = _artifacts_conn()
+    try:
+        n, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        reports = conn.execute("SELECT COUNT(DISTINCT report_id) FROM artifacts").fetchone()[0]
+    finally:
+        conn.close()
+    return {"blobs": n, "bytes": size, "reports": reports}
+
+def artifact_download_buttons(report_id, kinds: Tuple[str, ...] = ("pdf", "firma", "foto"), key_prefix: str = "art"):
+    mimes = {"pdf": "application/pdf", "firma": "image/png", "foto": "image/jpeg"}
+    arts = [a for a in list_report_artifacts(report_id) if a["kind"] in kinds]
+    if not arts:
+        st.caption("No hay archivos guardados para este reporte en este servidor.")
+        return
+    for a in arts:
+        # data diferida: el archivo se lee (y se marca su uso) solo al hacer clic, no en cada rerun
+        st.download_button(
+            f"⬇️ {a['name']} ({a['size'] // 1024} KB)",
+            data=lambda sha=a["sha256"]: get_blob(sha),
+            file_name=a["name"],
+            mime=mimes.get(a["kind"], "application/octet-stream"),
+            key=f"{key_prefix}_{report_id}_{a['kind']}_{a['name']}",
+        )
+
+# ---------------------------
+# EXPORTACIÓN MASIVA DE PDFs (ZIP)
+# ---------------------------
+BULK_EXPORT_MAX_REPORTS = int(st.secrets.get("BULK_EXPORT_MAX_REPORTS", 500))
+BULK_EXPORT_WORKERS = int(st.secrets.get("BULK_EXPORT_WORKERS", os.cpu_count() or 2))
+# La descarga entrega el ZIP completo en memoria (st.download_button no hace streaming): tope de tamaño
+BULK_EXPORT_MAX_BYTES = int(st.secrets.get("BULK_EXPORT_MAX_BYTES", 200_000_000))
+# ZIPs en EXPORTS_DIR/<sesión>/: se borran al descargarlos o tras BULK_EXPORT_TTL_S sin descargar
+BULK_EXPORT_TTL_S = int(st.secrets.get("BULK_EXPORT_TTL_S", 3600))
+EXPORTS_DIR = st.secrets.get("EXPORTS_DIR", os.path.join("data", "exports"))
+
+_PDF_WORKER_STATIC: Optional[dict] = None
+
+def _init_pdf_worker(static: dict):
+    global _PDF_WORKER_STATIC
+    _PDF_WORKER_STATIC = static
+
+def _render_pdf_job(payload: dict) -> Tuple[str, bytes, str]:
+    pdf_bytes, fname = generate_pdf_bytes(payload, static=_PDF_WORKER_STATIC)
+    return str(payload["report_id"]), pdf_bytes, fname
+
+def payload_from_sheet(rep: dict, items: List[dict]) -> dict:
+    """Rearma el payload de generate_pdf_bytes desde reports + report_items (sin fotos ni firma)."""
+    return {
+        "report_id": rep.get("report_id", ""),
+        "created_at": rep.get("created_at", ""),
+        "created_date": norm_date(rep.get("created_date")) or rep.get("created_date", ""),
+        "equipment_tipo": rep.get("equipment_tipo", ""),
+        "equipment_codigo": rep.get("equipment_codigo", ""),
+        "equipment_nombre": rep.get("equipment_nombre", ""),
+        "horometro": rep.get("horometro_inicial", ""),
+        "operador_user": rep.get("operador_user", ""),
+        "operador_nombre": rep.get("operador_nombre", ""),
+        "obs_general": rep.get("observaciones_generales", ""),
+        "estado_general": rep.get("estado_general", ""),
+        "resultado_final": rep.get("resultado_final", ""),
+        "firma_operador_bytes": b"",
+        "items": [
+            {"seccion": it.get("seccion", ""), "item": it.get("item", ""), "estado": it.get("estado", ""),
+             "observacion": it.get("observacion", "")}
+            for it in items
+        ],
+    }
+
+def _pdf_process_pool(static: dict) -> ProcessPoolExecutor:
+    # spawn: procesos nuevos que importan este módulo y corren sus funciones de nivel de módulo.
+    # fork copiaría el servidor con sus hilos (cola, pool de claves, sesiones gspread) y algún
+    # lock tomado en ese instante podría dejar al hijo bloqueado para siempre.
+    return ProcessPoolExecutor(max_workers=BULK_EXPORT_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_pdf_worker, initargs=(static,))
+
+def export_reports_zip(reports: List[dict], zip_path: str, progress=None,
+                       max_bytes: int = BULK_EXPORT_MAX_BYTES) -> int:
+    """
+    Renderiza los PDFs en paralelo (procesos) y los escribe uno a uno en un ZIP en disco.
+    Hay como máximo 2 x workers PDFs en memoria a la vez. Al llegar a max_bytes deja de agregar.
+    Devuelve cuántos PDFs se escribieron.
+    """
+    static = _pdf_static()
+    jobs = iter(reports)
+    done = written = 0
+    with _pdf_process_pool(static) as pool, zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_STORED) as zf:
+        inflight = set()
+
+        def submit_next() -> bool:
+            rep = next(jobs, None)
+            if rep is None:
+                return False
+            stored = list_report_artifacts(rep.get("report_id", ""), kind="pdf")
+            if stored:  # PDF original (con fotos y firma) ya guardado: no se re-renderiza
+                fut = Future()
+                fut.set_result((str(rep.get("report_id", "")), get_blob(stored[0]["sha256"]), stored[0]["name"]))
+                inflight.add(fut)
+                return True
+            items, err = report_items_for(rep.get("report_id", ""))
+            if err:
+                raise RuntimeError(err)
+            inflight.add(pool.submit(_render_pdf_job, payload_from_sheet(rep, items)))
+            return True
+
+        for _ in range(2 * BULK_EXPORT_WORKERS):
+            if not submit_next():
+                break
+        while inflight:
+            finished, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                report_id, pdf_bytes, fname = fut.result()
+                if written + len(pdf_bytes) > max_bytes and done:
+                    for f in inflight:
+                        f.cancel()
+                    return done
+                zf.writestr(f"{report_id}_{fname}", pdf_bytes)
+                done += 1
+                written += len(pdf_bytes)
+                if progress:
+                    progress(done, len(reports))
+                submit_next()
+    return done
+
+def _session_exports_dir() -> str:
+    # Cada sesión escribe en su carpeta: los ZIPs de un supervisor no quedan al alcance de otros
+    sid = st.session_state.setdefault("_exports_sid", secrets.token_hex(8))
+    return os.path.join(EXPORTS_DIR, sid)
+
+def cleanup_exports(max_age_s: int = BULK_EXPORT_TTL_S) -> int:
+    """Borra ZIPs de más de max_age_s (sesiones que no descargaron) y carpetas vacías. Devuelve cuántos."""
+    if not os.path.isdir(EXPORTS_DIR):
+        return 0
+    cutoff = time.time() - max_age_s
+    removed = 0
+    for sub in os.listdir(EXPORTS_DIR):
+        d = os.path.join(EXPORTS_DIR, sub)
+        if not os.path.isdir(d):
+            continue
+        for fname in os.listdir(d):
+            path = os.path.join(d, fname)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(d)  # solo si quedó vacía
+        except OSError:
+            pass
+    return removed
+
+def _take_export(zip_path: str) -> bytes:
+    # Se llama al hacer clic en descargar: lee el ZIP y lo borra del servidor
+    try:
+        with open(zip_path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return b""
+    os.remove(zip_path)
+    return data
+
 # ---------------------------
 # UI
 # ---------------------------
@@ -536,7 +3634,11 @@ def login_ui():
         ok = st.form_submit_button("Ingresar")
 
     if ok:
-        user = auth_user(u, p)
+        try:
+            user = auth_user(u, p, client_ip=_client_ip())
+        except Exception as e:
+            st.error(str(e))
+            return
         if not user:
             st.error("Usuario o clave incorrectos.")
             return
@@ -545,9 +3647,92 @@ def login_ui():
         st.session_state["full_name"] = user["full_name"]
         st.rerun()
 
+def reports_browser():
+    f1, f2, f3, f4 = st.columns([1, 1.4, 1.6, 1.6])
+    equipo = f1.selectbox("Equipo", ["(todos)"] + [e["codigo"] for e in EQUIPOS], key="rb_eq")
+    operador = f2.text_input("Operador (nombre o usuario)", key="rb_op")
+    resultados = f3.multiselect("Resultado", RESULTADOS, key="rb_res")
+    rango = f4.date_input("Fechas", value=(), key="rb_dates")
+    start, end = (rango[0], rango[-1]) if isinstance(rango, (list, tuple)) and rango else (None, None)
+
+    g1, g2, g3 = st.columns([3, 1, 1])
+    columns = g1.multiselect("Columnas", REPORTS_HEADERS, default=REPORTS_BROWSER_COLUMNS, key="rb_cols")
+    page_size = g2.selectbox("Filas por página", [25, 50, 100, 200], index=1, key="rb_ps")
+    page = g3.number_input("Página", min_value=1, step=1, value=1, key="rb_page")
+
+    filters = dict(
+        equipo="" if equipo == "(todos)" else equipo, operador=operador, resultados=resultados,
+        start=start, end=end, columns=columns or None, page_size=int(page_size),
+    )
+    page = int(page)
+    rows, total, err = query_reports(page=page, **filters)
+    pages = max(1, (total + page_size - 1) // page_size)
+    if page > pages:  # los filtros achicaron el resultado: se pide la última página que existe
+        page = pages
+        rows, total, err = query_reports(page=page, **filters)
+    if err:
+        st.error(err)
+    if not total:
+        st.info("Aún no hay reportes." if not (equipo != "(todos)" or operador or resultados or start) else "Sin resultados para esos filtros.")
+        return
+
+    st.caption(f"{total} reportes · página {page} de {pages}")
+    st.dataframe(rows, use_container_width=True, hide_index=True)
+
+    ids = [str(r.get("report_id", "")) for r in rows if r.get("report_id", "") != ""]
+    if ids:
+        rid = st.selectbox("Ver ítems del reporte", ["—"] + ids, key="rb_drill")
+        if rid != "—":
+            items, err = report_items_for(rid)
+            if err:
+                st.error(err)
+            st.dataframe(items, use_container_width=True, hide_index=True)
+            artifact_download_buttons(rid, key_prefix="rb_art")
+
+    if storage().name == "sheets" and ARCHIVE_KEEP_MONTHS > 0:
+        with st.expander("Archivo mensual (hojas reports_AAAA_MM)"):
+            months = archive_months()
+            st.write(f"Hojas vivas: desde {archive_cutoff()} · meses archivados: {', '.join(months) or 'ninguno'}")
+            st.caption("Sin rango de fechas se consulta solo la ventana viva; con fechas se incluyen los meses archivados.")
+            ob = _outbox_worker()
+            if ob["archive_error"]:
+                st.warning(f"Última pasada automática: {ob['archive_error']}")
+            if st.button("🗄️ Archivar meses antiguos ahora", key="rb_archive"):
+                try:
+                    moved = archive_old_months()
+                    st.success(f"Archivado: {moved}" if moved else "Nada que archivar.")
+                except Exception as e:
+                    st.error(f"No se pudo archivar: {e}")
+
+    if storage().name == "sheets":
+        with st.expander("Migración de report_items (etiquetas completas → códigos)"):
+            st.caption("Solo hace falta si report_items o sus archivos mensuales tienen el formato anterior. "
+                       "Reescribe las filas en su lugar; corre en una sola réplica a la vez y se puede repetir.")
+            if st.button("🔁 Migrar report_items a códigos", key="rb_migrate"):
+                try:
+                    migrated = migrate_report_items()
+                    st.success(f"Filas migradas: {migrated}" if migrated else "No hay hojas con el formato anterior.")
+                except Exception as e:
+                    st.error(f"No se pudo migrar: {e}")
+
+    with st.expander("Archivos guardados en el servidor"):
+        stats = artifacts_stats()
+        st.write(f"{stats['reports']} reportes · {stats['blobs']} archivos únicos · {stats['bytes'] / 1e6:.1f} MB")
+        if st.button("🧹 Compactar almacén", key="rb_compact"):
+            st.write(compact_artifacts())
+
 def supervisor_panel():
     st.subheader(f"🧑‍💼 Supervisor: {st.session_state.get('full_name','')}")
-    tabs = st.tabs(["Usuarios", "Reportes (Sheet)", "Panel de control"])
+
+    ob = outbox_stats()
+    q1, q2, q3 = st.columns(3)
+    q1.metric("Reportes en cola (sin subir a Sheets)", ob["pending"])
+    q2.metric("Antigüedad del más viejo", f"{ob['oldest_age_s']} s")
+    q3.metric("Subidos por este servidor", ob["flushed"])
+    if ob["last_error"]:
+        st.warning(f"Reintentando envío a Sheets (intentos: {ob['max_attempts']}): {ob['last_error']}")
+
+    tabs = st.tabs(["Usuarios", "Reportes (Sheet)", "Panel de control", "Fallas por ítem", "Exportar PDFs"])
 
     with tabs[0]:
         st.markdown("## Crear usuario")
@@ -574,54 +3759,156 @@ def supervisor_panel():
 
     with tabs[1]:
         st.markdown("## Reportes guardados en Sheets")
-        reps = sheet_records("reports")
-        if not reps:
-            st.info("Aún no hay reportes.")
-        else:
-            st.dataframe(reps, use_container_width=True)
+        reports_browser()
 
     with tabs[2]:
-        st.markdown("## Panel de control (desde Sheets)")
-
-        rango = st.selectbox("Rango", ["Diario", "Semanal", "Mensual"], index=0)
-        today = date.today()
-        if rango == "Diario":
-            start = today
-        elif rango == "Semanal":
-            start = today - timedelta(days=7)
-        else:
-            start = today - timedelta(days=30)
+        control_panel()
 
-        reps = sheet_records("reports")
-        rows = []
-        for r in reps:
-            try:
-                dte = (r.get("created_date") or "").strip()
-                if dte and dte >= start.isoformat():
-                    rows.append(r)
-            except Exception:
-                pass
+    with tabs[3]:
+        failure_analytics_panel()
 
-        total = len(rows)
-        operadores = len(set(r.get("operador_nombre","") for r in rows if r.get("operador_nombre"))) if rows else 0
-        equipos_con_envio = len(set(r.get("equipment_codigo","") for r in rows if r.get("equipment_codigo"))) if rows else 0
-        total_equipos = len(EQUIPOS)
-        equipos_sin_envio = total_equipos - equipos_con_envio
+    with tabs[4]:
+        bulk_export_panel()
 
-        c1, c2, c3, c4 = st.columns(4)
-        c1.metric("Informes", total)
-        c2.metric("Operadores con envíos", operadores)
-        c3.metric("Equipos con envíos", equipos_con_envio)
-        c4.metric("Equipos sin envío", equipos_sin_envio)
+def bulk_export_panel():
+    st.markdown("## Exportar PDFs históricos (ZIP)")
+    st.caption("Se usa el PDF original si está guardado en este servidor; si no, se regenera desde Sheets (sin fotos ni firma).")
+    today = date.today()
+    f1, f2 = st.columns([2, 1])
+    picked = f1.date_input("Desde / hasta", value=(today.replace(day=1), today), key="bx_dates")
+    equipo = f2.selectbox("Equipo", ["(todos)"] + [e["codigo"] for e in EQUIPOS], key="bx_eq")
+    if not isinstance(picked, (list, tuple)) or len(picked) != 2:
+        st.info("Selecciona fecha inicial y final.")
+        return
 
-        res_counts = {"APTO": 0, "RESTRICCIONES": 0, "NO APTO": 0}
-        for r in rows:
-            k = (r.get("resultado_final") or "").strip()
-            if k in res_counts:
-                res_counts[k] += 1
+    reps, total, err = query_reports(
+        equipo="" if equipo == "(todos)" else equipo, start=picked[0], end=picked[1],
+        columns=REPORTS_HEADERS, page=1, page_size=BULK_EXPORT_MAX_REPORTS,
+    )
+    if err:
+        st.error(err)
+    st.write(f"Reportes en el rango: **{total}**")
+    if total > BULK_EXPORT_MAX_REPORTS:
+        st.warning(f"Se exportarán solo los {BULK_EXPORT_MAX_REPORTS} más recientes. Acota el rango.")
+
+    if reps and st.button("📦 Generar ZIP", key="bx_go"):
+        prev = st.session_state.pop("bx_zip", None)
+        if prev and os.path.exists(prev[0]):
+            os.remove(prev[0])
+        cleanup_exports()
+        out_dir = _session_exports_dir()
+        os.makedirs(out_dir, exist_ok=True)
+        zip_name = f"CHECKLISTS_{equipo if equipo != '(todos)' else 'TODOS'}_{picked[0]}_{picked[1]}.zip"
+        zip_path = os.path.join(out_dir, f"{secrets.token_hex(8)}_{zip_name}")
+        bar = st.progress(0.0, text="Generando PDFs…")
+        try:
+            n = export_reports_zip(reps, zip_path, progress=lambda d, t: bar.progress(d / t, text=f"{d}/{t} PDFs"))
+        except Exception as e:
+            if os.path.exists(zip_path):
+                os.remove(zip_path)
+            st.error(f"Error exportando: {e}")
+            return
+        st.session_state["bx_zip"] = (zip_path, zip_name, n, len(reps))
+
+    saved = st.session_state.get("bx_zip")
+    if saved and os.path.exists(saved[0]):
+        zip_path, zip_name, n, wanted = saved
+        if n < wanted:
+            st.warning(f"El ZIP llegó al tope de {BULK_EXPORT_MAX_BYTES // 1_000_000} MB: incluye {n} de {wanted} PDFs. "
+                       "Acota el rango para exportar el resto.")
+        st.caption(f"El ZIP se borra del servidor al descargarlo (o en {BULK_EXPORT_TTL_S // 60} min).")
+        st.download_button(f"⬇️ Descargar ZIP ({n} PDFs)", data=lambda: _take_export(zip_path), file_name=zip_name,
+                           mime="application/zip", key="bx_dl")
+
+def control_panel():
+    st.markdown("## Panel de control (desde Sheets)")
+
+    rango = st.selectbox("Rango", ["Diario", "Semanal", "Mensual", "Personalizado"], index=0)
+    today = date.today()
+    end = today
+    if rango == "Diario":
+        start = today
+    elif rango == "Semanal":
+        start = today - timedelta(days=7)
+    elif rango == "Mensual":
+        start = today - timedelta(days=30)
+    else:
+        picked = st.date_input("Desde / hasta", value=(today - timedelta(days=30), today))
+        if not isinstance(picked, (list, tuple)) or len(picked) != 2:
+            st.info("Selecciona fecha inicial y final.")
+            return
+        start, end = picked
+
+    summary, err = rollup_summary(start, end)
+    if err:
+        st.error(err)
+
+    total = summary["total"]
+    operadores = summary["operadores"]
+    equipos_con_envio = summary["equipos_con_envio"]
+    total_equipos = len(EQUIPOS)
+    equipos_sin_envio = max(0, total_equipos - equipos_con_envio)
+
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Informes", total)
+    c2.metric("Operadores con envíos", operadores)
+    c3.metric("Equipos con envíos", equipos_con_envio)
+    c4.metric("Equipos sin envío", equipos_sin_envio)
+
+    res_counts = summary["resultados"]
+
+    st.markdown("### Resumen Resultados")
+    st.write(f"✅ APTO: **{res_counts['APTO']}**  |  ⚠️ RESTRICCIONES: **{res_counts['RESTRICCIONES']}**  |  ⛔ NO APTO: **{res_counts['NO APTO']}**")
+
+    if summary["por_equipo"]:
+        st.markdown("### Por equipo")
+        st.dataframe([
+            {"equipo": eq, **cnt, "total": sum(cnt.values())}
+            for eq, cnt in sorted(summary["por_equipo"].items())
+        ], use_container_width=True, hide_index=True)
 
-        st.markdown("### Resumen Resultados")
-        st.write(f"✅ APTO: **{res_counts['APTO']}**  |  ⚠️ RESTRICCIONES: **{res_counts['RESTRICCIONES']}**  |  ⛔ NO APTO: **{res_counts['NO APTO']}**")
+def failure_analytics_panel():
+    st.markdown("## Fallas por equipo e ítem")
+    today = date.today()
+    f1, f2 = st.columns([2, 1])
+    picked = f1.date_input("Desde / hasta", value=(today - timedelta(days=90), today), key="fa_dates")
+    min_n = f2.number_input("Mínimo de revisiones", min_value=1, value=3, step=1, key="fa_min")
+    if not isinstance(picked, (list, tuple)) or len(picked) != 2:
+        st.info("Selecciona fecha inicial y final.")
+        return
+
+    stats, err = item_failure_stats(picked[0], picked[1])
+    if err:
+        st.error(err)
+    if not stats["n"]:
+        st.info("No hay ítems revisados en ese rango.")
+        return
+
+    total, fails = stats["total"], stats["fails"]
+    cells = [
+        {"equipo": stats["equipos"][i], "ítem": stats["items"][j],
+         "tasa de falla %": round(float(100.0 * fails[i, j] / total[i, j]), 1),
+         "fallas": int(fails[i, j]), "revisiones": int(total[i, j])}
+        for i, j in zip(*np.nonzero(total >= min_n))
+    ]
+    if not cells:
+        st.info("Ningún ítem alcanza el mínimo de revisiones.")
+        return
+
+    heat = alt.Chart(alt.Data(values=cells)).mark_rect().encode(
+        x=alt.X("equipo:N", title="Equipo"),
+        y=alt.Y("ítem:N", title=None, sort="-color"),
+        color=alt.Color("tasa de falla %:Q", scale=alt.Scale(scheme="orangered")),
+        tooltip=["equipo:N", "ítem:N", "tasa de falla %:Q", "fallas:Q", "revisiones:Q"],
+    ).properties(height=max(300, 14 * len({c["ítem"] for c in cells})))
+    st.altair_chart(heat, use_container_width=True)
+
+    st.markdown("### Ítems con más fallas")
+    st.dataframe(sorted(cells, key=lambda c: (-c["tasa de falla %"], -c["fallas"]))[:20],
+                 use_container_width=True, hide_index=True)
+
+    st.markdown("### Tendencia semanal")
+    st.line_chart(stats["weeks"], x="semana", y="tasa de falla %")
 
 def _reset_operator_checklist_state():
     keys = list(st.session_state.keys())
@@ -638,62 +3925,71 @@ def _reset_operator_checklist_state():
             except Exception:
                 pass
 
-def operator_panel():
-    st.subheader(f"👷 Operador: {st.session_state.get('full_name','')}")
-    st.info("Completa checklist → firma → enviar. Se guarda SOLO en Sheets y se genera PDF para descargar.")
-
-    eq_label_map = {f"{e['nombre']}": e for e in EQUIPOS}
-
-    def _on_equipo_change():
-        _reset_operator_checklist_state()
-        st.rerun()
-
-    sel = st.selectbox("Equipo", list(eq_label_map.keys()), key="op_eq_select", on_change=_on_equipo_change)
-    eq = eq_label_map[sel]
+def _checklist_state(codigo: str) -> dict:
+    # seccion -> {"items": [...payload...], "counts": Counter(estado)}; la clave lleva "::" y se limpia al cambiar de equipo
+    return st.session_state.setdefault(f"op_sections::{codigo}", {})
 
-    horometro = st.number_input("Horómetro inicial", min_value=0, step=1, value=0, key=f"hor_{eq['codigo']}")
+def _checklist_totals(codigo: str) -> Tuple[str, str]:
+    total = Counter()
+    for sec in _checklist_state(codigo).values():
+        total.update(sec["counts"])
+    return compute_result_from_counts(total)
 
-    st.markdown("## Lista de verificación")
+@st.fragment
+def _checklist_section(eq: dict, seccion: str, items: List[str]):
+    """Una sección del checklist: al cambiar un estado solo se re-ejecuta esta sección."""
+    with perf_rerun(f"sección:{seccion}"):
+        _checklist_section_body(eq, seccion, items)
 
-    items_payload = []
-    estados_all = []
-    checklist = CHECKLISTS[eq["tipo"]]
+def _checklist_section_body(eq: dict, seccion: str, items: List[str]):
+    st.markdown(f"### {seccion}")
+    section_payload = []
+    for item in items:
+        c1, c2, c3 = st.columns([2.2, 1.2, 2.2])
+        with c1:
+            st.write(item)
+        with c2:
+            estado = st.selectbox("Estado", STATUS_OPCIONES, key=f"{eq['codigo']}::{seccion}::{item}::estado")
+        with c3:
+            obs = st.text_input("Observación (si aplica)", key=f"{eq['codigo']}::{seccion}::{item}::obs")
 
-    for seccion, items in checklist:
-        st.markdown(f"### {seccion}")
-        for item in items:
-            c1, c2, c3 = st.columns([2.2, 1.2, 2.2])
-            with c1:
-                st.write(item)
-            with c2:
-                estado = st.selectbox("Estado", STATUS_OPCIONES, key=f"{eq['codigo']}::{seccion}::{item}::estado")
-            with c3:
-                obs = st.text_input("Observación (si aplica)", key=f"{eq['codigo']}::{seccion}::{item}::obs")
-
-            foto_bytes = b""
-            if estado in ("OPERATIVO CON FALLA", "INOPERATIVO"):
-                up = st.file_uploader(
-                    f"Foto (se incrusta en el PDF): {item}",
-                    type=["png", "jpg", "jpeg", "webp"],
-                    key=f"{eq['codigo']}::{seccion}::{item}::foto"
-                )
-                if up:
-                    foto_bytes = upload_to_png_bytes(up)
+        foto_bytes, up = b"", None
+        if estado in ("OPERATIVO CON FALLA", "INOPERATIVO"):
+            up = st.file_uploader(
+                f"Foto (se incrusta en el PDF): {item}",
+                type=["png", "jpg", "jpeg", "webp"],
+                key=f"{eq['codigo']}::{seccion}::{item}::foto"
+            )
+            if up:
+                foto_bytes = upload_to_photo_bytes(up)
 
-            estados_all.append(estado)
-            items_payload.append({
-                "seccion": seccion,
-                "item": item,
-                "estado": estado,
-                "observacion": (obs or "").strip(),
-                "foto_bytes": foto_bytes
-            })
+        section_payload.append({
+            "seccion": seccion,
+            "item": item,
+            "estado": estado,
+            "observacion": (obs or "").strip(),
+            "foto_bytes": foto_bytes,
+            "foto_src": up if foto_bytes else None,  # original, por si hay que re-codificar (fit_photos_to_budget)
+        })
 
-    estado_general, resultado_final = compute_result(estados_all)
+    _checklist_state(eq["codigo"])[seccion] = {
+        "items": section_payload,
+        "counts": Counter(it["estado"] for it in section_payload),
+    }
+    # El resultado automático se muestra fuera del fragmento: solo si cambia se re-ejecuta la página
+    shown = st.session_state.get(f"op_result::{eq['codigo']}")
+    totals = _checklist_totals(eq["codigo"])
+    if shown is not None and shown != totals:
+        st.session_state[f"op_result::{eq['codigo']}"] = totals
+        st.rerun(scope="app")
 
-    st.markdown("## Firma operador")
-    st.write(f"Resultado automático: **{resultado_final}**")
+@st.fragment
+def _operator_submit(eq: dict, checklist):
+    """Firma + envío: dibujar la firma no re-ejecuta el checklist."""
+    with perf_rerun("firma/envío"):
+        _operator_submit_body(eq, checklist)
 
+def _operator_submit_body(eq: dict, checklist):
     sig = st_canvas(
         fill_color="rgba(255,255,255,0)",
         stroke_width=2,
@@ -708,19 +4004,28 @@ def operator_panel():
     obs_general = st.text_area("Observaciones generales (opcional)", key=f"obsgen_{eq['codigo']}")
 
     if st.button("📨 Enviar y generar PDF (descarga)", key=f"send_{eq['codigo']}"):
+        if TEMPLATES_ERROR:
+            st.error(TEMPLATES_ERROR)
+            return
         firma_bytes = canvas_to_png_bytes(sig)
         if not firma_bytes:
             st.error("La firma del operador es obligatoria.")
             return
 
+        sections = _checklist_state(eq["codigo"])
+        items_payload = [dict(it) for seccion, _ in checklist for it in sections[seccion]["items"]]
+        estado_general, resultado_final = _checklist_totals(eq["codigo"])
+        horometro = st.session_state.get(f"hor_{eq['codigo']}", 0)
+
         # si item es falla o inoperativo, exige foto (para el PDF)
         for it in items_payload:
             if it["estado"] in ("OPERATIVO CON FALLA", "INOPERATIVO") and not it.get("foto_bytes"):
                 st.error(f"Falta foto para el PDF en: {it['item']}")
                 return
 
-        report_id = next_report_id()
-
+        with perf_phase("fotos"):
+            fit_photos_to_budget(items_payload)
+        report_id = new_report_id()
         payload = {
             "report_id": report_id,
             "created_at": datetime.now().isoformat(timespec="seconds"),
@@ -739,7 +4044,8 @@ def operator_panel():
         }
 
         # 1) Guardar SOLO datos en Sheets (sin fotos, sin firmas, sin PDFs)
-        append_row_sheet("reports", [
+        #    Va a la cola local; el worker lo envía en un batchUpdate (todo o nada).
+        report_row = [
             report_id,
             payload["equipment_tipo"],
             payload["equipment_codigo"],
@@ -752,37 +4058,89 @@ def operator_panel():
             payload["resultado_final"],
             payload["estado_general"],
             payload.get("obs_general", ""),
-        ])
+        ]
+        item_rows = [
+            encode_item_row(report_id, eq["tipo"], it["seccion"], it["item"], it["estado"],
+                            it.get("observacion", ""), bool(it.get("foto_bytes")))
+            for it in payload["items"]
+        ]
+        # 2) PDF en paralelo (pool del proceso) mientras el reporte se guarda en la cola
+        with st.status("Guardando reporte y generando PDF…") as status:
+            pdf_future = _pdf_pool().submit(generate_pdf_bytes, payload)
+            with perf_phase("cola"):
+                ok, err = enqueue_report(report_id, report_row, item_rows)
+            if not ok:
+                pdf_future.cancel()
+                status.update(label="No se pudo guardar el reporte", state="error")
+                st.error(err)
+                return
+            status.update(label="Reporte guardado. Terminando PDF…")
+            with perf_phase("pdf"):
+                pdf_bytes, pdf_name = pdf_future.result()
+            status.update(label="PDF listo", state="complete")
 
-        for it in payload["items"]:
-            append_row_sheet("report_items", [
-                report_id,
-                it["seccion"],
-                it["item"],
-                it["estado"],
-                it.get("observacion", ""),
-                "SI" if bool(it.get("foto_bytes")) else "NO",
+        # 3) Firma, fotos y PDF al almacén local: la descarga sobrevive a los reruns
+        try:
+            store_report_artifacts(report_id, [("pdf", pdf_name, pdf_bytes), ("firma", "firma_operador.png", firma_bytes)] + [
+                ("foto", f"{it['seccion']} - {it['item']}.jpg", it["foto_bytes"]) for it in items_payload if it.get("foto_bytes")
             ])
+            st.session_state["op_last_report"] = report_id
+        except Exception as e:
+            st.warning(f"No se pudo guardar el PDF en el servidor (descárgalo ahora): {e}")
+            st.download_button("⬇️ Descargar PDF", data=pdf_bytes, file_name=pdf_name, mime="application/pdf")
 
-        # 2) Generar PDF en memoria para descargar
-        pdf_bytes, pdf_name = generate_pdf_bytes(payload)
+        st.success(f"✅ Reporte recibido. ID: {report_id} (se sincroniza con Sheets en segundo plano)")
 
-        st.success(f"✅ Reporte guardado en Sheets. ID: {report_id}")
-        st.download_button(
-            "⬇️ Descargar PDF",
-            data=pdf_bytes,
-            file_name=pdf_name,
-            mime="application/pdf"
-        )
+    last_report = st.session_state.get("op_last_report")
+    if last_report:
+        st.markdown(f"#### Último reporte enviado: {last_report}")
+        artifact_download_buttons(last_report, kinds=("pdf",), key_prefix="op_last")
+
+def operator_panel():
+    st.subheader(f"👷 Operador: {st.session_state.get('full_name','')}")
+    st.info("Completa checklist → firma → enviar. Se guarda SOLO en Sheets y se genera PDF para descargar.")
+
+    eq_label_map = {f"{e['nombre']}": e for e in EQUIPOS}
+
+    def _on_equipo_change():
+        _reset_operator_checklist_state()
+        st.rerun()
+
+    sel = st.selectbox("Equipo", list(eq_label_map.keys()), key="op_eq_select", on_change=_on_equipo_change)
+    eq = eq_label_map[sel]
+
+    st.number_input("Horómetro inicial", min_value=0, step=1, value=0, key=f"hor_{eq['codigo']}")
+
+    st.markdown("## Lista de verificación")
+
+    checklist = CHECKLISTS[eq["tipo"]]
+    for seccion, items in checklist:
+        _checklist_section(eq, seccion, items)
+
+    estado_general, resultado_final = _checklist_totals(eq["codigo"])
+    st.session_state[f"op_result::{eq['codigo']}"] = (estado_general, resultado_final)
+
+    st.markdown("## Firma operador")
+    st.write(f"Resultado automático: **{resultado_final}**")
+
+    _operator_submit(eq, checklist)
 
 def main():
     st.set_page_config(page_title=APP_TITLE, layout="wide")
+    with perf_rerun("app"):
+        _main()
 
+def _main():
     # Sidebar debug siempre visible
-    debug_google()
+    with perf_phase("debug_google"):
+        debug_google()
+    perf_sidebar()
 
     # Inicializa hojas y usuario admin
-    init_db_like()
+    with perf_phase("init_db_like"):
+        init_db_like()
+    if TEMPLATES_ERROR:
+        st.error(TEMPLATES_ERROR)
 
     if not st.session_state.get("user") or not st.session_state.get("role") or not st.session_state.get("full_name"):
         st.session_state.pop("user", None)
@@ -793,10 +4151,11 @@ def main():
 
     sidebar_user()
 
-    if st.session_state.get("role") == "supervisor":
-        supervisor_panel()
-    else:
-        operator_panel()
+    with perf_phase("panel"):
+        if st.session_state.get("role") == "supervisor":
+            supervisor_panel()
+        else:
+            operator_panel()
 
 if __name__ == "__main__":
     main()
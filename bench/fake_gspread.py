@@ -0,0 +1,257 @@
+"""
+Fake en memoria de la parte de gspread que usa app.py, para benchmarks sin Google.
+
+- Cliente/Spreadsheet/Worksheet con los métodos que llama la app
+  (open_by_key, worksheets, worksheet, add_worksheet, batch_update, values_batch_get,
+  append_row, row_values, get_all_values, get_all_records, get, update, ws.batch_update).
+- Latencia configurable por llamada (lectura/escritura + jitter).
+- Cuota por minuto como la de Sheets API: al pasarse responde 429, igual que Google.
+- Cuenta llamadas por método (FakeClient.calls).
+"""
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from typing import Dict, List, Optional
+
+READ_METHODS = {"open_by_key", "worksheets", "worksheet", "values_batch_get", "row_values",
+                "get_all_values", "get_all_records", "get"}
+
+class _Response:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+
+class FakeAPIError(Exception):
+    """Mismo contrato que gspread.exceptions.APIError para la app: e.response.status_code."""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.response = _Response(status_code)
+
+class WorksheetNotFound(Exception):
+    pass
+
+def _col_number(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n
+
+def _parse_a1(rng: str):
+    """'A1:F', 'B2', '5:7', 'A:C' -> (r1, c1, r2, c2) 1-based inclusivos (None = sin límite)."""
+    m = re.match(r"^([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?$", rng.strip())
+    if not m:
+        raise FakeAPIError(400, f"Rango inválido: {rng}")
+    c1 = _col_number(m.group(1)) if m.group(1) else 1
+    r1 = int(m.group(2)) if m.group(2) else 1
+    if m.group(3) is None and m.group(4) is None:
+        # celda o fila/columna suelta
+        c2 = c1 if m.group(1) else None
+        r2 = r1 if m.group(2) else None
+    else:
+        c2 = _col_number(m.group(3)) if m.group(3) else None
+        r2 = int(m.group(4)) if m.group(4) else None
+    return r1, c1, r2, c2
+
+def _cell_value(cell: dict) -> str:
+    v = next(iter(cell.get("userEnteredValue", {"stringValue": ""}).values()))
+    return str(v)
+
+class FakeClient:
+    def __init__(self, read_ms: float = 0.0, write_ms: float = 0.0, jitter_ms: float = 0.0,
+                 reads_per_min: Optional[int] = None, writes_per_min: Optional[int] = None,
+                 error_rate: float = 0.0, seed: int = 0):
+        self.read_ms, self.write_ms, self.jitter_ms = read_ms, write_ms, jitter_ms
+        self.quota = {"read": reads_per_min, "write": writes_per_min}
+        self.error_rate = error_rate
+        self.calls: Counter = Counter()
+        self.throttled: Counter = Counter()
+        self._window = {"read": deque(), "write": deque()}
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self.spreadsheet = FakeSpreadsheet(self)
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+            self.throttled.clear()
+
+    def _api(self, method: str):
+        """Cuenta, aplica cuota (ventana deslizante de 60 s) y simula latencia."""
+        kind = "read" if method in READ_METHODS else "write"
+        with self._lock:
+            self.calls[method] += 1
+            limit = self.quota[kind]
+            if limit:
+                win, now = self._window[kind], time.monotonic()
+                while win and now - win[0] > 60:
+                    win.popleft()
+                if len(win) >= limit:
+                    self.throttled[method] += 1
+                    raise FakeAPIError(429, f"Quota exceeded for quota metric '{kind} requests'")
+                win.append(now)
+            fail = self.error_rate and self._rng.random() < self.error_rate
+            delay = (self.read_ms if kind == "read" else self.write_ms) + self._rng.uniform(0, self.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000)
+        if fail:
+            self.throttled[method] += 1
+            raise FakeAPIError(429, "Rate limit exceeded (simulado)")
+
+    def open_by_key(self, key: str) -> "FakeSpreadsheet":
+        self._api("open_by_key")
+        return self.spreadsheet
+
+class FakeSpreadsheet:
+    def __init__(self, client: FakeClient):
+        self.client = client
+        self._sheets: Dict[str, FakeWorksheet] = {}
+        self._next_id = 0
+
+    # --- siembra directa (sin contar llamadas) ---
+    def seed(self, title: str, rows: List[list]) -> "FakeWorksheet":
+        ws = self._sheets.get(title) or self._new(title)
+        ws.rows = rows
+        return ws
+
+    def _new(self, title: str, sheet_id: Optional[int] = None) -> "FakeWorksheet":
+        self._next_id += 1
+        ws = FakeWorksheet(self, title, sheet_id if sheet_id is not None else self._next_id)
+        self._sheets[title] = ws
+        return ws
+
+    def _by_id(self, sheet_id: int) -> "FakeWorksheet":
+        for ws in self._sheets.values():
+            if ws.id == sheet_id:
+                return ws
+        raise FakeAPIError(400, f"No grid with id: {sheet_id}")
+
+    # --- API ---
+    def worksheets(self) -> List["FakeWorksheet"]:
+        self.client._api("worksheets")
+        return list(self._sheets.values())
+
+    def worksheet(self, title: str) -> "FakeWorksheet":
+        self.client._api("worksheet")
+        if title not in self._sheets:
+            raise WorksheetNotFound(title)
+        return self._sheets[title]
+
+    def add_worksheet(self, title: str, rows: int = 1000, cols: int = 26) -> "FakeWorksheet":
+        self.client._api("add_worksheet")
+        if title in self._sheets:
+            raise FakeAPIError(400, f"A sheet with the name \"{title}\" already exists.")
+        return self._new(title)
+
+    def del_worksheet(self, ws: "FakeWorksheet"):
+        self.client._api("del_worksheet")
+        self._sheets.pop(ws.title, None)
+
+    def values_batch_get(self, ranges: List[str], params=None) -> dict:
+        self.client._api("values_batch_get")
+        out = []
+        for r in ranges:
+            title, a1 = r.rsplit("!", 1)
+            title = title.strip("'")
+            values = self._sheets[title]._read(a1) if title in self._sheets else []
+            out.append({"range": r, "values": values})
+        return {"valueRanges": out}
+
+    def batch_update(self, body: dict) -> dict:
+        self.client._api("batch_update")
+        for req in body.get("requests", []):
+            if "appendCells" in req:
+                a = req["appendCells"]
+                ws = self._by_id(a["sheetId"])
+                ws.rows.extend([_cell_value(c) for c in row.get("values", [])] for row in a["rows"])
+            elif "deleteDimension" in req:
+                d = req["deleteDimension"]["range"]
+                ws = self._by_id(d["sheetId"])
+                del ws.rows[d["startIndex"]:d["endIndex"]]
+            elif "updateCells" in req:
+                u = req["updateCells"]
+                ws = self._by_id(u["start"]["sheetId"])
+                r0, c0 = u["start"].get("rowIndex", 0), u["start"].get("columnIndex", 0)
+                ws._write(r0 + 1, c0 + 1, [[_cell_value(c) for c in row.get("values", [])] for row in u["rows"]])
+            elif "addSheet" in req:
+                props = req["addSheet"]["properties"]
+                if props["title"] in self._sheets:
+                    raise FakeAPIError(400, f"A sheet with the name \"{props['title']}\" already exists.")
+                self._new(props["title"], props.get("sheetId"))
+            else:
+                raise FakeAPIError(400, f"Request no soportado por el fake: {list(req)}")
+        return {"replies": []}
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet: FakeSpreadsheet, title: str, sheet_id: int):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self.rows: List[list] = []
+
+    @property
+    def row_count(self) -> int:
+        return max(1000, len(self.rows))
+
+    def _api(self, method: str):
+        self.spreadsheet.client._api(method)
+
+    def _read(self, a1: str) -> List[list]:
+        r1, c1, r2, c2 = _parse_a1(a1)
+        out = [list(r[c1 - 1:c2]) for r in self.rows[r1 - 1:r2]]
+        while out and not any(out[-1]):  # Sheets no devuelve filas vacías al final
+            out.pop()
+        return out
+
+    def _write(self, r1: int, c1: int, values: List[list]):
+        for k, row in enumerate(values):
+            while len(self.rows) < r1 + k:
+                self.rows.append([])
+            target = self.rows[r1 + k - 1]
+            for j, v in enumerate(row):
+                while len(target) < c1 + j:
+                    target.append("")
+                target[c1 + j - 1] = str(v)
+
+    # --- API ---
+    def append_row(self, values: list, value_input_option: str = "RAW", **kwargs):
+        self._api("append_row")
+        self.rows.append([str(v) for v in values])
+
+    def row_values(self, row: int, **kwargs) -> List[str]:
+        self._api("row_values")
+        values = list(self.rows[row - 1]) if len(self.rows) >= row else []
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def get_all_values(self, **kwargs) -> List[list]:
+        self._api("get_all_values")
+        return [list(r) for r in self.rows]
+
+    def get_all_records(self, **kwargs) -> List[dict]:
+        self._api("get_all_records")
+        if not self.rows:
+            return []
+        header = self.rows[0]
+        return [dict(zip(header, r + [""] * (len(header) - len(r)))) for r in self.rows[1:]]
+
+    def get(self, range_name: str = "A1:ZZ", **kwargs) -> List[list]:
+        self._api("get")
+        return self._read(range_name)
+
+    def update(self, values=None, range_name: str = "A1", **kwargs):
+        self._api("update")
+        r1, c1, _, _ = _parse_a1(range_name)
+        self._write(r1, c1, values or [])
+
+    def batch_update(self, data: List[dict], **kwargs):
+        self._api("ws_batch_update")
+        for d in data:
+            r1, c1, _, _ = _parse_a1(d["range"].rsplit("!", 1)[-1])
+            self._write(r1, c1, d["values"])
+
+    def delete_rows(self, start_index: int, end_index: Optional[int] = None):
+        self._api("delete_rows")
+        del self.rows[start_index - 1:(end_index or start_index)]
@@ -0,0 +1,252 @@
+"""
+Benchmarks offline de app.py contra un gspread falso (bench/fake_gspread.py): sin Google.
+
+Uso (desde la raíz del repo, con las dependencias de requirements.txt):
+
+    python bench/run_bench.py                                   # 1k / 10k / 100k reportes
+    python bench/run_bench.py --sizes 1000 10000 --read-ms 120 --write-ms 250 --jitter-ms 60
+    python bench/run_bench.py --reads-per-min 60 --writes-per-min 60   # cuota real de Sheets: 429
+    python bench/run_bench.py --out bench_output.json
+    python bench/run_bench.py --shared-cache                    # cache de hojas compartido (SQLite)
+
+Escenarios por tamaño (hojas sembradas directamente en el fake, sin contar llamadas):
+  arranque             init_db_like(): verificación de esquema + usuario admin
+  login                auth_user() de N operadores (+1 clave errónea), hoja users sin cache
+  login_cacheado       lo mismo con la hoja users ya en cache
+  operador_envio       operator_panel() vía AppTest: clic en "Enviar", hasta que la cola queda vacía
+  supervisor_frio      supervisor_panel() vía AppTest con el cache de hojas vacío (todas las pestañas)
+  supervisor_caliente  el mismo panel en el rerun siguiente
+  supervisor_replica   el panel en otra réplica (cache local vacío) que toma la copia compartida
+                       (solo con --shared-cache)
+  migracion            migrate_report_items(): report_items con etiquetas completas -> códigos
+                       (solo con --legacy-items, que siembra el formato anterior)
+  archivo              archive_old_months(): meses fuera de la ventana viva a hojas por mes
+  consulta_archivo     query_reports() de los últimos 365 días (hoja viva + meses archivados)
+
+Por escenario: llamadas a la API por método, respuestas 429, tiempo (s) y memoria pico
+(tracemalloc, MB por encima de lo ya asignado al empezar el escenario).
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)  # st.secrets y assets/ relativos a la raíz
+
+import streamlit as st
+from PIL import Image
+from streamlit.testing.v1 import AppTest
+
+import app
+from fake_gspread import FakeClient
+
+OPERATORS = 20
+BENCH_PASSWORD = "bench-1234"
+
+def _signature_png() -> bytes:
+    buf = io.BytesIO()
+    img = Image.new("RGB", (520, 120), "white")
+    for x in range(40, 480):
+        img.putpixel((x, 60 + (x % 20) - 10), (0, 0, 0))
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+def seed(client: FakeClient, n_reports: int, items_per_report: int, rng: random.Random, legacy_items: bool = False):
+    sh = client.spreadsheet
+    salt_b64, pw_hash, iters = app.new_password_fields(BENCH_PASSWORD)
+    users = [list(app.USERS_HEADERS)] + [
+        [f"op{i}", f"Operador {i}", "operador", "1", salt_b64, pw_hash, "2025-01-01T00:00:00", str(iters)]
+        for i in range(OPERATORS)
+    ]
+    sh.seed("users", users)
+
+    reports = [list(app.REPORTS_HEADERS)]
+    items = [list(app.LEGACY_REPORT_ITEMS_HEADERS if legacy_items else app.REPORT_ITEMS_HEADERS)]
+    today = date.today()
+    estados = app.STATUS_OPCIONES
+    for n in range(n_reports):
+        eq = app.EQUIPOS[n % len(app.EQUIPOS)]
+        day = today - timedelta(days=rng.randrange(365))
+        op = rng.randrange(OPERATORS)
+        checklist = [(sec, it) for sec, its in app.CHECKLISTS[eq["tipo"]] for it in its][:items_per_report]
+        item_estados = [rng.choices(estados, weights=(90, 8, 2))[0] for _ in checklist]
+        estado_general, resultado = app.compute_result(item_estados)
+        report_id = f"{day:%Y%m%d}-{n:06d}-BENCH"
+        reports.append([
+            report_id, eq["tipo"], eq["codigo"], eq["nombre"], str(rng.randrange(20000)),
+            f"op{op}", f"Operador {op}", f"{day.isoformat()}T08:00:00", day.isoformat(),
+            resultado, estado_general, "",
+        ])
+        if legacy_items:
+            items.extend(
+                [report_id, sec, it, est, "", "SI" if est != "OPERATIVO" else "NO"]
+                for (sec, it), est in zip(checklist, item_estados)
+            )
+        else:
+            items.extend(
+                app.encode_item_row(report_id, eq["tipo"], sec, it, est, "", est != "OPERATIVO")
+                for (sec, it), est in zip(checklist, item_estados)
+            )
+    sh.seed("reports", reports)
+    sh.seed("report_items", items)
+
+def fresh_app(client: FakeClient, workdir: str, shared_cache: bool = False):
+    """Caches de proceso vacíos y rutas locales aisladas para cada tamaño."""
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    app.get_google_client = lambda: (client, "BENCH", None)
+    app.OUTBOX_PATH = os.path.join(workdir, "outbox.sqlite3")
+    app.ARTIFACTS_DIR = os.path.join(workdir, "artifacts")
+    app.EXPORTS_DIR = os.path.join(workdir, "exports")
+    app.PERF_LOG_PATH = ""
+    app.SHARED_CACHE = "sqlite" if shared_cache else ""
+    app.SHARED_CACHE_PATH = os.path.join(workdir, "shared_cache.sqlite3")
+    app.ARCHIVE_AUTO = False  # el archivo mensual se mide aparte (escenario "archivo")
+    app.canvas_to_png_bytes = lambda sig, _png=_signature_png(): _png  # el canvas no dibuja fuera del navegador
+
+def measure(name: str, client: FakeClient, fn) -> dict:
+    client.reset_counters()
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    t0 = time.perf_counter()
+    extra = fn() or {}
+    wall = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    return {
+        "escenario": name,
+        "segundos": round(wall, 3),
+        "llamadas": sum(client.calls.values()),
+        "por_metodo": dict(sorted(client.calls.items())),
+        "429": sum(client.throttled.values()),
+        "mem_pico_mb": round((peak - base) / 1e6, 1),
+        **extra,
+    }
+
+def _operator_script():
+    import app
+    app.operator_panel()
+
+def _supervisor_script():
+    import app
+    app.supervisor_panel()
+
+def _app_test(script, role: str, user: str, timeout: float) -> AppTest:
+    at = AppTest.from_function(script, default_timeout=timeout)
+    at.session_state["user"] = user
+    at.session_state["role"] = role
+    at.session_state["full_name"] = user
+    return at
+
+def scenario_other_replica(sup: AppTest):
+    """Otra réplica: mismo cache compartido, cache de hojas y de datos del proceso vacíos."""
+    def run():
+        app._records_cache()["entries"].clear()
+        st.cache_data.clear()
+        sup.run()
+        return {"copias_compartidas": app.records_cache_stats()["shared_hits"]}
+    return run
+
+def scenario_login(client: FakeClient):
+    ok = 0
+    for i in range(OPERATORS):
+        ok += bool(app.auth_user(f"op{i}", BENCH_PASSWORD, client_ip="10.0.0.1"))
+    ok += bool(app.auth_user("op0", "clave-errónea", client_ip="10.0.0.2"))
+    return {"logins_ok": ok}
+
+def scenario_submit(submissions: int, timeout: float):
+    def run():
+        at = _app_test(_operator_script, "operador", "op0", timeout).run()
+        for _ in range(submissions):
+            at.button(key=next(b.key for b in at.button if b.key and b.key.startswith("send_"))).click().run()
+            if at.exception or at.error:
+                raise RuntimeError(f"Envío falló: {[e.value for e in at.exception] or [e.value for e in at.error]}")
+        deadline = time.monotonic() + timeout
+        while app.outbox_stats()["pending"] and time.monotonic() < deadline:
+            app._outbox_worker()["wake"].set()
+            time.sleep(0.05)
+        return {"pendientes": app.outbox_stats()["pending"]}
+    return run
+
+def run_size(n_reports: int, args) -> list:
+    rng = random.Random(args.seed)
+    client = FakeClient(read_ms=args.read_ms, write_ms=args.write_ms, jitter_ms=args.jitter_ms,
+                        reads_per_min=args.reads_per_min, writes_per_min=args.writes_per_min,
+                        error_rate=args.error_rate, seed=args.seed)
+    seed(client, n_reports, args.items_per_report, rng, args.legacy_items)
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        fresh_app(client, workdir, args.shared_cache)
+        results.append(measure("arranque", client, app.init_db_like))
+        if args.legacy_items:
+            results.append(measure("migracion", client, lambda: {
+                "migradas": sum(app.migrate_report_items().values())
+            }))
+        app.invalidate_records("users")
+        results.append(measure("login", client, lambda: scenario_login(client)))
+        results.append(measure("login_cacheado", client, lambda: scenario_login(client)))
+        results.append(measure("operador_envio", client, scenario_submit(args.submissions, args.timeout)))
+        app.invalidate_records()
+        sup = _app_test(_supervisor_script, "supervisor", app.ADMIN_USER, args.timeout)
+        results.append(measure("supervisor_frio", client, lambda: sup.run() and None))
+        results.append(measure("supervisor_caliente", client, lambda: sup.run() and None))
+        if args.shared_cache:
+            results.append(measure("supervisor_replica", client, scenario_other_replica(sup)))
+        if sup.exception:
+            raise RuntimeError(f"supervisor_panel falló: {[e.value for e in sup.exception]}")
+        results.append(measure("archivo", client, lambda: {"movidos": sum(app.archive_old_months().values())}))
+        year = (date.today() - timedelta(days=365), date.today())
+        results.append(measure("consulta_archivo", client, lambda: {
+            "coincidencias": app.query_reports(start=year[0], end=year[1], page_size=50)[1]
+        }))
+    for r in results:
+        r["reportes"] = n_reports
+    return results
+
+def print_table(results: list):
+    cols = ["reportes", "escenario", "segundos", "llamadas", "429", "mem_pico_mb"]
+    print(" | ".join(f"{c:>19}" for c in cols))
+    for r in results:
+        print(" | ".join(f"{r[c]!s:>19}" for c in cols) + "   " + json.dumps(r["por_metodo"]))
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    p.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    p.add_argument("--items-per-report", type=int, default=10,
+                   help="ítems sembrados por reporte (el checklist real tiene ~45; 100k×45 pide varios GB)")
+    p.add_argument("--submissions", type=int, default=5)
+    p.add_argument("--legacy-items", action="store_true",
+                   help="siembra report_items con etiquetas completas y mide la migración a códigos")
+    p.add_argument("--shared-cache", action="store_true",
+                   help="activa el cache de hojas compartido entre réplicas (SQLite en el directorio temporal)")
+    p.add_argument("--read-ms", type=float, default=0.0)
+    p.add_argument("--write-ms", type=float, default=0.0)
+    p.add_argument("--jitter-ms", type=float, default=0.0)
+    p.add_argument("--reads-per-min", type=int, default=None)
+    p.add_argument("--writes-per-min", type=int, default=None)
+    p.add_argument("--error-rate", type=float, default=0.0, help="probabilidad de 429 aleatorio por llamada")
+    p.add_argument("--timeout", type=float, default=600.0, help="segundos máximos por rerun de AppTest")
+    p.add_argument("--seed", type=int, default=7)
+    p.add_argument("--out", help="escribe los resultados como JSON")
+    args = p.parse_args()
+
+    tracemalloc.start()
+    results = []
+    for n in args.sizes:
+        size_results = run_size(n, args)
+        print_table(size_results)
+        results.extend(size_results)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()